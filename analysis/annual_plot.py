@@ -4,9 +4,12 @@ import matplotlib.dates as mdates
 
 from src.plot_setup import bg_color, main_palette, season_color_dict
 from src.utils import save_plt_dated
+from src.trace import traced
 
+@traced('plot')
 def plot_annual_stats(summary_df,
-                      plot_folder=None):
+                      plot_folder=None,
+                      filename=None):
     
     if 'year_month' in summary_df.columns:
         # Convert year_month to datetime for proper sorting and display
@@ -15,7 +18,7 @@ def plot_annual_stats(summary_df,
         
         # Generate title and filename
         plot_title = 'Surf Stats by Year and Month'
-        filename = 'surf_stats_bar_charts_by_month_year.png'
+        filename = filename or 'surf_stats_bar_charts_by_month_year.png'
     else:
         # Ensure year is in a suitable format for plotting
         summary_df['year'] = pd.to_numeric(summary_df['year'], errors='coerce')
@@ -24,7 +27,7 @@ def plot_annual_stats(summary_df,
         
         # Generate title and filename
         plot_title = 'Surf Stats by Year'
-        filename = 'surf_stats_bar_charts_by_year.png'
+        filename = filename or 'surf_stats_bar_charts_by_year.png'
 
     # Create the figure with 4 subplots stacked vertically
     fig, axes = plt.subplots(4, 1, figsize=(16, 14), sharex=True)
@@ -106,7 +109,9 @@ def plot_annual_stats(summary_df,
 
 
 
-def plot_seasonal_stats(summary_df, plot_folder=None, season_palette=season_color_dict):
+@traced('plot')
+def plot_seasonal_stats(summary_df, plot_folder=None, season_palette=season_color_dict,
+                        filename='surf_stats_bar_charts_by_month_season.png'):
     """
     Plots annual surf summaries, coloring bars by season.
 
@@ -114,6 +119,7 @@ def plot_seasonal_stats(summary_df, plot_folder=None, season_palette=season_colo
         summary_df (pd.DataFrame): Must contain columns 'year_month', 'season', and all relevant metrics.
         plot_folder (str): Folder path for saving the plot.
         season_palette (dict): Mapping from season name to color, e.g. {'Winter': '#1f77b4', ...}
+        filename (str): Name of the png the plot is saved as.
     """
     # Ensure required columns are present
     required_cols = ['year_month', 'season',
@@ -126,9 +132,8 @@ def plot_seasonal_stats(summary_df, plot_folder=None, season_palette=season_colo
     summary_df['year_month'] = pd.to_datetime(summary_df['year_month'], format='%Y-%m')
     summary_df = summary_df.sort_values('year_month')
 
-    # Generate title and filename
+    # Generate title
     plot_title = 'Surf Stats by Month and Season'
-    filename = 'surf_stats_bar_charts_by_month_season.png'
 
     # Map color for each row
     bar_colors = summary_df['season'].map(season_palette).fillna('#CCCCCC')
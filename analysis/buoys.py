@@ -0,0 +1,220 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.trace import traced
+from src.buoy_archive import ARCHIVE_COLS, ARCHIVE_META_FILE, archive_stations, load_station, station_window
+
+# csv file with the buoy of every subregion (spot left empty) or spot (overrides its subregion's buoy),
+# and the timezone the sessions there are logged in
+SPOT_BUOY_MAP_FILE = 'input/spot_buoy_map.csv'
+# folder with the observations of every buoy: the buoy archive (see src.buoy_archive) and/or a <station>.csv per buoy
+BUOY_FOLDER = 'input/buoys'
+
+# Conditions attached to every session (the columns of the buoy archive)
+BUOY_COLS = ARCHIVE_COLS
+# conditions that are angles (averaged on the circle)
+DIRECTION_COLS = ['mwd', 'wdir']
+
+# Nominal local hour of a session, by the time of day it was logged at (sessions without one are taken at midday)
+WHEN_HOURS = {'morning': 7, 'midday': 12, 'afternoon': 15, 'evening': 18, 'night': 20}
+DEFAULT_HOUR = 12
+# Largest gap between a session and the buoy observation attached to it
+BUOY_TOLERANCE = pd.Timedelta(hours=3)
+
+
+def load_spot_buoy_map(buoy_map_file=SPOT_BUOY_MAP_FILE):
+    """
+    Read the spot -> buoy map; a row without a spot is the buoy of the whole subregion.
+    Returns:
+        DataFrame with the columns subregion, spot ('' for a subregion), station and timezone
+    """
+    buoy_map = pd.read_csv(buoy_map_file, dtype=str, keep_default_na=False)
+    missing = {'subregion', 'spot', 'station', 'timezone'} - set(buoy_map.columns)
+    if missing:
+        raise ValueError(f'The buoy map {buoy_map_file} is missing the column(s) {", ".join(sorted(missing))}')
+    duplicated = buoy_map[buoy_map.duplicated(['subregion', 'spot'])]
+    if len(duplicated):
+        raise ValueError(f'The buoy map {buoy_map_file} has more than one buoy for: '
+                         f'{", ".join((duplicated["subregion"] + " " + duplicated["spot"]).str.strip())}')
+    return buoy_map
+
+
+def load_buoy_observations(buoy_folder=BUOY_FOLDER, stations=None):
+    """
+    Read the observations of the buoys: the stations in the buoy archive are opened as memory maps (see src.buoy_archive),
+    the others are read from a <station>.csv with a 'time' column (UTC) and any of the BUOY_COLS (missing values left empty).
+    Arguments:
+        buoy_folder: folder with the buoy archive and/or the csv files
+        stations: stations to read (None for every station in the folder); stations without observations are skipped
+    Returns:
+        dictionary of {station: 'time' (sorted) and the BUOY_COLS (float32)}, as a dictionary of arrays or a DataFrame
+    """
+    if not os.path.isdir(buoy_folder):
+        raise FileNotFoundError(f'No buoy observations found, "{buoy_folder}" does not exist')
+    if stations is None:
+        stations = sorted(set(archive_stations(buoy_folder)) |
+                          {os.path.splitext(file_name)[0] for file_name in os.listdir(buoy_folder) if file_name.endswith('.csv')})
+
+    observations = {}
+    for station in stations:
+        if os.path.exists(os.path.join(buoy_folder, station, ARCHIVE_META_FILE)):
+            observations[station] = load_station(buoy_folder, station)
+            continue
+        file_path = os.path.join(buoy_folder, f'{station}.csv')
+        if not os.path.exists(file_path):
+            print(f'No observations for buoy {station} ({file_path}), its sessions get no conditions')
+            continue
+        df = pd.read_csv(file_path, parse_dates=['time'])
+        df['time'] = pd.to_datetime(df['time'], utc=True).dt.tz_localize(None)
+        observations[station] = (df
+                                 .reindex(columns=['time'] + BUOY_COLS)
+                                 .astype({col: 'float32' for col in BUOY_COLS})
+                                 .sort_values('time', kind='stable', ignore_index=True))
+    return observations
+
+
+# Fingerprint of the buoy data (file sizes and modification times), so cached conditions are rebuilt when it changes
+# (an archived station is rebuilt as a whole, so its metadata file stands for it)
+def buoy_fingerprint(buoy_folder=BUOY_FOLDER, buoy_map_file=SPOT_BUOY_MAP_FILE):
+    file_paths = [buoy_map_file]
+    if os.path.isdir(buoy_folder):
+        file_paths += sorted(os.path.join(buoy_folder, file_name) for file_name in os.listdir(buoy_folder))
+        file_paths += [os.path.join(buoy_folder, station, ARCHIVE_META_FILE) for station in archive_stations(buoy_folder)]
+    return {file_path: [os.stat(file_path).st_size, os.stat(file_path).st_mtime_ns]
+            for file_path in file_paths if os.path.isfile(file_path)}
+
+
+# Function to look up the buoy (and timezone) of every session: the buoy of its spot, else the buoy of its subregion
+def map_session_buoys(sessions, buoy_map):
+    subregion = sessions['subregion'].astype(object).to_numpy()
+    spot = sessions['spot'].astype(object).to_numpy()
+    by_spot = buoy_map[buoy_map['spot'] != ''].set_index(['subregion', 'spot'])
+    by_subregion = buoy_map[buoy_map['spot'] == ''].set_index('subregion')
+
+    mapped = {}
+    for col in ['station', 'timezone']:
+        spot_values = by_spot[col].reindex(pd.MultiIndex.from_arrays([subregion, spot])).to_numpy()
+        subregion_values = by_subregion[col].reindex(subregion).to_numpy()
+        mapped[col] = np.where(pd.isna(spot_values), subregion_values, spot_values)
+    return mapped['station'], mapped['timezone']
+
+
+# Function to get the (UTC) time of every session, from its date and the nominal hour of its time of day
+def session_times(sessions, timezones):
+    hours = sessions['when'].astype(object).map(WHEN_HOURS).fillna(DEFAULT_HOUR).to_numpy(dtype=np.float64)
+    local_times = pd.DatetimeIndex(sessions['date']) + pd.to_timedelta(hours, unit='h')
+
+    times = np.full(len(sessions), np.datetime64('NaT'), dtype='datetime64[ns]')
+    for timezone in pd.unique(timezones[pd.notna(timezones)]):
+        mask = timezones == timezone
+        # (the nominal hours are never in a daylight saving time change)
+        times[mask] = (local_times[mask]
+                       .tz_localize(timezone, ambiguous=False, nonexistent='shift_forward')
+                       .tz_convert('UTC')
+                       .tz_localize(None))
+    return times
+
+
+def nearest_index(obs_times, times, tolerance):
+    """
+    Find the observation nearest in time to each of the times, in a single binary search over the sorted observation times
+    (ties go to the earlier observation).
+    Arguments:
+        obs_times: sorted int64 array of observation times
+        times: int64 array of times to look up
+        tolerance: largest gap (same unit as the times) to an observation
+    Returns:
+        int array with the index of the nearest observation, -1 where there is none within the tolerance
+    """
+    n_obs = len(obs_times)
+    if n_obs == 0:
+        return np.full(len(times), -1)
+
+    right = np.searchsorted(obs_times, times)
+    left = np.maximum(right - 1, 0)
+    right = np.minimum(right, n_obs - 1)
+    gap_left = np.abs(times - obs_times[left])
+    gap_right = np.abs(obs_times[right] - times)
+
+    nearest = np.where(gap_right < gap_left, right, left)
+    nearest[np.minimum(gap_left, gap_right) > tolerance] = -1
+    return nearest
+
+
+@traced('process')
+def join_buoy_conditions(sessions, observations, buoy_map, tolerance=BUOY_TOLERANCE):
+    """
+    Attach the buoy conditions nearest in time to every session (an as-of join, per buoy).
+    Each condition comes from the nearest observation that has it (e.g. a buoy that only reports waves every other hour),
+    within the tolerance; sessions without a buoy, or without an observation close enough, get NaN.
+    Arguments:
+        sessions: processed session DataFrame
+        observations: dictionary of {station: observations}, see load_buoy_observations
+        buoy_map: spot -> buoy map, see load_spot_buoy_map
+        tolerance: largest gap between a session and an observation (Timedelta)
+    Returns:
+        the sessions, with the columns session_time (UTC), buoy_station and the BUOY_COLS
+    """
+    stations, timezones = map_session_buoys(sessions, buoy_map)
+    times = session_times(sessions, timezones)
+    tolerance = pd.Timedelta(tolerance).value
+
+    conditions = {col: np.full(len(sessions), np.nan, dtype=np.float32) for col in BUOY_COLS}
+    has_time = ~np.isnat(times)
+    for station in pd.unique(stations[pd.notna(stations)]):
+        rows = np.flatnonzero((stations == station) & has_time)
+        if station not in observations or not len(rows):
+            continue
+        station_times = times[rows].view(np.int64)
+        # only the observations around the sessions are read (a window of the memory maps, for an archived buoy)
+        obs = station_window({col: np.asarray(observations[station][col]) for col in ['time'] + BUOY_COLS},
+                             times[rows].min() - np.timedelta64(tolerance, 'ns'), times[rows].max() + np.timedelta64(tolerance, 'ns'))
+        obs_times = obs['time'].astype('datetime64[ns]', copy=False).view(np.int64)
+        for col in BUOY_COLS:
+            values = obs[col].astype(np.float32, copy=False)
+            observed = ~np.isnan(values)
+            nearest = nearest_index(obs_times[observed], station_times, tolerance)
+            conditions[col][rows] = np.where(nearest >= 0, values[observed][np.maximum(nearest, 0)], np.nan)
+
+    return sessions.assign(session_time=times,
+                           buoy_station=pd.Categorical(stations),
+                           **conditions)
+
+
+# Mean of angles in degrees per group (on the circle, so 350 and 10 average to 0 rather than 180)
+def circular_mean(angles, groups):
+    radians = np.deg2rad(angles)
+    sums = pd.DataFrame({'sin': np.sin(radians), 'cos': np.cos(radians)}).groupby(groups, observed=True).mean()
+    return np.rad2deg(np.arctan2(sums['sin'], sums['cos'])) % 360
+
+
+@traced('summarise')
+def summarise_good_conditions(session_conditions, good_wave_quality=9, group_col='subregion'):
+    """
+    Compare the buoy conditions of the good sessions (wave quality above good_wave_quality) with those of all sessions,
+    for the sessions with buoy data.
+    Arguments:
+        session_conditions: output of join_buoy_conditions
+        good_wave_quality: sessions with a wave quality above this are 'good'
+        group_col: column to compare by (e.g. 'subregion' or 'subregion_spot')
+    Returns:
+        DataFrame with per group the number of sessions and good sessions, and per condition its median over the good
+        sessions ('<col>_good') and over all the sessions ('<col>_all'); directions are circular means
+    """
+    df = session_conditions[session_conditions[BUOY_COLS].notna().any(axis=1)]
+    good = (df['wave_quality'] > good_wave_quality).fillna(False).to_numpy(dtype=bool)
+
+    summary = pd.DataFrame({'n_sessions': df.groupby(group_col, observed=True).size(),
+                            'n_good': df[good].groupby(group_col, observed=True).size()})
+    for label, subset in [('good', df[good]), ('all', df)]:
+        groups = subset[group_col].to_numpy()
+        for col in BUOY_COLS:
+            if col in DIRECTION_COLS:
+                summary[f'{col}_{label}'] = circular_mean(subset[col].to_numpy(dtype=np.float64), groups)
+            else:
+                summary[f'{col}_{label}'] = subset.groupby(group_col, observed=True)[col].median()
+
+    summary['n_good'] = summary['n_good'].fillna(0).astype(int)
+    return summary.sort_values('n_good', ascending=False).reset_index()
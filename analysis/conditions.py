@@ -0,0 +1,343 @@
+import os
+import itertools
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from src.trace import traced
+from src.utils import session_keys
+
+# File the conditions index is kept in between runs (it is updated with the new sessions only)
+CONDITIONS_INDEX_FILE = os.path.join('output', 'conditions_index.npz')
+
+# Grid of the conditions index; every condition is binned on its edges (below the first edge, between each
+# pair of edges, above the last edge), plus a last bin for sessions without the condition (e.g. no buoy data)
+#   wvht: significant wave height [m], dpd: dominant period [s], wspd: wind speed [m/s], tide_m: tide height [m]
+#   mwd: wave direction, in the 8 compass sectors of DIRECTION_LABELS
+CONDITION_BINS = {'wvht': [0.5, 1, 1.5, 2, 3, 4],
+                  'dpd': [8, 10, 12, 14, 16],
+                  'mwd': None,
+                  'wspd': [3, 6, 10],
+                  'tide_m': [0, 0.5, 1, 1.5]}
+DIRECTION_LABELS = ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW']
+# Sums kept per cell: the number of sessions, of sessions with a wave quality, and the sums of wave quality and session value
+INDEX_STATS = {'n_sessions': np.int32, 'n_rated': np.int32, 'wave_quality': np.float64, 'session_value': np.float64}
+
+# Sparse index of the sessions per spot and cell of the conditions grid
+#   cells: sorted int64 array of the cells with sessions (spot * GRID_SIZE + the flat index of the cell in the grid)
+#   sums: dictionary of {stat: array} with the INDEX_STATS of every cell in cells
+#   spots: list of the spots (subregion_spot); a spot keeps its code once it is in the index
+#   sessions: dictionary of arrays with the key (see src.utils.session_keys), cell and stats of every session in the index,
+#       so an update adds the sessions that are new and takes out those that are gone (e.g. edited in the sheet)
+#   source: key of the data the conditions came from (e.g. a fingerprint of the buoy archive); a new source rebuilds the index
+#   prefix_sums: dictionary of {spot code: {stat: prefix sums over the spot's grid}}, built on the first query of
+#       a spot with many cells (see spot_prefix_sums), so a query sums the 32 corners of its box rather than every cell in it
+ConditionsIndex = namedtuple('ConditionsIndex', ['cells', 'sums', 'spots', 'sessions', 'source', 'prefix_sums'])
+
+# Corners of a box of the grid (1 for its upper edge on an axis, 0 for its lower edge), and their sign in the
+# inclusion-exclusion sum of the prefix sums
+BOX_CORNERS = np.array(list(itertools.product([0, 1], repeat=len(CONDITION_BINS))))
+CORNER_SIGNS = (-1) ** (len(CONDITION_BINS) - BOX_CORNERS.sum(axis=1))
+
+
+# Number of bins of a condition (including the bin of the missing values)
+def n_bins(condition):
+    edges = CONDITION_BINS[condition]
+    return len(DIRECTION_LABELS) + 1 if edges is None else len(edges) + 2
+
+
+# Labels of the bins of a condition, e.g. ['<8', '8-10', ..., '16+', 'NA'] for the period
+def bin_labels(condition):
+    edges = CONDITION_BINS[condition]
+    if edges is None:
+        return DIRECTION_LABELS + ['NA']
+    return ([f'<{edges[0]:g}'] + [f'{low:g}-{high:g}' for low, high in zip(edges[:-1], edges[1:])] +
+            [f'{edges[-1]:g}+', 'NA'])
+
+
+# Function to bin the values of a condition (missing values go to the last bin)
+def bin_condition(values, condition):
+    values = np.asarray(values, dtype=np.float64)
+    edges = CONDITION_BINS[condition]
+    if edges is None:
+        # compass sectors centred on N, NE, ... (N is 337.5 to 22.5 degrees)
+        bins = (np.floor(((np.nan_to_num(values) + 22.5) % 360) / 45)).astype(np.intp)
+    else:
+        bins = np.digitize(values, edges)
+    bins[np.isnan(values)] = n_bins(condition) - 1
+    return bins
+
+
+# Shape and number of cells of the grid of a spot
+GRID_SHAPE = tuple(n_bins(condition) for condition in CONDITION_BINS)
+GRID_SIZE = int(np.prod(GRID_SHAPE))
+# Spots with at least this many cells are queried through their prefix sums (see box_sums)
+PREFIX_MIN_CELLS = 256
+# Columns a session's key is made from: everything its cell and stats come from
+SESSION_KEY_COLS = ['subregion_spot', 'wave_quality', 'session_value'] + list(CONDITION_BINS)
+
+
+# Prefix sums over the grid axes, with a row of zeros in front: prefix[i1, ..., i5] is the sum of the cells below (i1, ..., i5)
+def prefix_from_cells(cells):
+    prefix = np.zeros(tuple(n + 1 for n in cells.shape), dtype=cells.dtype)
+    prefix[(slice(1, None),) * len(CONDITION_BINS)] = cells
+    for axis in range(len(CONDITION_BINS)):
+        np.cumsum(prefix, axis=axis, out=prefix)
+    return prefix
+
+
+def empty_conditions_index(source=None):
+    return ConditionsIndex(np.empty(0, dtype=np.int64),
+                           {stat: np.empty(0, dtype=dtype) for stat, dtype in INDEX_STATS.items()},
+                           [],
+                           {'key': np.empty(0, dtype=np.uint64), 'cell': np.empty(0, dtype=np.int64),
+                            **{stat: np.empty(0, dtype=dtype) for stat, dtype in INDEX_STATS.items()}},
+                           source,
+                           {})
+
+
+# Function to add the stats of some cells (negative to take sessions out) to the sparse cells of the index:
+# the cells that are already there are added to in place, the others are inserted, and the cells left empty dropped
+def add_to_cells(cells, sums, delta_cells, delta_stats):
+    touched, inverse = np.unique(delta_cells, return_inverse=True)
+    position = np.searchsorted(cells, touched)
+    exists = position < len(cells)
+    exists[exists] = cells[position[exists]] == touched[exists]
+
+    new_sums = {}
+    for stat, dtype in INDEX_STATS.items():
+        delta = np.bincount(inverse, weights=delta_stats[stat], minlength=len(touched)).astype(dtype)
+        values = sums[stat].copy()
+        values[position[exists]] += delta[exists]
+        new_sums[stat] = np.insert(values, position[~exists], delta[~exists])
+    cells = np.insert(cells, position[~exists], touched[~exists])
+
+    keep = new_sums['n_sessions'] != 0
+    return cells[keep], {stat: values[keep] for stat, values in new_sums.items()}
+
+
+@traced('process')
+def update_conditions_index(index, session_conditions, source=None):
+    """
+    Bring the index up to date with the sessions: the sessions are told apart by a key made from their content
+    (see src.utils.session_keys), the sessions that are new to the index are added to their cells and those that are
+    no longer in the log (or were edited) are taken out; only the cells they are in are touched.
+    Spots that are new to the index are appended to its spots.
+    Arguments:
+        index: ConditionsIndex (None, or one built from another source, is rebuilt from all the sessions)
+        session_conditions: sessions with their conditions (see analysis.buoys.join_buoy_conditions);
+            conditions that are not columns of it (e.g. the tide, without tide data) are binned as missing
+        source: key of the data the conditions came from
+    Returns:
+        the updated ConditionsIndex
+    """
+    if index is None or index.source != source:
+        index = empty_conditions_index(source)
+
+    sessions = session_conditions[session_conditions['subregion_spot'].notna().to_numpy()]
+    keys = session_keys(sessions, SESSION_KEY_COLS)
+    is_new = ~np.isin(keys, index.sessions['key'])
+    is_gone = ~np.isin(index.sessions['key'], keys)
+    if not is_new.any() and not is_gone.any():
+        return index
+    new_sessions = sessions[is_new]
+
+    # spots (new spots are appended)
+    spots = list(index.spots)
+    spot_codes = {spot: code for code, spot in enumerate(spots)}
+    for spot in pd.unique(new_sessions['subregion_spot'].astype(object)):
+        if spot not in spot_codes:
+            spot_codes[spot] = len(spots)
+            spots.append(spot)
+
+    bins = tuple(bin_condition(new_sessions[condition] if condition in new_sessions else np.full(len(new_sessions), np.nan), condition)
+                 for condition in CONDITION_BINS)
+    new_cells = (new_sessions['subregion_spot'].astype(object).map(spot_codes).to_numpy(dtype=np.int64) * GRID_SIZE +
+                 np.ravel_multi_index(bins, GRID_SHAPE))
+    wave_quality = new_sessions['wave_quality'].astype('float64')
+    new_stats = {'n_sessions': np.ones(len(new_sessions), dtype=np.int32),
+                 'n_rated': wave_quality.notna().to_numpy(dtype=np.int32),
+                 'wave_quality': wave_quality.fillna(0).to_numpy(dtype=np.float64),
+                 'session_value': new_sessions['session_value'].fillna(0).to_numpy(dtype=np.float64)}
+
+    # the new sessions are added to their cells, the sessions that are gone taken out of theirs
+    cells, sums = add_to_cells(index.cells, index.sums,
+                               np.concatenate([new_cells, index.sessions['cell'][is_gone]]),
+                               {stat: np.concatenate([new_stats[stat], -index.sessions[stat][is_gone]]) for stat in INDEX_STATS})
+    kept = ~is_gone
+    index_sessions = {'key': np.concatenate([index.sessions['key'][kept], keys[is_new]]),
+                      'cell': np.concatenate([index.sessions['cell'][kept], new_cells]),
+                      **{stat: np.concatenate([index.sessions[stat][kept], new_stats[stat]]) for stat in INDEX_STATS}}
+
+    # the prefix sums of the spots that changed are built again on their next query
+    touched_spots = set(np.concatenate([new_cells, index.sessions['cell'][is_gone]]) // GRID_SIZE)
+    prefix_sums = {code: prefix for code, prefix in index.prefix_sums.items() if code not in touched_spots}
+    return ConditionsIndex(cells, sums, spots, index_sessions, source, prefix_sums)
+
+
+# Function to save the conditions index (its cells and the sessions in them)
+def save_conditions_index(index, file_path=CONDITIONS_INDEX_FILE):
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    np.savez_compressed(file_path,
+                        grid=np.array(GRID_SHAPE),
+                        cells=index.cells,
+                        spots=np.array(index.spots, dtype=str),
+                        source=np.array('' if index.source is None else index.source),
+                        **{stat: values for stat, values in index.sums.items()},
+                        **{f'session_{name}': values for name, values in index.sessions.items()})
+
+
+# Function to load the conditions index, None if there is none yet or it was built on another grid
+def load_conditions_index(file_path=CONDITIONS_INDEX_FILE):
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as data:
+        if 'grid' not in data or tuple(data['grid']) != GRID_SHAPE:
+            return None
+        return ConditionsIndex(data['cells'],
+                               {stat: data[stat] for stat in INDEX_STATS},
+                               data['spots'].tolist(),
+                               {name: data[f'session_{name}'] for name in ['key', 'cell'] + list(INDEX_STATS)},
+                               str(data['source']) or None,
+                               {})
+
+
+# Function to get the prefix sums of a spot over its grid (see prefix_from_cells), built from its cells on the
+# first query of the spot and kept in the index
+def spot_prefix_sums(index, spot_code):
+    if spot_code not in index.prefix_sums:
+        first, last = np.searchsorted(index.cells, [spot_code * GRID_SIZE, (spot_code + 1) * GRID_SIZE])
+        cells = index.cells[first:last] - spot_code * GRID_SIZE
+        index.prefix_sums[spot_code] = {
+            stat: prefix_from_cells(np.bincount(cells, weights=index.sums[stat][first:last], minlength=GRID_SIZE)
+                                    .astype(dtype).reshape(GRID_SHAPE))
+            for stat, dtype in INDEX_STATS.items()}
+    return index.prefix_sums[spot_code]
+
+
+# Function to select the bins of a condition: a (low, high) range of values (high of None for no upper limit),
+# which has to line up with the edges, or for the direction a compass sector or a list of them
+def select_bins(condition, selection):
+    edges = CONDITION_BINS[condition]
+    if edges is None:
+        sectors = [selection] if isinstance(selection, str) else list(selection)
+        return np.isin(bin_labels(condition), sectors)
+    low, high = selection
+    if any(limit is not None and limit not in edges for limit in (low, high)):
+        raise ValueError(f'The range of {condition} has to be on the edges of its bins ({", ".join(f"{edge:g}" for edge in edges)})')
+    lows = np.array([-np.inf] + list(edges) + [np.nan])
+    highs = np.array(list(edges) + [np.inf, np.nan])
+    return (lows >= (-np.inf if low is None else low)) & (highs <= (np.inf if high is None else high))
+
+
+# Function to parse a selection given as text (see select_bins), e.g. 'dpd=14:' -> ('dpd', (14, None)), 'mwd=W,SW'
+def parse_selection(text):
+    condition, _, selection = text.partition('=')
+    if condition not in CONDITION_BINS:
+        raise ValueError(f'Unknown condition "{condition}", use one of {", ".join(CONDITION_BINS)}')
+    if CONDITION_BINS[condition] is None:
+        return condition, selection.split(',')
+    low, _, high = selection.partition(':')
+    return condition, (float(low) if low else None, float(high) if high else None)
+
+
+# Function to turn the selections into boxes of the grid: a (low, high) pair of bins per condition, one box per
+# combination of the runs of consecutive selected bins (e.g. N,NE,E is a single run, N,S two; the directions don't
+# wrap around, so NW,N,NE is two runs too: N,NE and NW)
+def selection_boxes(selections, by=None):
+    runs = []
+    for condition in CONDITION_BINS:
+        keep = select_bins(condition, selections[condition]) if condition in selections else np.ones(n_bins(condition), dtype=bool)
+        if condition == by:
+            # a box per bin of the condition the results are by
+            runs.append([(bin_, bin_ + 1) for bin_ in np.flatnonzero(keep)])
+        else:
+            edges = np.flatnonzero(np.diff(np.concatenate([[0], keep.astype(np.int8), [0]])))
+            runs.append(list(zip(edges[::2], edges[1::2])))
+    return list(itertools.product(*runs))
+
+
+# Function to sum the stats of every spot over boxes of the grid
+#   returns {stat: array (spot, box)}
+# A spot with many cells sums the corners of the boxes in its prefix sums; the cells of the other spots are few
+# enough that they are checked against the boxes directly (so there are no dense grids of the rarely surfed spots)
+def box_sums(index, spot_rows, boxes):
+    boxes = np.array(boxes, dtype=np.intp).reshape(-1, len(CONDITION_BINS), 2)
+    spot_rows = np.asarray(spot_rows, dtype=np.int64)
+    sums = {stat: np.zeros((len(spot_rows), len(boxes)), dtype=dtype) for stat, dtype in INDEX_STATS.items()}
+    bounds = np.searchsorted(index.cells, np.stack([spot_rows * GRID_SIZE, (spot_rows + 1) * GRID_SIZE]))
+    use_prefix = bounds[1] - bounds[0] >= PREFIX_MIN_CELLS
+
+    # corner index per (box, corner, condition): the upper edge of the box where the corner is 1, else the lower edge
+    corners = np.where(BOX_CORNERS[None] == 1, boxes[:, None, :, 1], boxes[:, None, :, 0])
+    gather = tuple(corners[:, :, axis] for axis in range(len(CONDITION_BINS)))
+    for row in np.flatnonzero(use_prefix):
+        for stat, prefix in spot_prefix_sums(index, spot_rows[row]).items():
+            sums[stat][row] = prefix[gather] @ CORNER_SIGNS
+
+    # the cells of the other spots, and the boxes each of them is in
+    rows = np.flatnonzero(~use_prefix)
+    lengths = bounds[1, rows] - bounds[0, rows]
+    positions = np.repeat(bounds[0, rows] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    cell_bins = np.stack(np.unravel_index(index.cells[positions] % GRID_SIZE, GRID_SHAPE), axis=1)
+    in_box = ((cell_bins[:, None, :] >= boxes[None, :, :, 0]) & (cell_bins[:, None, :] < boxes[None, :, :, 1])).all(axis=2)
+    cell_positions, box_columns = np.nonzero(in_box)
+    cell_rows = np.repeat(rows, lengths)[cell_positions]
+    for stat, values in index.sums.items():
+        np.add.at(sums[stat], (cell_rows, box_columns), values[positions[cell_positions]])
+    return sums
+
+
+def query_conditions(index, spots=None, **selections):
+    """
+    Number of sessions, mean wave quality and mean session value per spot, in a range of conditions
+    (e.g. dpd=(14, None), mwd='W' for a 14s+ west swell), from the cells of the index rather than the sessions.
+    Arguments:
+        index: ConditionsIndex
+        spots: spots to report (None for all)
+        selections: condition -> bins to keep (see select_bins); the other conditions are not filtered on
+    Returns:
+        DataFrame with a row per spot: n_sessions, mean_wave_quality and mean_session_value
+    """
+    spot_rows = np.arange(len(index.spots)) if spots is None else np.array([index.spots.index(spot) for spot in spots], dtype=np.intp)
+    sums = {stat: values.sum(axis=1) for stat, values in box_sums(index, spot_rows, selection_boxes(selections)).items()}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return pd.DataFrame({'subregion_spot': [index.spots[row] for row in spot_rows],
+                             'n_sessions': sums['n_sessions'],
+                             'mean_wave_quality': sums['wave_quality'] / sums['n_rated'],
+                             'mean_session_value': sums['session_value'] / sums['n_sessions']})
+
+
+# Function to find the spots with at least min_sessions sessions in a range of conditions
+# e.g. the spots where a 14s+ W swell produced 8+ sessions: spots_where(index, min_sessions=8, dpd=(14, None), mwd='W')
+def spots_where(index, min_sessions=1, **selections):
+    result = query_conditions(index, **selections)
+    return (result[result['n_sessions'] >= min_sessions]
+            .sort_values(['n_sessions', 'mean_wave_quality'], ascending=False, ignore_index=True))
+
+
+def best_bins(index, spot, condition, min_sessions=1, **selections):
+    """
+    Rank the bins of a condition at a spot by their mean wave quality, e.g. the best swell direction window at a spot.
+    Arguments:
+        index: ConditionsIndex
+        spot: spot (subregion_spot)
+        condition: condition to rank the bins of (e.g. 'mwd')
+        min_sessions: leave out the bins with fewer sessions
+        selections: only count the sessions in these bins of the other conditions (see select_bins)
+    Returns:
+        DataFrame with a row per bin: the bin label, n_sessions, mean_wave_quality and mean_session_value
+    """
+    boxes = selection_boxes(selections, by=condition)
+    sums = box_sums(index, np.array([index.spots.index(spot)]), boxes)
+    # add up the boxes of each bin (there is more than one when the other selections are not a single run)
+    bins = np.array([box[list(CONDITION_BINS).index(condition)][0] for box in boxes], dtype=np.intp)
+    sums = {stat: np.bincount(bins, weights=values[0], minlength=n_bins(condition)) for stat, values in sums.items()}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = pd.DataFrame({condition: bin_labels(condition),
+                               'n_sessions': sums['n_sessions'].astype(np.int64),
+                               'mean_wave_quality': sums['wave_quality'] / sums['n_rated'],
+                               'mean_session_value': sums['session_value'] / sums['n_sessions']})
+    return (result[result['n_sessions'] >= min_sessions]
+            .sort_values(['mean_wave_quality', 'n_sessions'], ascending=False, ignore_index=True))
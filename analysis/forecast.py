@@ -0,0 +1,195 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from src.trace import traced
+from analysis.buoys import map_session_buoys
+from analysis.conditions import CONDITION_BINS, n_bins, bin_condition, selection_boxes, box_sums
+
+# Default file the ranked forecast is written to
+FORECAST_OUTPUT_FILE = os.path.join('output', 'forecast.json')
+# Sessions a bin of a condition (or a spot) needs before its own mean counts as much as the prior it is shrunk towards
+PRIOR_SESSIONS = 5
+# Local hours that are ranked (first light to dark, roughly)
+DAYLIGHT_HOURS = (6, 20)
+# Stats the model predicts: the mean of the stat per session, from the sums of the conditions index
+#   stat: (sum in the index, count in the index)
+MODEL_STATS = {'wave_quality': ('wave_quality', 'n_rated'),
+               'session_value': ('session_value', 'n_sessions')}
+
+# Per spot model of a stat given the conditions: the spot's mean plus, per condition, the effect of the bin it is in
+# (the mean of the bin shrunk towards the spot's mean, minus the spot's mean)
+#   spots: list of the spots (subregion_spot)
+#   stations: buoy of every spot (None if it has none)
+#   timezones: timezone of every spot (None if it has no buoy)
+#   baseline: dictionary of {stat: array (spot,)} with the mean of every spot
+#   effects: dictionary of {stat: array (spot, condition, bin)}; 0 for the missing value bins and the padding
+ForecastModel = namedtuple('ForecastModel', ['spots', 'stations', 'timezones', 'baseline', 'effects'])
+
+# Scores of every spot at every forecast hour
+#   times: DatetimeIndex (UTC) of the forecast hours
+#   scores: dictionary of {stat: array (spot, hour)}, NaN where the spot's buoy has no forecast
+#   grid: dictionary of {condition: array (spot, hour)} with the forecast conditions at the spot's buoy
+ForecastScores = namedtuple('ForecastScores', ['times', 'scores', 'grid'])
+
+
+@traced('process')
+def build_forecast_model(index, session_conditions, buoy_map, prior_sessions=PRIOR_SESSIONS):
+    """
+    Fit the per spot model (see ForecastModel) from the conditions index: one box sum per condition gives the
+    sessions and sums of every spot in every bin. Bins with few sessions are shrunk towards the spot's mean,
+    and spots with few sessions towards the mean of all the spots, so a spot surfed twice doesn't top every forecast.
+    Arguments:
+        index: ConditionsIndex (see analysis.conditions)
+        session_conditions: sessions with their conditions (for the subregion and spot of every spot in the index)
+        buoy_map: spot -> buoy map (see analysis.buoys.load_spot_buoy_map)
+        prior_sessions: weight of the prior, in sessions
+    """
+    rows = np.arange(len(index.spots))
+    max_bins = max(n_bins(condition) for condition in CONDITION_BINS)
+
+    # buoy and timezone of every spot
+    spots = (session_conditions[['subregion_spot', 'subregion', 'spot']]
+             .astype(object)
+             .drop_duplicates('subregion_spot')
+             .set_index('subregion_spot')
+             .reindex(index.spots))
+    stations, timezones = map_session_buoys(spots, buoy_map)
+
+    baseline = {}
+    effects = {}
+    totals = {stat: values[:, 0] for stat, values in box_sums(index, rows, selection_boxes({})).items()}
+    for stat, (sum_stat, count_stat) in MODEL_STATS.items():
+        overall = totals[sum_stat].sum() / max(totals[count_stat].sum(), 1)
+        baseline[stat] = (totals[sum_stat] + prior_sessions * overall) / (totals[count_stat] + prior_sessions)
+
+        effects[stat] = np.zeros((len(index.spots), len(CONDITION_BINS), max_bins))
+        for axis, condition in enumerate(CONDITION_BINS):
+            # every bin of the condition (sessions without it are in the last bin, which gets no effect)
+            sums = box_sums(index, rows, selection_boxes({}, by=condition))
+            bin_mean = ((sums[sum_stat] + prior_sessions * baseline[stat][:, None]) /
+                        (sums[count_stat] + prior_sessions))
+            effects[stat][:, axis, :n_bins(condition) - 1] = (bin_mean - baseline[stat][:, None])[:, :-1]
+
+    return ForecastModel(list(index.spots), list(stations), list(timezones), baseline, effects)
+
+
+def read_forecast(file_path):
+    """
+    Read a local forecast file: a .csv or .ndjson/.jsonl file with a row per buoy (station) and hour,
+    a 'time' column (UTC) and the forecast conditions (any of the CONDITION_BINS, e.g. wvht, dpd, mwd, wspd, tide_m).
+    """
+    if os.path.splitext(file_path)[1].lower() in ['.ndjson', '.jsonl']:
+        forecast = pd.read_json(file_path, lines=True, dtype={'station': str}, convert_dates=False)
+    else:
+        forecast = pd.read_csv(file_path, dtype={'station': str})
+    missing = {'station', 'time'} - set(forecast.columns)
+    if missing:
+        raise ValueError(f'The forecast {file_path} is missing the column(s) {", ".join(sorted(missing))}')
+    forecast['time'] = pd.to_datetime(forecast['time'], utc=True).dt.tz_localize(None)
+    return forecast
+
+
+@traced('process')
+def score_forecast(model, forecast):
+    """
+    Score every spot at every forecast hour in one pass: the forecast is laid out as a (buoy, hour) grid per condition,
+    every spot takes the rows of its buoy, and the effects of the bins are gathered and added up.
+    Arguments:
+        model: ForecastModel
+        forecast: DataFrame with station, time and the forecast conditions (see read_forecast)
+    Returns:
+        ForecastScores
+    """
+    station_names, station_codes = np.unique(forecast['station'].to_numpy(dtype=str), return_inverse=True)
+    times, time_codes = np.unique(forecast['time'].to_numpy(dtype='datetime64[ns]'), return_inverse=True)
+    grid_shape = (len(station_names), len(times))
+
+    # (buoy, hour) grids, NaN where a buoy has no forecast for an hour
+    has_forecast = np.zeros(grid_shape, dtype=bool)
+    has_forecast[station_codes, time_codes] = True
+    station_grid = {}
+    for condition in CONDITION_BINS:
+        values = np.full(grid_shape, np.nan)
+        if condition in forecast:
+            values[station_codes, time_codes] = forecast[condition].to_numpy(dtype=np.float64)
+        station_grid[condition] = values
+
+    # the buoy row of every spot (spots whose buoy is not in the forecast take an empty row at the end)
+    station_rows = {station: row for row, station in enumerate(station_names)}
+    spot_rows = np.array([station_rows.get(station, len(station_names)) for station in model.stations], dtype=np.intp)
+    has_forecast = np.vstack([has_forecast, np.zeros((1, len(times)), dtype=bool)])[spot_rows]
+    grid = {condition: np.vstack([values, np.full((1, len(times)), np.nan)])[spot_rows]
+            for condition, values in station_grid.items()}
+
+    spot_index = np.arange(len(model.spots))[:, None]
+    scores = {}
+    for stat, effects in model.effects.items():
+        score = np.repeat(model.baseline[stat][:, None], len(times), axis=1)
+        for axis, condition in enumerate(CONDITION_BINS):
+            score += effects[spot_index, axis, bin_condition(grid[condition], condition)]
+        scores[stat] = np.where(has_forecast, score, np.nan)
+
+    return ForecastScores(pd.DatetimeIndex(times), scores, grid)
+
+
+@traced('summarise')
+def rank_forecast(model, forecast_scores, top_n=25, daylight=DAYLIGHT_HOURS):
+    """
+    Rank the best hour of every spot and (local) day of the forecast by its expected wave quality.
+    Arguments:
+        model: ForecastModel
+        forecast_scores: ForecastScores
+        top_n: number of (spot, day) rows to return, None for all
+        daylight: (first, last) local hour that is ranked
+    Returns:
+        DataFrame with a row per (spot, day): rank, subregion_spot, station, local_time, time (UTC),
+        expected_wave_quality, expected_session_value and the forecast conditions of the hour
+    """
+    times = forecast_scores.times
+    quality = forecast_scores.scores['wave_quality']
+
+    # local hour and day of every forecast hour, per timezone of the spots
+    timezones = pd.Series(model.timezones, dtype=object)
+    timezone_codes, timezone_names = pd.factorize(timezones)
+    local_times = np.array([times.tz_localize('UTC').tz_convert(timezone).tz_localize(None) for timezone in timezone_names]
+                           ).reshape(len(timezone_names), len(times)).astype('datetime64[ns]')
+    local_hours = (local_times - local_times.astype('datetime64[D]')).astype('timedelta64[h]').astype(np.int64)
+
+    spots, hours = np.nonzero(~np.isnan(quality) & (timezone_codes >= 0)[:, None])
+    spot_timezones = timezone_codes[spots]
+    in_daylight = (local_hours[spot_timezones, hours] >= daylight[0]) & (local_hours[spot_timezones, hours] <= daylight[1])
+    spots, hours, spot_timezones = spots[in_daylight], hours[in_daylight], spot_timezones[in_daylight]
+    days = local_times[spot_timezones, hours].astype('datetime64[D]')
+
+    # best hour per (spot, day): sort by spot, day and descending score, keep the first of each (spot, day)
+    order = np.lexsort((-quality[spots, hours], days, spots))
+    spots, hours, days, spot_timezones = spots[order], hours[order], days[order], spot_timezones[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (spots[1:] != spots[:-1]) | (days[1:] != days[:-1])
+    spots, hours, spot_timezones = spots[first], hours[first], spot_timezones[first]
+
+    ranked = pd.DataFrame({'subregion_spot': np.array(model.spots, dtype=object)[spots],
+                           'station': np.array(model.stations, dtype=object)[spots],
+                           'local_time': local_times[spot_timezones, hours],
+                           'time': times[hours],
+                           'expected_wave_quality': quality[spots, hours],
+                           'expected_session_value': forecast_scores.scores['session_value'][spots, hours]})
+    for condition, values in forecast_scores.grid.items():
+        if not np.isnan(values).all():
+            ranked[condition] = values[spots, hours]
+    ranked = ranked.sort_values('expected_wave_quality', ascending=False, kind='stable', ignore_index=True)
+    if top_n is not None:
+        ranked = ranked.head(top_n)
+    ranked.insert(0, 'rank', np.arange(1, len(ranked) + 1))
+    return ranked
+
+
+@traced('export')
+def write_forecast_json(ranked, file_path=FORECAST_OUTPUT_FILE):
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    ranked.to_json(file_path, orient='records', date_format='iso', date_unit='s', indent=2)
+    print(f"Saved the ranked forecast ({len(ranked)} spot-days) in {file_path}")
+    return file_path
@@ -1,53 +1,95 @@
+from collections import namedtuple
+
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.patches import Patch
 from matplotlib.dates import DateFormatter
-import seaborn as sns
 
 from src.plot_setup import bg_color, region_color_dict, time_of_day_color_dict, main_palette
 from src.utils import save_plt_dated
-
+from src.trace import traced
+
+# Dense (month x region) array of a value summed per calendar month, which any time-series plot can reuse
+#   values: 2D float array, one row per month and one column per region
+#   months: DatetimeIndex with the first day of every month, from January of the first year to December of the last
+#   regions: list of the regions (in order of their first session)
+MonthRegionCube = namedtuple('MonthRegionCube', ['values', 'months', 'regions'])
+
+
+def build_month_region_cube(surf_data_df, value_col='hrs', region_col='region'):
+    """
+    Sum a value (e.g. hours) per calendar month and region, in a single pass (np.add.at over the region codes).
+    Months without sessions are kept as zeros, so every region has a complete (month) time-series.
+    Arguments:
+        surf_data_df: processed session DataFrame
+        value_col: column to sum
+        region_col: (categorical) column with the regions
+    """
+    regions = surf_data_df[region_col].astype('category')
+    years = surf_data_df['year'].to_numpy(dtype=np.int64)
+    first_year = years.min()
+    month_idx = (years - first_year) * 12 + surf_data_df['month'].to_numpy(dtype=np.int64) - 1
+    n_months = (years.max() - first_year + 1) * 12
+
+    region_codes = regions.cat.codes.to_numpy()
+    session_values = surf_data_df[value_col].to_numpy(dtype=np.float64, na_value=np.nan)
+    # sessions without a region are left out, and missing values count as 0 (as with groupby().sum())
+    has_region = region_codes >= 0
+    is_summed = has_region & ~np.isnan(session_values)
+    values = np.zeros((n_months, len(regions.cat.categories)))
+    np.add.at(values, (month_idx[is_summed], region_codes[is_summed]), session_values[is_summed])
+
+    # keep the regions that were surfed, ordered by their first month (ties in category order)
+    first_month = np.full(len(regions.cat.categories), n_months)
+    np.minimum.at(first_month, region_codes[has_region], month_idx[has_region])
+    order = [code for code in np.lexsort((np.arange(len(first_month)), first_month)) if first_month[code] < n_months]
+
+    months = pd.date_range(f'{first_year}-01-01', periods=n_months, freq='MS')
+    return MonthRegionCube(values[:, order], months, [regions.cat.categories[code] for code in order])
+
+
+# Per region time-series of the cube (a DataFrame view, months as index and regions as columns)
+def cube_region_series(cube):
+    return pd.DataFrame(cube.values, index=cube.months, columns=cube.regions)
+
+
+# Total of all regions, per month
+def cube_monthly_totals(cube):
+    return cube.values.sum(axis=1)
+
+
+# Lower and upper edge of every region in a stacked plot (both months x regions)
+#   baseline 'zero': stacked from zero
+#   baseline 'symmetric': centered around zero (streamgraph)
+def cube_stack_baselines(cube, baseline='zero'):
+    upper = np.cumsum(cube.values, axis=1)
+    if baseline == 'symmetric':
+        upper = upper - cube_monthly_totals(cube)[:, None] / 2
+    return upper - cube.values, upper
+
+
+@traced('process')
 def process_region_hours(surf_data_df):
 
-    # Group by year, month, and region, then sum the hours
-    region_hours = (surf_data_df
-                    .groupby(['year', 'month', 'region'])['hrs']
-                    .sum()
-                    .reset_index()
-                    .sort_values(['year', 'month']))
-
-    # for the code to work, we need a df with every combination of year, month, and region
-    # that way, for every year/month, we know the hours in each region
-    # Step 1.  Create a list of all combinations (years, month, and regions)
-    all_combinations = []
-    for year in region_hours['year'].unique():
-        for month in region_hours['month'].unique():
-            for region in region_hours['region'].unique():
-                all_combinations.append([year, month, region])
-    combinations_df = pd.DataFrame(all_combinations, columns=['year', 'month', 'region'])
-
-    # sort by year and month
-    combinations_df = combinations_df.sort_values(['year', 'month'])
-
-    # Merge region_hours and combinations_df
-    region_hours_full = pd.merge(combinations_df, region_hours, on=['year', 'month', 'region'], how='left')
-    
-    assert len(region_hours_full) == len(combinations_df), "Join of region hours to df with all combinations did not work correctly"
-    
-    # Fill NaN values in 'hrs' column with 0
-    region_hours_full['hrs'] = region_hours_full['hrs'].fillna(0)
+    # Sum the hours per month and region; every month/region combination is in the cube (hours of 0 if not surfed)
+    cube = build_month_region_cube(surf_data_df)
+    n_months, n_regions = cube.values.shape
+
+    # long version of the cube; one row per month and region (regions in the order of the cube)
+    region_hours_full = pd.DataFrame({'year': np.repeat(cube.months.year, n_regions),
+                                      'month': np.repeat(cube.months.month, n_regions),
+                                      'region': np.tile(np.array(cube.regions, dtype=object), n_months),
+                                      'hrs': cube.values.ravel()})
 
     # get a version of the month that is in string form
-    region_hours_full['month_str'] = region_hours_full['month'].apply(lambda x: f'{int(x):02d}')
+    region_hours_full['month_str'] = region_hours_full['month'].map('{:02d}'.format)
 
     # Add in the 'year-month' value - for x-axis unit
-    region_hours_full['year_month'] = (region_hours_full['year'].astype(str) + '-' + region_hours_full['month_str'])
+    region_hours_full['year_month'] = region_hours_full['year'].astype(str) + '-' + region_hours_full['month_str']
 
     # Also add in date column
-    def create_date_column(df, year_col, month_col, new_col):
-        df[new_col] = pd.to_datetime(df[year_col].astype(str) + '-' + df[month_col].astype(str) + '-01')
-        return df
-    region_hours_full = create_date_column(region_hours_full, 'year', 'month_str', 'date')
+    region_hours_full['date'] = np.repeat(cube.months, n_regions)
 
     # map the colors to the df
     region_hours_full['color'] = region_hours_full['region'].map(region_color_dict)
@@ -57,14 +99,18 @@ def process_region_hours(surf_data_df):
 
     return region_hours_full
 
+@traced('plot')
 def plot_regions_across_time(plot_df,
-                             plot_folder=None):
+                             plot_folder=None,
+                             filename='region_hours_across_time.png'):
     
 
-    # find the total amount of hours per year/month and divide by 2 (we are going to use this value for both side of the line)
-    symm_adjust = (plot_df.groupby('year_month')['hrs'].sum().values / 2)
-    #get a list of the regions
+    #get a list of the regions (stacking order)
     region_list = plot_df['region'].unique().tolist()
+    # wide version of the data (months x regions), and the edges of each region centered around zero
+    wide_df = plot_df.pivot(index='date', columns='region', values='hrs')[region_list]
+    cube = MonthRegionCube(wide_df.to_numpy(dtype=np.float64), wide_df.index, region_list)
+    lower, upper = cube_stack_baselines(cube, baseline='symmetric')
 
     # Plot Setup
     fig, ax = plt.subplots(1, figsize=(16,4), facecolor=bg_color)
@@ -78,14 +124,12 @@ def plot_regions_across_time(plot_df,
     plt.tight_layout(rect=[0, 0, 1, 0.9])  # Give more space at top
 
     # Do the plotting
-    stack = 0
-    for region in region_list:
-        temp = plot_df[plot_df['region'] == region]
-        stack = stack + temp['hrs'].values
-        plt.fill_between(x = temp.date,
-                        y1 = stack - temp['hrs'].values - symm_adjust,
-                        y2 = stack - symm_adjust,
-                        color = temp.color,
+    # (a color per month, like the color column, which keeps the edges between the regions solid)
+    for i, region in enumerate(cube.regions):
+        plt.fill_between(x = cube.months,
+                        y1 = lower[:, i],
+                        y2 = upper[:, i],
+                        color = [region_color_dict.get(region)] * len(cube.months),
                         linewidth=0)
 
     # Legend
@@ -113,10 +157,10 @@ def plot_regions_across_time(plot_df,
     ax.xaxis.grid(color='lightgrey', linestyle='dashed', alpha=.5, lw=0.5)
 
     if plot_folder:
-        filename = 'region_hours_across_time.png'
         save_plt_dated(plot_folder, filename)
         print(f"Plot saved as {filename} in {plot_folder}")
 
+@traced('process')
 def process_time_of_day(surf_data_df):
     time_of_day_df = surf_data_df.copy().dropna(subset=['when'])
     afternoon_index = time_of_day_df.index[time_of_day_df['when'] == 'afternoon'].tolist()
@@ -129,8 +173,13 @@ def process_time_of_day(surf_data_df):
 
     return(time_of_day_df)
 
+@traced('plot')
 def plot_time_of_day(time_of_day_df,
-                            plot_folder=None):
+                            plot_folder=None,
+                            filename='time_of_day_by_region.png'):
+    # seaborn is only needed for this plot (and is slow to import)
+    import seaborn as sns
+
     fig, ax = plt.subplots(1, figsize=(10,4), facecolor=bg_color)
     ax.set_facecolor(bg_color)
 
@@ -189,6 +238,5 @@ def plot_time_of_day(time_of_day_df,
     plt.tight_layout()
 
     if plot_folder:
-        filename = 'time_of_day_by_region.png'
         save_plt_dated(plot_folder, filename)
         print(f"Plot saved as {filename} in {plot_folder}")
@@ -1,3 +1,142 @@
+import numpy as np
+import pandas as pd
+
+from src.trace import traced
+
+# Columns in the simple summary that are a count of distinct values, or the most frequent value, of a session column
+DISTINCT_COLS = {'total_unique_spots': 'spot',
+                 'total_unique_subregions': 'subregion',
+                 'total_unique_regions': 'region'}
+MODE_COLS = {'most_freq_spot': 'spot',
+             'most_freq_subregion': 'subregion',
+             'most_freq_region': 'region',
+             'most_freq_board': 'board',
+             'most_freq_wetsuit': 'wetty'}
+# Order of the columns in the simple summary (after the group columns)
+SUMMARY_COLS = (['total_hours', 'total_sessions'] + list(DISTINCT_COLS) +
+                ['total_barrels_made'] + list(MODE_COLS))
+
+
+def build_summary_cube(df, grain=['year', 'month', 'season']):
+    """
+    Aggregate the sessions once at the finest grain needed; every simple summary is then derived from this cube.
+    Arguments:
+        df: DataFrame to summarise
+        grain: finest list of columns that the summaries will be grouped by
+    Returns:
+        dictionary with
+          'grain': the grain (with a '_dummy_' column, for the summary over all the data)
+          'totals': sums and counts per cell of the grain
+          'freqs': per session column, a frequency table of (cell, value) -> count and first row it shows up in
+    """
+    # a constant column, so the summary over all the data is just another grouping
+    grain = ['_dummy_'] + list(grain)
+    keys = {'_dummy_': np.zeros(len(df), dtype=np.int8)}
+    keys.update({col: df[col] for col in grain[1:]})
+    base = pd.DataFrame(keys, index=df.index)
+
+    totals = (base
+              .assign(hrs=df['hrs'], year_count=df['year'].notna(), barrels_made=df['barrels_made'])
+              .groupby(grain, observed=True)
+              .agg(total_hours=('hrs', 'sum'),
+                   total_sessions=('year_count', 'sum'),
+                   total_barrels_made=('barrels_made', 'sum')))
+
+    # one frequency table per column serves both the distinct counts and the most frequent values
+    row = np.arange(len(df))
+    freqs = {}
+    for col in dict.fromkeys(list(DISTINCT_COLS.values()) + list(MODE_COLS.values())):
+        freqs[col] = (base
+                      .assign(value=df[col], row=row)
+                      .groupby(grain + ['value'], observed=True)
+                      .agg(count=('row', 'size'),
+                           first_row=('row', 'min'))
+                      .reset_index())
+
+    return {'grain': grain, 'totals': totals, 'freqs': freqs}
+
+
+# Row of the most frequent value in a group's counts (in the order the values show up), picked as value_counts does:
+# value_counts sorts the counts with an unstable sort, so a tie doesn't always go to the value that shows up first
+def value_counts_mode(counts):
+    return counts.astype(np.int64).sort_values(ascending=False).index[0]
+
+
+def summarise_cube(cube, group_cols=None):
+    """
+    Roll the summary cube up to a coarser grouping.
+    Sums and counts are added up, distinct counts come from merging the (cell, value) sets,
+    and the most frequent value is the idxmax of the rolled up frequency table
+    (ties are broken as value_counts does, see value_counts_mode).
+    Arguments:
+        cube: output of build_summary_cube
+        group_cols: List of columns to group by (must be part of the cube's grain), None for all the data
+    """
+    group_cols = ['_dummy_'] + list(group_cols or [])
+
+    summary = cube['totals'].groupby(group_cols, observed=True).sum()
+
+    for col, freq in cube['freqs'].items():
+        # roll the frequency table up to the group columns
+        freq = (freq
+                .groupby(group_cols + ['value'], observed=True)
+                .agg(count=('count', 'sum'),
+                     first_row=('first_row', 'min'))
+                .reset_index()
+                .sort_values('first_row', kind='stable'))
+        grouped_freq = freq.groupby(group_cols, observed=True)
+
+        # every (group, value) pair left after rolling up is one distinct value
+        for summary_col in [summary_col for summary_col, distinct_col in DISTINCT_COLS.items() if distinct_col == col]:
+            summary[summary_col] = grouped_freq.size().reindex(summary.index, fill_value=0)
+
+        # idxmax takes the first maximum; the groups with a tie are sorted again as value_counts would
+        for summary_col in [summary_col for summary_col, mode_col in MODE_COLS.items() if mode_col == col]:
+            mode_rows = grouped_freq['count'].idxmax()
+            is_max = freq['count'] == grouped_freq['count'].transform('max')
+            is_tied = is_max.groupby(grouped_freq.ngroup()).transform('sum') > 1
+            if is_tied.any():
+                mode_rows.update(freq[is_tied].groupby(group_cols, observed=True)['count'].apply(value_counts_mode))
+            most_freq = (freq.loc[mode_rows]
+                         .set_index(group_cols)['value']
+                         .astype(object)
+                         .reindex(summary.index))
+            summary[summary_col] = most_freq.where(most_freq.notna(), None)
+
+    summary = summary[SUMMARY_COLS].reset_index().drop(columns='_dummy_')
+    return summary
+
+
+@traced('summarise')
+def create_simple_summaries(df, group_cols_list):
+    """
+    Create several simple summaries of surf data from a single scan of the sessions.
+    Arguments:
+        df: DataFrame to summarise
+        group_cols_list: List of group_cols (see create_simple_summary), e.g. [None, ['year'], ['year', 'month', 'season']]
+    """
+    return summaries_from_cube(build_summary_cube(df, summary_grain(group_cols_list)), group_cols_list)
+
+
+# The cube is built at the finest grain of all the requested summaries
+def summary_grain(group_cols_list):
+    return list(dict.fromkeys(col for group_cols in group_cols_list for col in (group_cols or [])))
+
+
+# Function to roll a summary cube up to each of the requested summaries (see create_simple_summaries)
+def summaries_from_cube(cube, group_cols_list):
+    summaries = []
+    for group_cols in group_cols_list:
+        annual_summary = summarise_cube(cube, group_cols)
+
+        # Add in the 'year-month' column if we are grouping over both year and month
+        if group_cols and 'year' in group_cols and 'month' in group_cols:
+            annual_summary['year_month'] = (annual_summary['year'].astype(str) + '-' +
+                                                annual_summary['month'].apply(lambda x: f'{int(x):02d}'))
+        summaries.append(annual_summary)
+
+    return summaries
+
 
 def create_simple_summary(df, group_cols=None):
     """
@@ -6,91 +145,96 @@ def create_simple_summary(df, group_cols=None):
         df: DataFrame to summarise
         group_cols: List of columns to group by (e.g., ['year'], ['year', 'month'])
     """
-    
-    # make copy
-    df_copy = df.copy()
-
-    # If no grouping columns, create a dummy grouping column
-    # this is because .agg() behaves differently on a dataframe then on a GroupBy object
-    if group_cols is None:
-        df_copy['_dummy_'] = 0
-        group_cols = ['_dummy_']
-    
-    annual_summary = (df_copy
-                     .groupby(group_cols, as_index=False)
-                     .agg(total_hours=('hrs', lambda x: x.sum(skipna=True)),
-                          total_sessions=('year', lambda x: x.count()),
-                          total_unique_spots=('spot', 'nunique'),
-                          total_unique_subregions=('subregion', 'nunique'),
-                          total_unique_regions=('region', 'nunique'),
-                          total_barrels_made=('barrels_made', 'sum'),
-                          most_freq_spot=('spot', lambda x: x.value_counts().index[0] if not x.isna().all() else None),
-                          most_freq_subregion=('subregion', lambda x: x.value_counts().index[0] if not x.isna().all() else None),
-                          most_freq_region=('region', lambda x: x.value_counts().index[0] if not x.isna().all() else None),
-                          most_freq_board=('board', lambda x: x.value_counts().index[0] if not x.isna().all() else None),
-                          most_freq_wetsuit=('wetty', lambda x: x.value_counts().index[0] if not x.isna().all() else None))
-                     .reset_index(drop=True))
-    
-    # Remove dummy column if we added it
-    if '_dummy_' in annual_summary.columns:
-        annual_summary = annual_summary.drop('_dummy_', axis=1)
-    
-    # Add in the 'year-month' column if we are grouping over both year and month
-    if 'year' in group_cols and 'month' in group_cols:
-        annual_summary['year_month'] = (annual_summary['year'].astype(str) + '-' + 
-                                            annual_summary['month'].apply(lambda x: f'{int(x):02d}'))
-
-    return annual_summary
-
-# Function to summarise the data - top n by variable and aggregation type
-# e.g. Top 5 Spots by Time
-def top_n_by_agg_type(df,
-                      grp_cols,
-                      top_n,
-                      agg_type,
-                      agg_col,
-                      by_year = True):
-    """ 
-    Create a summary DataFrame with the top n by aggregation type
-    Arguments:
-        df: DataFrame to summarise
-        grp_cols: List of columns to group by
-        top_n: Number of top entries to return
-        agg_type: Aggregation type (e.g., 'count', 'sum', 'mean')
-        agg_col: Column to aggregate on
-        by_year: Whether to group by year or not
+    return create_simple_summaries(df, [group_cols])[0]
+
+
+# Keys that the sessions are ranked on, and the ranked summaries (key, metric) built from them
+RANKED_KEYS = {'spots': ['subregion', 'spot'],
+               'boards': ['board'],
+               'sessions': ['date', 'subregion', 'spot', 'session_id']}
+RANKED_SUMMARIES = {'top_spots_by_count': ('spots', 'session_count'),
+                    'top_spots_by_time': ('spots', 'total_hours'),
+                    'top_spots_by_barrels': ('spots', 'total_barrel_count'),
+                    'top_boards_by_count': ('boards', 'session_count'),
+                    'top_boards_by_time': ('boards', 'total_hours'),
+                    'top_boards_by_barrels': ('boards', 'total_barrel_count'),
+                    'top_sessions_by_rank': ('sessions', 'session_value')}
+
+
+def build_ranked_cube(surf_data_df):
     """
-    if by_year:
-        # Add year to group columns if not already present
-        if 'year' not in grp_cols:
-            grp_cols = ['year'] + grp_cols
+    Aggregate the sessions once per year and ranking key (spot, board, session), holding every metric together:
+    session count, total hours, total barrels and the sum/count behind the mean session value.
+    """
+    cube = {}
+    for key, key_cols in RANKED_KEYS.items():
+        cube[key] = (surf_data_df
+                     .groupby(['year'] + key_cols, as_index=False, observed=True)
+                     .agg(session_count=('year', 'size'),
+                          total_hours=('hrs', 'sum'),
+                          total_barrel_count=('barrels_made', 'sum'),
+                          session_value_sum=('session_value', 'sum'),
+                          session_value_count=('session_value', 'count')))
+    return cube
 
-    # develop aggregation per group
-    summary_df = (df
-                  .groupby(grp_cols, as_index = False)
-                  .agg(agg = (agg_col, agg_type)))
+
+# Roll the per-year ranked cube up to all years (the per-year tables are already sorted by year and key)
+def rollup_ranked_cube(cube):
+    return {key: (table
+                  .drop(columns='year')
+                  .groupby(RANKED_KEYS[key], as_index=False, observed=True)
+                  .sum())
+            for key, table in cube.items()}
+
+
+# Select the top n rows of an aggregated table by a metric, per year if by_year (ties go to the first row)
+def select_top_n(table, key_cols, metric, top_n, by_year=True):
+    if metric == 'session_value':
+        table = table.assign(session_value=table['session_value_sum'] / table['session_value_count'])
+    table = table[(['year'] if by_year else []) + key_cols + [metric]]
 
     if by_year:
-        # add rank column   
-        summary_df['rank'] = (summary_df
-            .groupby('year')['agg']
-            .rank(method='first', ascending=False))
-        # filter to only top n
-        top_n_per_group = (summary_df[summary_df['rank'] <= top_n]
-                        .sort_values(['year', 'rank'])
-                        .drop(columns=['rank']))
+        # partial sort of each year, rather than ranking every row
+        top_index = (table
+                     .groupby('year')[metric]
+                     .nlargest(top_n)
+                     .index.get_level_values(-1))
     else:
-        # add rank column   
-        summary_df['rank'] = summary_df['agg'].rank(method='first', ascending=False)
-        # filter to only top n
-        top_n_per_group = (summary_df[summary_df['rank'] <= top_n]
-                           .sort_values(['rank'])
-                           .drop(columns=['rank']))
+        top_index = table[metric].nlargest(top_n).index
 
-    return top_n_per_group
+    return table.loc[top_index]
 
-def create_ranked_summary(surf_data_df, top_n=5, by_year=True):
 
+@traced('summarise')
+def create_ranked_summaries(surf_data_df, top_n=5):
+    """
+    Create the ranked summaries for all the years together and per year, from a single aggregation per ranking key.
+    The all-years rankings are derived from the per-year aggregates, so ranking only scales with the number of keys.
+    Arguments:
+        surf_data_df: DataFrame to summarise
+        top_n: Number of top entries to return
+    Returns:
+        (ranked summary over all years, ranked summary by year), see create_ranked_summary
+    """
+    cube_by_year = build_ranked_cube(surf_data_df)
+    return ranked_summaries_from_cubes(rollup_ranked_cube(cube_by_year), cube_by_year, top_n=top_n)
+
+
+# Function to select the ranked summaries from the ranked cube of all years and by year (see create_ranked_summaries)
+def ranked_summaries_from_cubes(cube_all, cube_by_year, top_n=5):
+    ranked_summaries = []
+    for cube, by_year in [(cube_all, False), (cube_by_year, True)]:
+        ranked_summary_dict = {}
+        for name, (key, metric) in RANKED_SUMMARIES.items():
+            ranked_summary_dict[name] = select_top_n(cube[key], RANKED_KEYS[key], metric, top_n, by_year=by_year)
+        # remove zeros (I did not record barrels before 2021)
+        ranked_summary_dict['top_spots_by_barrels'] = ranked_summary_dict['top_spots_by_barrels'].query('total_barrel_count > 0')
+        ranked_summaries.append(ranked_summary_dict)
+
+    return tuple(ranked_summaries)
+
+
+def create_ranked_summary(surf_data_df, top_n=5, by_year=True):
     """
     Create a dictionary of ranked spots, boards, and sessions by different parameters.
     Arguments:
@@ -99,68 +243,5 @@ def create_ranked_summary(surf_data_df, top_n=5, by_year=True):
         by_year: Whether to group by year or not
 
     """
-    
-    # Create a dictionary to hold the ranked summaries
-    ranked_summary_dict = {}
-
-    # Top Spots by Count
-    ranked_summary_dict['top_spots_by_count'] = top_n_by_agg_type(
-        surf_data_df,
-        grp_cols=['subregion', 'spot'],
-        top_n=top_n,
-        agg_type='count',
-        agg_col='spot',
-        by_year=by_year).rename(columns = {'agg': 'session_count'})
-    # Top Spots by Time
-    ranked_summary_dict['top_spots_by_time'] = top_n_by_agg_type(
-        surf_data_df,
-        grp_cols=['subregion', 'spot'],
-        top_n=top_n,
-        agg_type='sum',
-        agg_col='hrs',
-        by_year=by_year).rename(columns = {'agg': 'total_hours'})
-    # Top Spots by Barrels Made
-    ranked_summary_dict['top_spots_by_barrels'] = top_n_by_agg_type(
-        surf_data_df,
-        grp_cols=['subregion', 'spot'],
-        top_n=top_n,
-        agg_type='sum',
-        agg_col='barrels_made',
-        by_year=by_year).rename(columns = {'agg': 'total_barrel_count'})
-    # remove zeros (I did not record barrels before 2021)
-    ranked_summary_dict['top_spots_by_barrels'] = ranked_summary_dict['top_spots_by_barrels'].query('total_barrel_count > 0')
-
-    # Top Boards by Count
-    ranked_summary_dict['top_boards_by_count'] = top_n_by_agg_type(
-        surf_data_df,
-        grp_cols=['board'],
-        top_n=top_n,
-        agg_type='count',
-        agg_col='board',
-        by_year=by_year).rename(columns = {'agg': 'session_count'})
-    # Top Boards by Time
-    ranked_summary_dict['top_boards_by_time'] = top_n_by_agg_type(
-        surf_data_df,
-        grp_cols=['board'],
-        top_n=top_n,
-        agg_type='sum',
-        agg_col='hrs',
-        by_year=by_year).rename(columns = {'agg': 'total_hours'})
-    # Top Boards by Barrels Made
-    ranked_summary_dict['top_boards_by_barrels'] = top_n_by_agg_type(
-        surf_data_df,
-        grp_cols=['board'],
-        top_n=top_n,
-        agg_type='sum',
-        agg_col='barrels_made',
-        by_year=by_year).rename(columns = {'agg': 'total_barrel_count'})
-    # Top 5 Sessions by session_value
-    ranked_summary_dict['top_sessions_by_rank'] = top_n_by_agg_type(
-        surf_data_df,
-        grp_cols=['date', 'subregion', 'spot', 'session_id'],
-        top_n=top_n,
-        agg_type='mean',
-        agg_col='session_value',
-        by_year=by_year).rename(columns = {'agg': 'session_value'})
-
-    return ranked_summary_dict
\ No newline at end of file
+    ranked_summary, ranked_summary_by_year = create_ranked_summaries(surf_data_df, top_n=top_n)
+    return ranked_summary_by_year if by_year else ranked_summary
@@ -5,14 +5,16 @@ import numpy as np
 
 from src.plot_setup import bg_color, region_color_dict, board_state_color_dict
 from src.utils import to_snake_case, save_plt_dated
+from src.trace import traced
 
+@traced('process')
 def process_surfboard_hrs(surf_data_df, surf_data_dict):
     # filter to surfboards that exist in the board column of surf_data_dict['Surfboards']
     surfboard_analysis = surf_data_df[surf_data_df['board'].isin(surf_data_dict['Surfboards']['board'])]
     # now summarise so that for each board and region, we know the total hours
-    surf_data_board_hrs_region = surfboard_analysis.groupby(['board', 'region'])['hrs'].sum().reset_index().sort_values('hrs', ascending=False)
+    surf_data_board_hrs_region = surfboard_analysis.groupby(['board', 'region'], observed=True)['hrs'].sum().reset_index().sort_values('hrs', ascending=False)
     # convert from data long to data wide
-    surf_data_board_hrs_region_wide = surf_data_board_hrs_region.pivot_table(index='board', columns='region', values='hrs', fill_value=0).reset_index()
+    surf_data_board_hrs_region_wide = surf_data_board_hrs_region.pivot_table(index='board', columns='region', values='hrs', fill_value=0, observed=True).reset_index()
     # Calculate total hours per board and sort
     surf_data_board_hrs_region_wide['total_hrs'] = surf_data_board_hrs_region_wide.drop(columns=['board']).sum(axis=1)
     surf_data_board_hrs_region_wide = surf_data_board_hrs_region_wide.sort_values(by='total_hrs', ascending=True)
@@ -21,8 +23,10 @@ def process_surfboard_hrs(surf_data_df, surf_data_dict):
 
 
 
+@traced('plot')
 def plot_surfboard_hrs(surfboard_hrs_df,
-                       plot_folder=None):
+                       plot_folder=None,
+                       filename='surfboard_hours_by_region.png'):
     """ Plot the amount of hours spent on each surfboard by region."""
 
     # Create the figure and axis
@@ -75,17 +79,17 @@ def plot_surfboard_hrs(surfboard_hrs_df,
     # Show the plot
     # plt.show()
     if plot_folder:
-        filename = 'surfboard_hours_by_region.png'
         save_plt_dated(plot_folder, filename)
         print(f"Plot saved as {filename} in {plot_folder}")
 
 
 
+@traced('process')
 def process_surfboard_lifetime(surf_data_df, surf_data_dict):
     # Step 1: Find the min and max date for each board
     #         also remove boards that were only surfed once (i.e. start to end date are the same)
     board_timeline_df_all = (surf_data_df
-                    .groupby(['board'])
+                    .groupby(['board'], observed=True)
                     .agg(min_date = ('date', 'min'),
                         max_date = ('date', 'max'))
                     .sort_values('min_date', ascending=False)
@@ -111,8 +115,10 @@ def process_surfboard_lifetime(surf_data_df, surf_data_dict):
 
     return board_timeline_df
 
+@traced('plot')
 def plot_surfboard_lifetime(board_timeline_df, 
-                            plot_folder=None):
+                            plot_folder=None,
+                            filename='surfboard_timeline_df.png'):
     """ Plot a gantt chart with the first and last time using each surfboard."""
     # From two sources:
     # https://medium.com/towards-data-science/gantt-charts-with-pythons-matplotlib-395b7af72d72
@@ -183,6 +189,5 @@ def plot_surfboard_lifetime(board_timeline_df,
     fig.text(0.5, 0.95, 'Each bar represents the first and last time using each surfboard', transform=fig.transFigure, ha='center', va='top', fontsize=10, fontweight='light', color='w')
 
     if plot_folder:
-        filename = 'surfboard_timeline_df.png'
         save_plt_dated(plot_folder, filename)
         print(f"Plot saved as {filename} in {plot_folder}")
\ No newline at end of file
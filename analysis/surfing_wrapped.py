@@ -1,14 +1,41 @@
 import json
 import os
+import hashlib
 import numpy as np
+import pandas as pd
 
-from src.utils import NpEncoder
+from src.trace import traced
 
-def create_surf_wrapped_json(surf_data_df_all_years, 
+# File (in the JSON output folder) that keeps the input fingerprint of each year's JSON file
+WRAPPED_MANIFEST_FILE = 'wrapped_manifest.json'
+# Bump this when the layout of the JSON changes, so every year is re-written
+WRAPPED_VERSION = 2
+
+
+# Fingerprint the rows of a DataFrame per year, from a single split of the frame
+def fingerprint_by_year(df):
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return {year: hashlib.sha256(row_hashes[rows].tobytes()).hexdigest()
+            for year, rows in df.groupby('year', observed=True).indices.items()}
+
+
+# Convert a DataFrame to a list of records with native python types (NA -> None, dates -> ISO strings) in one go
+def to_native_records(df):
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime('%Y-%m-%dT%H:%M:%S')
+    df = df.astype(object)
+    return df.where(df.notna(), None).to_dict(orient='records')
+
+
+@traced('export')
+def create_surf_wrapped_json(surf_data_df_all_years,
                              surf_data_dict,
-                             summary_by_year, 
+                             summary_by_year,
                              ranked_summary_by_year,
-                             json_output_folder):
+                             json_output_folder,
+                             force=False):
 
     """
     This function creates a JSON file, per year, for the surfing-wrapped animation project.
@@ -17,92 +44,128 @@ def create_surf_wrapped_json(surf_data_df_all_years,
       - total number of sessions
       - total number of hours
       - total number of barrels
-      - total number of unique spots surfed 
+      - total number of unique spots surfed
       - Single day with most hours in the water
       - Top 5 surf spots, by most amount of hours. With this data; spot name, region, total hours, number of sessions
       - Top 5 Surf sessions, by rank (parameter which includes wave quality, surf quality and barrel count). With this data; date, region, spot, wave quality, surf quality, barrel count
 
+    The data for all years is built at once, and a year's file is only (re-)written when the fingerprint of
+    its inputs differs from the one recorded for the last written file (so a daily run only rebuilds the current year).
+
     Arguments:
         surf_data_df_all_years -- DataFrame containing the surf data
         summary_by_year -- DataFrame containing the summary by year
         ranked_summary_by_year -- DataFrame containing the ranked summary by year
         json_output_folder -- Folder where the JSON files will be saved
+        force -- re-write every year, even if its inputs did not change
+
+    Returns:
+        list of the JSON files (of every year, whether they were re-written or not)
     """
 
     years = surf_data_df_all_years['year'].unique()
 
-    top_spots_by_time_by_year = ranked_summary_by_year['top_spots_by_time']
-    top_sessions_by_year = ranked_summary_by_year['top_sessions_by_rank']
-
     # process surfboards data - figure out how many were broken per year
     surfboard_df = surf_data_dict['Surfboards']
-    # filter to cases where the board was broken, using .query
-    surfboard_broken = surfboard_df[surfboard_df['gone'] == 'broken']
-    # convert date, in format YYYYMMDD, to a year column
-    surfboard_broken['year'] = surfboard_broken['when_gone'].astype(str).str[:4].astype(int)
+    # filter to cases where the board was broken, and convert the date, in format YYYYMMDD, to a year
+    surfboard_broken_year = pd.to_numeric(surfboard_df.loc[surfboard_df['gone'] == 'broken', 'when_gone'].astype(str).str[:4],
+                                          errors='coerce')
+    broken_boards_count = surfboard_broken_year.value_counts()
+
+    # For the top 5 spots, add in the total number of sessions (for all years at once)
+    spot_sessions = (surf_data_df_all_years
+                     .groupby(['year', 'subregion', 'spot'], observed=True)
+                     .size()
+                     .rename('total_sessions')
+                     .reset_index())
+    top_spots_by_time = ranked_summary_by_year['top_spots_by_time'].merge(spot_sessions,
+                                                                         on=['year', 'subregion', 'spot'],
+                                                                         how='left')
+
+    # For the top 5 sessions, add in the region, wave quality, surf quality and barrel count
+    session_cols = ['year', 'session_id', 'date', 'spot', 'region', 'wave_quality', 'surfing_quality', 'barrels_made']
+    top_sessions = ranked_summary_by_year['top_sessions_by_rank'].merge(surf_data_df_all_years[session_cols],
+                                                                       on=['year', 'session_id', 'date', 'spot'],
+                                                                       how='left')
+    # pull out month, in character format
+    top_sessions['month'] = top_sessions['date'].dt.month_name()
+    # pull out day as a number and add "/st/nd/th" depending on the day
+    day = top_sessions['date'].dt.day
+    day_suffix = np.select([day.isin([1, 21, 31]), day.isin([2, 22]), day.isin([3, 23])],
+                           ['st', 'nd', 'rd'],
+                           default='th')
+    top_sessions['day'] = day.astype(str) + day_suffix
+    # the session_id is a 3-digit string in the animation project
+    top_sessions['session_id'] = top_sessions['session_id'].map('{:03d}'.format)
+
+    # "biggest_day" add in the single day with most hours in the water (first such day, per year)
+    hours_per_day = (surf_data_df_all_years
+                     .groupby(['year', 'date'], observed=True)['hrs']
+                     .sum()
+                     .rename('total_hours')
+                     .reset_index())
+    biggest_days = hours_per_day.loc[hours_per_day.groupby('year')['total_hours'].idxmax()].set_index('year')
 
+    # convert everything to native python types in bulk, then split per year
+    summary_records = {record['year']: record for record in to_native_records(summary_by_year)}
+    biggest_day_records = dict(zip(biggest_days.index, to_native_records(biggest_days)))
+    top_spots_records = {}
+    for record in to_native_records(top_spots_by_time):
+        top_spots_records.setdefault(record['year'], []).append(record)
+    top_sessions_records = {}
+    for record in to_native_records(top_sessions):
+        top_sessions_records.setdefault(record['year'], []).append(record)
+
+    # fingerprint the inputs of each year
+    inputs = [surf_data_df_all_years, summary_by_year, top_spots_by_time, top_sessions]
+    input_fingerprints = [fingerprint_by_year(df) for df in inputs]
+
+    # create the output folder if it doesn't exist
+    if not os.path.exists(json_output_folder):
+        print(f"Creating output folder: {json_output_folder}")
+        os.makedirs(json_output_folder, exist_ok=True)
+
+    manifest_path = os.path.join(json_output_folder, WRAPPED_MANIFEST_FILE)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    output_file_paths = []
     for year in years:
-        surf_data_df = surf_data_df_all_years[surf_data_df_all_years['year'] == year]
-        summary = summary_by_year[summary_by_year['year'] == year]
-        top_spots_by_time = top_spots_by_time_by_year[top_spots_by_time_by_year['year'] == year]
-        top_sessions = top_sessions_by_year[top_sessions_by_year['year'] == year]
-        broken_boards = surfboard_broken[surfboard_broken['year'] == year]
-
-        # For the top 5 spots, add in the total number of sessions
-        # 1. inner join surf_data_df and top_spots_by_time on spot
-        top_spots_n_sessions = top_spots_by_time.merge(surf_data_df, on=['subregion', 'spot'], how='inner')
-        # 2. group by subregion, spot and count the number of sessions
-        top_spots_n_sessions = (top_spots_n_sessions
-                                .groupby(['subregion', 'spot'], as_index = False)
-                                .agg(total_sessions=('spot', 'count')))
-        # 3. merge the total_sessions into the top_spots_by_time
-        top_spots_by_time = (top_spots_by_time.merge(top_spots_n_sessions, 
-                                                    on=['subregion', 'spot'], 
-                                                    how='left'))
-
-        # For the top 5 sessions, add in the region, wave quality, surf quality and barrel count
-        top_sessions_merge = top_sessions.merge(surf_data_df[['session_id', 'date', 'spot', 'region', 'wave_quality', 'surfing_quality', 'barrels_made']], 
-                                                on=['session_id', 'date', 'spot'], # THIS IS A PROBLEM!!!
-                                                how='left')
-        # pull out month, in character format
-        top_sessions_merge['month'] = top_sessions_merge['date'].dt.month_name()
-        # pull out day as a number and add "/st/nd/th" depending on the day
-        top_sessions_merge['day'] = top_sessions_merge['date'].dt.day
-        top_sessions_merge['day_suffix'] = np.select(
-            [top_sessions_merge['day'].isin([1, 21, 31]),
-              top_sessions_merge['day'].isin([2, 22]),
-              top_sessions_merge['day'].isin([3, 23])],
-            ['st', 'nd', 'rd'],
-            default='th')
-        top_sessions_merge['day'] = top_sessions_merge['day'].astype(str) + top_sessions_merge['day_suffix']
-        top_sessions_merge = top_sessions_merge.drop(columns=['day_suffix'])
-
-        # "biggest_day" add in the single day with most hours in the water
-        hours_per_day = surf_data_df.groupby('date')['hrs'].sum().reset_index()
-        hours_per_day.columns = ['date', 'total_hours']
-        biggest_day = hours_per_day.loc[hours_per_day['total_hours'].idxmax()]
+        year = int(year)
+        n_broken_boards = int(broken_boards_count.get(year, 0))
+        fingerprint = hashlib.sha256(json.dumps([WRAPPED_VERSION, n_broken_boards] +
+                                                [fingerprints.get(year) for fingerprints in input_fingerprints])
+                                     .encode()).hexdigest()
+
+        file_name = f'wrapped_data_{year}.json'
+        output_file_path = os.path.join(json_output_folder, file_name)
+        output_file_paths.append(output_file_path)
+        if not force and manifest.get(str(year)) == fingerprint and os.path.exists(output_file_path):
+            continue
 
+        summary = summary_records[year]
         # Create a dictionary to hold the wrapped data
         wrapped_data = {
             'year': year,
-            'total_sessions': summary['total_sessions'].values[0],
-            'total_hours': summary['total_hours'].values[0],
-            'total_barrels': summary['total_barrels_made'].values[0],
-            'total_unique_spots': summary['total_unique_spots'].values[0],
-            'broken_boards_count': broken_boards.shape[0],
-            'biggest_day': biggest_day.to_dict(),
-            'top_spots': top_spots_by_time.to_dict(orient='records'), 
-            'top_sessions': top_sessions_merge.to_dict(orient='records')
+            'total_sessions': summary['total_sessions'],
+            'total_hours': summary['total_hours'],
+            'total_barrels': summary['total_barrels_made'],
+            'total_unique_spots': summary['total_unique_spots'],
+            'broken_boards_count': n_broken_boards,
+            'biggest_day': biggest_day_records[year],
+            'top_spots': top_spots_records.get(year, []),
+            'top_sessions': top_sessions_records.get(year, [])
         }
 
         # Save the wrapped data as a JSON file
-        file_name = f'wrapped_data_{year}.json'
-        output_file_path = os.path.join(json_output_folder, file_name)
-        # create the output folder if it doesn't exist
-        if not os.path.exists(json_output_folder):
-            print(f"Creating output folder: {json_output_folder}")
-            os.makedirs(json_output_folder, exist_ok=True)
-
         with open(output_file_path, 'w') as f:
-            json.dump(wrapped_data, f, indent=4, cls=NpEncoder)
-            print(f"Created JSON file: {output_file_path}")
\ No newline at end of file
+            json.dump(wrapped_data, f, indent=4)
+            print(f"Created JSON file: {output_file_path}")
+        manifest[str(year)] = fingerprint
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    return output_file_paths
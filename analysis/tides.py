@@ -0,0 +1,249 @@
+import os
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from src.trace import traced
+from src.schema import REGION_MAP_FILE
+
+# folder with the harmonic constituents of the NOAA tide stations, one <station>.csv each (see load_constituents),
+# and the cache of the yearly tide curves
+TIDE_FOLDER = 'input/tides'
+TIDE_CACHE_FOLDER = os.path.join(TIDE_FOLDER, 'cache')
+# Time step of the cached tide curves (the height in between is interpolated)
+TIDE_CURVE_STEP = np.timedelta64(10, 'm')
+TIDE_PHASES = ['rising', 'falling']
+
+# A tidal constituent:
+#   doodson: multiples of the astronomical arguments (tau, s, h, p, N', p1), see astronomical_arguments
+#   offset: phase offset [deg]
+#   nodal: the nodal correction, as powers of the base constituents of NODAL_CORRECTIONS (e.g. M4 = M2 squared);
+#          None for the solar constituents, which have none
+Constituent = namedtuple('Constituent', ['doodson', 'offset', 'nodal'])
+# The 37 constituents of the NOAA harmonic tables (equilibrium arguments after Schureman)
+CONSTITUENTS = {'M2': Constituent((2, 0, 0, 0, 0, 0), 0, {'M2': 1}),
+                'S2': Constituent((2, 2, -2, 0, 0, 0), 0, None),
+                'N2': Constituent((2, -1, 0, 1, 0, 0), 0, {'M2': 1}),
+                'K1': Constituent((1, 1, 0, 0, 0, 0), -90, {'K1': 1}),
+                'M4': Constituent((4, 0, 0, 0, 0, 0), 0, {'M2': 2}),
+                'O1': Constituent((1, -1, 0, 0, 0, 0), 90, {'O1': 1}),
+                'M6': Constituent((6, 0, 0, 0, 0, 0), 0, {'M2': 3}),
+                'MK3': Constituent((3, 1, 0, 0, 0, 0), -90, {'M2': 1, 'K1': 1}),
+                'S4': Constituent((4, 4, -4, 0, 0, 0), 0, None),
+                'MN4': Constituent((4, -1, 0, 1, 0, 0), 0, {'M2': 2}),
+                'NU2': Constituent((2, -1, 2, -1, 0, 0), 0, {'M2': 1}),
+                'S6': Constituent((6, 6, -6, 0, 0, 0), 0, None),
+                'MU2': Constituent((2, -2, 2, 0, 0, 0), 0, {'M2': 1}),
+                '2N2': Constituent((2, -2, 0, 2, 0, 0), 0, {'M2': 1}),
+                'OO1': Constituent((1, 3, 0, 0, 0, 0), -90, {'K1': 1}),
+                'LAM2': Constituent((2, 1, -2, 1, 0, 0), 180, {'M2': 1}),
+                'S1': Constituent((1, 1, -1, 0, 0, 0), 0, None),
+                'M1': Constituent((1, 0, 0, 1, 0, 0), -90, {'O1': 1}),
+                'J1': Constituent((1, 2, 0, -1, 0, 0), -90, {'K1': 1}),
+                'MM': Constituent((0, 1, 0, -1, 0, 0), 0, {'MM': 1}),
+                'SSA': Constituent((0, 0, 2, 0, 0, 0), 0, None),
+                'SA': Constituent((0, 0, 1, 0, 0, 0), 0, None),
+                'MSF': Constituent((0, 2, -2, 0, 0, 0), 0, {'M2': 1}),
+                'MF': Constituent((0, 2, 0, 0, 0, 0), 0, {'MF': 1}),
+                'RHO': Constituent((1, -2, 2, -1, 0, 0), 90, {'O1': 1}),
+                'Q1': Constituent((1, -2, 0, 1, 0, 0), 90, {'O1': 1}),
+                'T2': Constituent((2, 2, -3, 0, 0, 1), 0, None),
+                'R2': Constituent((2, 2, -1, 0, 0, -1), 180, None),
+                '2Q1': Constituent((1, -3, 0, 2, 0, 0), 90, {'O1': 1}),
+                'P1': Constituent((1, 1, -2, 0, 0, 0), 90, None),
+                '2SM2': Constituent((2, 4, -4, 0, 0, 0), 0, {'M2': -1}),
+                'M3': Constituent((3, 0, 0, 0, 0, 0), 0, {'M2': 1.5}),
+                'L2': Constituent((2, 1, 0, -1, 0, 0), 180, {'M2': 1}),
+                '2MK3': Constituent((3, -1, 0, 0, 0, 0), 90, {'M2': 2, 'K1': -1}),
+                'K2': Constituent((2, 2, 0, 0, 0, 0), 0, {'K2': 1}),
+                'M8': Constituent((8, 0, 0, 0, 0, 0), 0, {'M2': 4}),
+                'MS4': Constituent((4, 2, -2, 0, 0, 0), 0, {'M2': 1})}
+# Speed of the astronomical arguments (tau, s, h, p, N', p1) [deg / hour]
+ARGUMENT_SPEEDS = np.array([14.4920521, 0.5490165, 0.0410686, 0.0046418, 0.0022064, 0.0000020])
+# Nodal corrections of the base constituents, as functions of the longitude of the moon's node N [deg]:
+#   (node factor f, correction u [deg] of the phase)
+NODAL_CORRECTIONS = {
+    'M2': lambda N: (1.0004 - 0.0373 * cosd(N) + 0.0002 * cosd(2 * N),
+                     -2.14 * sind(N)),
+    'K1': lambda N: (1.0060 + 0.1150 * cosd(N) - 0.0088 * cosd(2 * N) + 0.0006 * cosd(3 * N),
+                     -8.86 * sind(N) + 0.68 * sind(2 * N) - 0.07 * sind(3 * N)),
+    'O1': lambda N: (1.0089 + 0.1871 * cosd(N) - 0.0147 * cosd(2 * N) + 0.0014 * cosd(3 * N),
+                     10.80 * sind(N) - 1.34 * sind(2 * N) + 0.19 * sind(3 * N)),
+    'K2': lambda N: (1.0241 + 0.2863 * cosd(N) + 0.0083 * cosd(2 * N) - 0.0015 * cosd(3 * N),
+                     -17.74 * sind(N) + 0.68 * sind(2 * N) - 0.04 * sind(3 * N)),
+    'MF': lambda N: (1.043 + 0.414 * cosd(N),
+                     -23.74 * sind(N) + 2.68 * sind(2 * N) - 0.38 * sind(3 * N)),
+    'MM': lambda N: (1.000 - 0.130 * cosd(N),
+                     0 * N)}
+
+
+def cosd(degrees):
+    return np.cos(np.deg2rad(degrees))
+
+
+def sind(degrees):
+    return np.sin(np.deg2rad(degrees))
+
+
+def astronomical_arguments(times):
+    """
+    Doodson's astronomical arguments at every time, from the mean longitudes of the moon and the sun.
+    Arguments:
+        times: array of datetime64 (UTC)
+    Returns:
+        (array (time, 6) of tau, s, h, p, N' and p1 [deg], array (time,) of the longitude of the moon's node N [deg])
+    """
+    times = np.asarray(times, dtype='datetime64[s]')
+    hours = (times - np.datetime64('2000-01-01T12:00:00', 's')).astype(np.float64) / 3600
+    centuries = hours / (24 * 36525)
+    s = 218.3164591 + 481267.88134236 * centuries   # mean longitude of the moon
+    h = 280.46645 + 36000.76983 * centuries          # mean longitude of the sun
+    p = 83.3532430 + 4069.0137111 * centuries        # longitude of the lunar perigee
+    N = 125.0445550 - 1934.1361849 * centuries       # longitude of the moon's ascending node
+    p1 = 282.93735 + 1.71946 * centuries             # longitude of the solar perigee
+    # mean lunar time: the hour angle of the mean sun (0 at noon UT) moved to the mean moon
+    ut_hours = (times - times.astype('datetime64[D]')).astype(np.float64) / 3600
+    tau = 180 + 15 * ut_hours + h - s
+    return np.stack([tau, s, h, p, -N, p1], axis=1), N
+
+
+def load_constituents(station, tide_folder=TIDE_FOLDER):
+    """
+    Read the harmonic constituents of a NOAA tide station, from <tide_folder>/<station>.csv with the columns
+    name, amplitude [m] and phase [deg, Greenwich] (as in the station's harmonic constituents table on tidesandcurrents.noaa.gov).
+    An optional row named Z0 holds the mean sea level above the datum (e.g. MLLW) the heights are given against.
+    Constituents that are not in CONSTITUENTS are left out (with a message).
+    Returns:
+        DataFrame indexed by the constituent name, with the columns amplitude and phase (and the Z0 row, 0 if there was none)
+    """
+    file_path = os.path.join(tide_folder, f'{station}.csv')
+    constituents = pd.read_csv(file_path, dtype={'name': str}).set_index('name')[['amplitude', 'phase']]
+    constituents.index = constituents.index.str.upper()
+    unknown = set(constituents.index) - set(CONSTITUENTS) - {'Z0'}
+    if unknown:
+        print(f'Tide station {station}: leaving out the unknown constituent(s) {", ".join(sorted(unknown))}')
+        constituents = constituents.drop(index=list(unknown))
+    if 'Z0' not in constituents.index:
+        constituents.loc['Z0'] = [0.0, 0.0]
+    return constituents
+
+
+def predict_tide(constituents, times):
+    """
+    Harmonic synthesis of the tide at every time at once: h = Z0 + sum of f * A * cos(V + u - G) over the constituents,
+    with V from the Doodson numbers of the constituents (a single matrix product) and the nodal corrections f and u.
+    Arguments:
+        constituents: DataFrame from load_constituents
+        times: array of datetime64 (UTC)
+    Returns:
+        (heights [m], rates [m / hour]), arrays of the length of the times
+    """
+    names = [name for name in constituents.index if name in CONSTITUENTS]
+    doodson = np.array([CONSTITUENTS[name].doodson for name in names], dtype=np.float64)
+    offsets = np.array([CONSTITUENTS[name].offset for name in names], dtype=np.float64)
+    amplitudes = constituents.loc[names, 'amplitude'].to_numpy(dtype=np.float64)
+    phases = constituents.loc[names, 'phase'].to_numpy(dtype=np.float64)
+
+    arguments, node = astronomical_arguments(times)
+    # nodal corrections of every (time, constituent), from those of the base constituents
+    base = {name: correction(node) for name, correction in NODAL_CORRECTIONS.items()}
+    f = np.ones((len(node), len(names)))
+    u = np.zeros((len(node), len(names)))
+    for column, name in enumerate(names):
+        for base_name, power in (CONSTITUENTS[name].nodal or {}).items():
+            f[:, column] *= base[base_name][0] ** abs(power)
+            u[:, column] += power * base[base_name][1]
+
+    angles = np.deg2rad(arguments @ doodson.T + offsets + u - phases)
+    speeds = np.deg2rad(doodson @ ARGUMENT_SPEEDS)
+    heights = constituents.loc['Z0', 'amplitude'] + (f * amplitudes * np.cos(angles)).sum(axis=1)
+    rates = -(f * amplitudes * speeds * np.sin(angles)).sum(axis=1)
+    return heights, rates
+
+
+# Key of a constituents table (part of the file names of its cached curves, so a new table is not read from an old curve)
+def constituents_key(constituents):
+    return hashlib.sha256(constituents.sort_index().to_csv().encode()).hexdigest()[:12]
+
+
+def tide_curve(station, year, constituents, cache_folder=TIDE_CACHE_FOLDER):
+    """
+    The tide of a station over a year, every TIDE_CURVE_STEP from January 1st (UTC) to the first step of the next year.
+    The curve is computed once and cached as .npy, later runs read it back as a memory map.
+    Returns:
+        float32 array of the heights [m]
+    """
+    file_path = os.path.join(cache_folder, f'{station}_{year}_{constituents_key(constituents)}.npy')
+    if os.path.exists(file_path):
+        return np.load(file_path, mmap_mode='r')
+
+    start = np.datetime64(f'{year}-01-01', 'ns')
+    n_steps = int((np.datetime64(f'{year + 1}-01-01', 'ns') - start) // TIDE_CURVE_STEP) + 1
+    curve = predict_tide(constituents, start + np.arange(n_steps) * TIDE_CURVE_STEP)[0].astype(np.float32)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    np.save(file_path + '.tmp.npy', curve)
+    os.replace(file_path + '.tmp.npy', file_path)
+    return curve
+
+
+# Function to look up the tide station of every session, from the tide_station column of the region map
+def map_session_tide_stations(sessions, region_map_file=REGION_MAP_FILE):
+    region_map = pd.read_csv(region_map_file, dtype=str, keep_default_na=False)
+    if 'tide_station' not in region_map.columns:
+        raise ValueError(f'The region map {region_map_file} has no tide_station column')
+    tide_stations = region_map.set_index('subregion')['tide_station'].replace('', np.nan)
+    return tide_stations.reindex(sessions['subregion'].astype(object)).to_numpy()
+
+
+@traced('process')
+def attach_tides(session_conditions, region_map_file=REGION_MAP_FILE, tide_folder=TIDE_FOLDER, cache_folder=TIDE_CACHE_FOLDER):
+    """
+    Attach the tide height and phase at every session, from the cached yearly curve of its subregion's tide station
+    (interpolated to the session time); stations without a constituents table, or sessions without a time, get none.
+    Arguments:
+        session_conditions: sessions with their (UTC) session_time, see analysis.buoys.join_buoy_conditions
+        region_map_file: region map with the tide_station of every subregion
+        tide_folder: folder with the constituents of the tide stations
+        cache_folder: folder of the cached tide curves
+    Returns:
+        the sessions, with the columns tide_m (height above the datum of the station) and tide_phase (rising / falling)
+    """
+    stations = map_session_tide_stations(session_conditions, region_map_file)
+    times = session_conditions['session_time'].to_numpy(dtype='datetime64[ns]')
+    years = times.astype('datetime64[Y]')
+
+    heights = np.full(len(session_conditions), np.nan)
+    phases = np.full(len(session_conditions), -1, dtype=np.int8)
+    has_time = ~np.isnat(times)
+    if not os.path.isdir(tide_folder):
+        print(f'No tide constituents found ("{tide_folder}" does not exist), the sessions get no tide')
+        stations = np.full(len(stations), np.nan, dtype=object)
+    for station in pd.unique(stations[pd.notna(stations)]):
+        if not os.path.exists(os.path.join(tide_folder, f'{station}.csv')):
+            print(f'No harmonic constituents for tide station {station} ({tide_folder}/{station}.csv), its sessions get no tide')
+            continue
+        constituents = load_constituents(station, tide_folder)
+        station_rows = (stations == station) & has_time
+        for year in np.unique(years[station_rows]):
+            rows = np.flatnonzero(station_rows & (years == year))
+            curve = tide_curve(station, int(year.astype(np.int64)) + 1970, constituents, cache_folder)
+            # position on the curve, and linear interpolation between its steps
+            steps = (times[rows] - year.astype('datetime64[ns]')) / TIDE_CURVE_STEP
+            step = np.floor(steps).astype(np.intp)
+            before, after = curve[step], curve[step + 1]
+            heights[rows] = before + (steps - step) * (after - before)
+            phases[rows] = np.where(after >= before, 0, 1)
+
+    return session_conditions.assign(tide_m=heights,
+                                     tide_phase=pd.Categorical.from_codes(phases, categories=TIDE_PHASES))
+
+
+# Fingerprint of the tide data (the constituents tables and the region map), so cached tides are rebuilt when it changes
+def tide_fingerprint(tide_folder=TIDE_FOLDER, region_map_file=REGION_MAP_FILE):
+    file_paths = [region_map_file]
+    if os.path.isdir(tide_folder):
+        file_paths += sorted(os.path.join(tide_folder, file_name) for file_name in os.listdir(tide_folder) if file_name.endswith('.csv'))
+    return {file_path: [os.stat(file_path).st_size, os.stat(file_path).st_mtime_ns] for file_path in file_paths}
@@ -0,0 +1,291 @@
+import os
+from collections import namedtuple
+
+import matplotlib.pyplot as plt
+from matplotlib.patches import Patch
+import pandas as pd
+import numpy as np
+
+from src.plot_setup import bg_color, wetsuit_state_color_dict
+from src.utils import save_plt_dated, session_keys
+from src.trace import traced
+
+# File the wetsuit ledger is kept in (new sessions are appended to it on every run)
+WETSUIT_LEDGER_FILE = os.path.join('output', 'wetsuit_ledger.npz')
+# Wear of an hour in the water, relative to an hour at the reference water temperature:
+# it doubles every WEAR_DOUBLING_TEMP degrees warmer (heat and sun age neoprene), sessions without a temperature count as 1
+WEAR_REFERENCE_TEMP = 15
+WEAR_DOUBLING_TEMP = 10
+# A wetsuit not worn for this long before the last session is retired
+RETIRED_AFTER_DAYS = 180
+# Stats of the ledger, summed per wetsuit
+LEDGER_STATS = ['sessions', 'hours', 'wear']
+# Columns a session's key is made from: everything its row in the ledger comes from
+SESSION_KEY_COLS = ['date', 'wetty', 'hrs', 'wtmp']
+
+# Ledger of the wetsuit sessions, one row per session in the order they were added (by date within every update):
+#   wetsuits: list of the wetsuits
+#   dates: datetime64[D] array with the date of every row
+#   codes: array with the wetsuit (index in wetsuits) of every row
+#   cumulative: dictionary of {stat: float64 array}, the total of the row's wetsuit up to and including the row
+#               (a prefix sum per wetsuit, so the total over any dates is the difference of two rows)
+#   keys: array with the key of the session of every row (see src.utils.session_keys), so only new sessions are added on an update
+#   source: key of the water temperatures the wear came from; a new source rebuilds the ledger
+WetsuitLedger = namedtuple('WetsuitLedger', ['wetsuits', 'dates', 'codes', 'cumulative', 'keys', 'source'])
+
+
+def empty_wetsuit_ledger(source=None):
+    return WetsuitLedger([], np.empty(0, dtype='datetime64[D]'), np.empty(0, dtype=np.int32),
+                         {stat: np.empty(0) for stat in LEDGER_STATS}, np.empty(0, dtype=np.uint64), source)
+
+
+# Function to get the wear of every session: its hours weighted by the water temperature (wtmp, if the sessions have it)
+def session_wear(sessions):
+    hours = sessions['hrs'].to_numpy(dtype=np.float64, na_value=np.nan)
+    if 'wtmp' not in sessions:
+        return hours
+    weight = 2 ** ((sessions['wtmp'].to_numpy(dtype=np.float64) - WEAR_REFERENCE_TEMP) / WEAR_DOUBLING_TEMP)
+    return hours * np.where(np.isnan(weight), 1, weight)
+
+
+# Function to get the latest total of every wetsuit in the ledger (0 for a wetsuit without rows)
+def wetsuit_totals(ledger):
+    totals = {stat: np.zeros(len(ledger.wetsuits)) for stat in LEDGER_STATS}
+    if len(ledger.codes):
+        # the last row of every wetsuit holds its total
+        last_rows = len(ledger.codes) - 1 - np.unique(ledger.codes[::-1], return_index=True)[1]
+        for stat in LEDGER_STATS:
+            totals[stat][ledger.codes[last_rows]] = ledger.cumulative[stat][last_rows]
+    return totals
+
+
+@traced('process')
+def update_wetsuit_ledger(ledger, sessions, source=None):
+    """
+    Append the sessions that are not in the ledger yet (told apart by a key made from their content, see
+    src.utils.session_keys): their prefix sums continue from the totals of their wetsuits, so the history is never
+    recomputed. A new session dated before the last one of its wetsuit (a back-filled session), or a session that is no
+    longer in the log (deleted or edited), can't be appended, and the ledger is rebuilt from all the sessions.
+    Arguments:
+        ledger: WetsuitLedger (None, or one built from another source, is rebuilt from all the sessions)
+        sessions: processed sessions, with the water temperature (wtmp) if there is one (see analysis.buoys.join_buoy_conditions)
+        source: key of the water temperatures
+    Returns:
+        the updated WetsuitLedger
+    """
+    if ledger is None or ledger.source != source:
+        ledger = empty_wetsuit_ledger(source)
+
+    sessions = sessions[sessions['wetty'].notna().to_numpy()]
+    keys = session_keys(sessions, SESSION_KEY_COLS)
+    is_new = ~np.isin(keys, ledger.keys)
+    if not np.isin(ledger.keys, keys).all():
+        return update_wetsuit_ledger(None, sessions, source)
+    if not is_new.any():
+        return ledger
+    order = np.argsort(sessions['date'].to_numpy()[is_new], kind='stable')
+    new_sessions = sessions[is_new].iloc[order]
+    new_keys = keys[is_new][order]
+
+    wetsuits = list(ledger.wetsuits)
+    wetsuit_codes = {wetsuit: code for code, wetsuit in enumerate(wetsuits)}
+    for wetsuit in pd.unique(new_sessions['wetty'].astype(object)):
+        if wetsuit not in wetsuit_codes:
+            wetsuit_codes[wetsuit] = len(wetsuits)
+            wetsuits.append(wetsuit)
+    codes = new_sessions['wetty'].astype(object).map(wetsuit_codes).to_numpy(dtype=np.int32)
+    dates = new_sessions['date'].to_numpy(dtype='datetime64[D]')
+
+    # the ledger only grows forward in time, per wetsuit
+    last_dates = np.full(len(wetsuits), np.datetime64('NaT'), dtype='datetime64[D]')
+    if len(ledger.codes):
+        last_dates[:len(ledger.wetsuits)] = (pd.Series(ledger.dates).groupby(ledger.codes).max()
+                                             .reindex(range(len(ledger.wetsuits))).to_numpy(dtype='datetime64[D]'))
+    if (dates < last_dates[codes]).any():
+        return update_wetsuit_ledger(None, sessions, source)
+
+    totals = wetsuit_totals(ledger)
+    # a session without hours (an NA in the sheet) counts as a session, but adds no hours or wear
+    values = {'sessions': np.ones(len(new_sessions)),
+              'hours': np.nan_to_num(new_sessions['hrs'].to_numpy(dtype=np.float64, na_value=np.nan)),
+              'wear': np.nan_to_num(session_wear(new_sessions))}
+    cumulative = {}
+    for stat in LEDGER_STATS:
+        start = np.concatenate([totals[stat], np.zeros(len(wetsuits) - len(ledger.wetsuits))])
+        new_cumulative = start[codes] + pd.Series(values[stat]).groupby(codes).cumsum().to_numpy()
+        cumulative[stat] = np.concatenate([ledger.cumulative[stat], new_cumulative])
+
+    return WetsuitLedger(wetsuits, np.concatenate([ledger.dates, dates]), np.concatenate([ledger.codes, codes]),
+                         cumulative, np.concatenate([ledger.keys, new_keys]), source)
+
+
+# Function to save the wetsuit ledger
+def save_wetsuit_ledger(ledger, file_path=WETSUIT_LEDGER_FILE):
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    np.savez_compressed(file_path,
+                        wetsuits=np.array(ledger.wetsuits, dtype=str),
+                        dates=ledger.dates,
+                        codes=ledger.codes,
+                        keys=ledger.keys,
+                        source=np.array('' if ledger.source is None else ledger.source),
+                        **ledger.cumulative)
+
+
+# Function to load the wetsuit ledger, None if there is none yet
+# (or if it is from an older version: without keys, or with the NaN totals of sessions without hours)
+def load_wetsuit_ledger(file_path=WETSUIT_LEDGER_FILE):
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as data:
+        if any(name not in data for name in LEDGER_STATS + ['keys']):
+            return None
+        if not all(np.isfinite(data[stat]).all() for stat in LEDGER_STATS):
+            return None
+        return WetsuitLedger(data['wetsuits'].tolist(),
+                             data['dates'],
+                             data['codes'],
+                             {stat: data[stat] for stat in LEDGER_STATS},
+                             data['keys'],
+                             str(data['source']) or None)
+
+
+# Function to get the cumulative sessions, hours and wear of a wetsuit over time (a row per session)
+def wetsuit_wear_series(ledger, wetsuit):
+    rows = ledger.codes == ledger.wetsuits.index(wetsuit)
+    return pd.DataFrame({'date': ledger.dates[rows].astype('datetime64[ns]'),
+                         **{stat: ledger.cumulative[stat][rows] for stat in LEDGER_STATS}})
+
+
+def wetsuit_wear_between(ledger, start=None, end=None):
+    """
+    Sessions, hours and wear of every wetsuit between two dates (inclusive), from the difference of its prefix sums
+    at the two dates (a binary search per wetsuit, not a pass over its sessions).
+    Returns:
+        DataFrame indexed by wetsuit, with the LEDGER_STATS
+    """
+    start = np.datetime64(start or '1900-01-01', 'D')
+    end = np.datetime64(end or '2200-01-01', 'D')
+    wear = pd.DataFrame(0.0, index=pd.Index(ledger.wetsuits, name='wetsuit'), columns=LEDGER_STATS)
+    for code, wetsuit in enumerate(ledger.wetsuits):
+        rows = np.flatnonzero(ledger.codes == code)
+        dates = ledger.dates[rows]
+        first, last = np.searchsorted(dates, start, side='left'), np.searchsorted(dates, end, side='right')
+        for stat in LEDGER_STATS:
+            cumulative = np.concatenate([[0], ledger.cumulative[stat][rows]])
+            wear.loc[wetsuit, stat] = cumulative[last] - cumulative[first]
+    return wear
+
+
+@traced('summarise')
+def process_wetsuit_lifetime(ledger, retired_after_days=RETIRED_AFTER_DAYS):
+    """
+    Lifetime of every wetsuit: first and last use, its totals, and whether it is still in use.
+    Arguments:
+        ledger: WetsuitLedger
+        retired_after_days: a wetsuit not worn for this long before the last session is retired
+    Returns:
+        DataFrame with a row per wetsuit (latest first): wetsuit, min_date, max_date, sessions, hours, wear,
+        hours_per_month, state, and the start_num / end_num / days_start_to_end and color of its bar in the timeline
+    """
+    dates = pd.Series(ledger.dates.astype('datetime64[ns]'))
+    totals = wetsuit_totals(ledger)
+    wetsuit_timeline_df = pd.DataFrame({'wetsuit': ledger.wetsuits,
+                                        'min_date': dates.groupby(ledger.codes).min().reindex(range(len(ledger.wetsuits))).to_numpy(),
+                                        'max_date': dates.groupby(ledger.codes).max().reindex(range(len(ledger.wetsuits))).to_numpy(),
+                                        **totals})
+    wetsuit_timeline_df['sessions'] = wetsuit_timeline_df['sessions'].round().astype(int)
+    days_in_use = (wetsuit_timeline_df.max_date - wetsuit_timeline_df.min_date).dt.days
+    wetsuit_timeline_df['hours_per_month'] = wetsuit_timeline_df.hours / np.maximum(days_in_use / 30.44, 1)
+    last_session = wetsuit_timeline_df.max_date.max()
+    retired = (last_session - wetsuit_timeline_df.max_date).dt.days > retired_after_days
+    wetsuit_timeline_df['state'] = np.where(retired, 'retired', 'in use')
+    wetsuit_timeline_df = wetsuit_timeline_df.sort_values('min_date', ascending=False, ignore_index=True)
+
+    # days from the first use of any wetsuit to the first and last use of each
+    first_date = wetsuit_timeline_df.min_date.min()
+    wetsuit_timeline_df['start_num'] = (wetsuit_timeline_df.min_date - first_date).dt.days
+    wetsuit_timeline_df['end_num'] = (wetsuit_timeline_df.max_date - first_date).dt.days
+    wetsuit_timeline_df['days_start_to_end'] = wetsuit_timeline_df.end_num - wetsuit_timeline_df.start_num
+
+    # map the colors to the df
+    wetsuit_timeline_df['color'] = wetsuit_timeline_df['state'].map(wetsuit_state_color_dict)
+
+    return wetsuit_timeline_df
+
+
+@traced('plot')
+def plot_wetsuit_lifetime(wetsuit_timeline_df,
+                          plot_folder=None,
+                          filename='wetsuit_timeline.png'):
+    """ Plot a gantt chart with the first and last time using each wetsuit, and the hours in it."""
+    # Setup
+    fig, ax = plt.subplots(1, figsize=(16, 8), facecolor=bg_color)
+    ax.set_facecolor(bg_color)
+
+    # Bars
+    ax.barh(y = wetsuit_timeline_df.index,
+            width = wetsuit_timeline_df.days_start_to_end,
+            left = wetsuit_timeline_df.start_num,
+            color = wetsuit_timeline_df.color)
+
+    # Adding the wetsuit as text before each bar, and its hours after it
+    for idx, row in wetsuit_timeline_df.iterrows():
+        ax.text(x = row.start_num - 10,
+                y = idx,
+                s = row.wetsuit,
+                va = 'center',
+                ha = 'right',
+                alpha = 1,
+                color = 'w')
+        ax.text(x = row.end_num + 10,
+                y = idx,
+                s = f'{row.hours:.0f} hrs',
+                va = 'center',
+                ha = 'left',
+                alpha = 0.8,
+                fontsize = 10,
+                color = 'w')
+
+    # Grid lines
+    ax.set_axisbelow(True)
+    ax.xaxis.grid(color = 'k',
+                linestyle = 'dashed',
+                alpha = 0.4,
+                which = 'both')
+
+    # Legend
+    legend_elements = [Patch(facecolor = wetsuit_state_color_dict[i], label = i)  for i in wetsuit_state_color_dict]
+    legend = ax.legend(handles = legend_elements,
+                    loc = 'lower center',
+                    ncol = len(wetsuit_state_color_dict),
+                    bbox_to_anchor=(0.5, 1),
+                    frameon = False)
+    plt.setp(legend.get_texts(), color='w')
+
+    # Ticks: the day index of the start of every year
+    year_per_day_range = pd.date_range(wetsuit_timeline_df.min_date.min(), end=wetsuit_timeline_df.max_date.max()).strftime("%Y")
+    year_per_day_range = np.array(year_per_day_range, dtype=int)
+    years_start_index = np.where(np.diff(year_per_day_range) != 0)[0] + 1
+    years_start_index = np.insert(years_start_index, 0, 0)
+    ax.set_xticks(years_start_index)
+    ax.set_xticklabels(np.unique(year_per_day_range), color='w', fontsize =14)
+    ax.set_yticks([]) # no y-ticks
+    plt.setp([ax.get_xticklines()], color='w')
+    plt.tick_params(axis='x', length=0)
+
+    # align x axis
+    ax.set_xlim(0, wetsuit_timeline_df.end_num.max())
+
+    # remove spines
+    ax.spines['right'].set_visible(False)
+    ax.spines['left'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.spines['bottom'].set_color('w')
+
+    # Title
+    plt.suptitle('Wetsuit Lifetime', color='w', fontweight='bold', fontsize=18)
+    fig.text(0.5, 0.95, 'Each bar represents the first and last time using each wetsuit', transform=fig.transFigure, ha='center', va='top', fontsize=10, fontweight='light', color='w')
+
+    if plot_folder:
+        save_plt_dated(plot_folder, filename)
+        print(f"Plot saved as {filename} in {plot_folder}")
@@ -1,174 +1,725 @@
-# import pandas as pd
-import numpy as np
 import os
+import sys
+import argparse
 
-from src.setup import load_gsheet, concatenate_entries
-from src.process import process_surf_data
-from src.utils import check_n_distinct
+# Heavy libraries (numpy/pandas, the google client, matplotlib, seaborn) are imported inside the functions that
+# need them, so each command only pays for the imports it uses.
 
-def main(check_data=False,
-         save_plots=False,
-         surf_wrapped=True,
-         print_summaries=False,
-         surfboard_analysis=False):
-    """
-    Main function to read, process, summarise, and visualize my surf data.
-    """
+# Path to your JSON file (allows access to google sheet)
+SHEET_ACCESS_KEY = 'keys/surf-data-analysis-b31fc887181f.json'
+# Spreadsheet ID (from the URL of the Google Sheet)
+SHEET_URL = '1DvfcN09E9cHPDe83N89AJtZhk-4DhxkxGLi8UsaR0Mw'
+# Output folders
+PLOT_FOLDER = os.path.join(os.path.dirname(__file__), 'output', 'visuals')
+JSON_OUTPUT_FOLDER = os.path.join(os.path.dirname(__file__), 'output', 'surfing_wrapped')
+# NOAA buoy observations (a <station>.csv per buoy) and the buoy of every spot
+BUOY_FOLDER = os.path.join(os.path.dirname(__file__), 'input', 'buoys')
+SPOT_BUOY_MAP_FILE = os.path.join(os.path.dirname(__file__), 'input', 'spot_buoy_map.csv')
+# Harmonic constituents of the NOAA tide stations (a <station>.csv each) and the cache of their tide curves
+TIDE_FOLDER = os.path.join(os.path.dirname(__file__), 'input', 'tides')
+# Index of the sessions per spot and conditions (updated with the new sessions on every run)
+CONDITIONS_INDEX_FILE = os.path.join(os.path.dirname(__file__), 'output', 'conditions_index.npz')
+# Ranked forecast of the spots
+FORECAST_OUTPUT_FILE = os.path.join(os.path.dirname(__file__), 'output', 'forecast.json')
+# Cumulative wear of every wetsuit (the new sessions are appended on every run)
+WETSUIT_LEDGER_FILE = os.path.join(os.path.dirname(__file__), 'output', 'wetsuit_ledger.npz')
 
-    # SETUP -------------------------------------------------------------------
-  
-    # Path to your JSON file (allows access to google sheet)
-    sheet_access_key = 'keys/surf-data-analysis-b31fc887181f.json'
-    # Spreadsheet ID (from the URL of the Google Sheet)
-    sheet_url = '1DvfcN09E9cHPDe83N89AJtZhk-4DhxkxGLi8UsaR0Mw'
-
-    # Load the Google Sheet data into a dictionary of dfs and then concatenate the surf data
-    surf_data_dict = load_gsheet(sheet_url, sheet_access_key)
-    surf_data_df_raw = concatenate_entries(surf_data_dict)
-
-    # PROCESS ---------------------------------------------------------
-    
-    # process the surf data
-    # i.e. remove columns, clean up headers, create date col, calculate wave height, etc.
-    # New columns added: date, region, subregion_spot session_value
-    surf_data_df = process_surf_data(surf_data_df_raw, rm_incomplete_yrs = False)
-    
-    # CHECK -----------------------------------------------------------
 
-    if check_data:
-        # Toggles
-        check_missing_values      = False
-        check_unique_vals_per_col = False
-        check_spots_and_regions   = False
-
-        # check for missing values across all columns, per year
-        if check_missing_values:
-            missing_values = surf_data_df.groupby('year').apply(lambda x: x.isna().sum())
-            print("\nMissing Values:", missing_values)
-
-        # Check unique values per column
-        if check_unique_vals_per_col:
-            for col in surf_data_df:
-                if not col in ['people', 'notes', 'visuals', 'date', 'day']:
-                    unique_col = surf_data_df[col].unique()
-                    unique_col_str = unique_col.astype(str)
-                    unique_col_sort = np.sort(unique_col_str, axis=0)
-                    print(unique_col_sort)
-
-        # Check surf spots and regions
-        if check_spots_and_regions:
-            print("\nUnique Surf Spots:")
-            check_n_distinct(surf_data_df, 'subregion_spot')
-            print("\nUnique SubRegions:")
-            check_n_distinct(surf_data_df, 'subregion')
+# STAGES ----------------------------------------------------------------------
+# Each stage declares the stages it needs (see src.pipeline), so a command only runs what its outputs depend on,
+# and re-uses the cached results of the stages whose inputs did not change.
 
+# Load the Google Sheet data (via the local snapshot) into a dictionary of dfs
+def load_surf_data_dict():
+    from src.setup import load_gsheet_snapshot
+    return load_gsheet_snapshot(SHEET_URL, SHEET_ACCESS_KEY)
 
-    # ANALYSIS -------------------------------------------------
-    
-    # (1) INITIALIZE THINGS ----
-    # Specify the plot folder, if save_plots is True
-    if save_plots:
-        plot_folder = os.path.join(os.path.dirname(__file__), 'output', 'visuals')
+
+# Fingerprint of the local snapshot (the hash of every tab), the source of every other stage
+def snapshot_fingerprint():
+    from src.snapshot import tab_hashes
+    return tab_hashes()
+
+
+# Fingerprint of the region map (processing the sessions reads it besides the raw entries)
+def region_map_fingerprint():
+    from src.schema import region_map_fingerprint
+    return region_map_fingerprint()
+
+
+# Concatenate the surf data (the year sheets)
+def load_surf_data_raw(surf_data_dict):
+    from src.setup import load_raw_entries
+    return load_raw_entries(surf_data_dict)
+
+
+# Process the surf data
+# i.e. remove columns, clean up headers, create date col, calculate wave height, etc.
+# New columns added: date, region, subregion_spot session_value
+def process_surf_data_raw(surf_data_df_raw):
+    from src.process import process_surf_data
+    return process_surf_data(surf_data_df_raw, rm_incomplete_yrs = False)
+
+
+# Basic, single values for all data, per year and per year+month (all from a single pass over the data)
+def simple_summaries(surf_data_df):
+    from analysis.summarise import create_simple_summaries
+
+    summary_all, summary_by_year, summary_by_year_month = create_simple_summaries(
+        surf_data_df, [None, ['year'], ['year', 'month', 'season']])
+    return {'summary_all': summary_all,
+            'summary_by_year': summary_by_year,
+            'summary_by_year_month': summary_by_year_month}
+
+
+# Ranked Summaries (dictionary objects), for all years and by year (from the same aggregation)
+def ranked_summaries(surf_data_df):
+    from analysis.summarise import create_ranked_summaries
+
+    ranked_summary, ranked_summary_by_year = create_ranked_summaries(surf_data_df)
+    return {'ranked_summary': ranked_summary,
+            'ranked_summary_by_year': ranked_summary_by_year}
+
+
+# view the summaries
+def print_summaries(simple_summaries, ranked_summaries):
+    print("\nSummary:")
+    print(simple_summaries['summary_all'])
+    print("\nRanked Summary:")
+    for key, value in ranked_summaries['ranked_summary'].items():
+        print(f"{key}:\n{value}\n")
+    print("\nRanked Summary by Year:")
+    for key, value in ranked_summaries['ranked_summary_by_year'].items():
+        print(f"{key}:\n{value}\n")
+
+
+def check_surf_data(surf_data_df,
+                    check_missing_values=False,
+                    check_unique_vals_per_col=False,
+                    check_spots_and_regions=False):
+    import numpy as np
+    from src.utils import check_n_distinct
+
+    # check for missing values across all columns, per year
+    if check_missing_values:
+        missing_values = surf_data_df.groupby('year').apply(lambda x: x.isna().sum())
+        print("\nMissing Values:", missing_values)
+
+    # Check unique values per column
+    if check_unique_vals_per_col:
+        for col in surf_data_df:
+            if not col in ['people', 'notes', 'visuals', 'date', 'day']:
+                unique_col = surf_data_df[col].unique()
+                unique_col_str = unique_col.astype(str)
+                unique_col_sort = np.sort(unique_col_str, axis=0)
+                print(unique_col_sort)
+
+    # Check surf spots and regions
+    if check_spots_and_regions:
+        print("\nUnique Surf Spots:")
+        check_n_distinct(surf_data_df, 'subregion_spot')
+        print("\nUnique SubRegions:")
+        check_n_distinct(surf_data_df, 'subregion')
+
+
+# create and save (as JSON) the data needed for the surfing-wrapped animation project
+# TODO: Create an output with all the data (summary_all)
+def write_surf_wrapped(surf_data_df, surf_data_dict, simple_summaries, ranked_summaries,
+                       json_output_folder=JSON_OUTPUT_FOLDER, force=False):
+    from analysis.surfing_wrapped import create_surf_wrapped_json
+
+    return create_surf_wrapped_json(surf_data_df,
+                                    surf_data_dict,
+                                    simple_summaries['summary_by_year'],
+                                    ranked_summaries['ranked_summary_by_year'],
+                                    json_output_folder,
+                                    force=force)
+
+
+# plot the hours per region across time, binned by month
+def region_hours(surf_data_df):
+    from analysis.regions import process_region_hours
+    return process_region_hours(surf_data_df)
+
+
+# plot the time of day surfed, separated by region
+def time_of_day(surf_data_df):
+    from analysis.regions import process_time_of_day
+    return process_time_of_day(surf_data_df)
+
+
+# Process the amount of hours with each surfboard by region
+def surfboard_hrs(surf_data_df, surf_data_dict):
+    from analysis.surfboards import process_surfboard_hrs
+    return process_surfboard_hrs(surf_data_df, surf_data_dict)
+
+
+# process a gantt-timeline with each surfboard
+# new analysis; surfboard length over time
+# TODO: maybe average length per month - weighted by hours used?
+def surfboard_lifetime(surf_data_df, surf_data_dict):
+    from analysis.surfboards import process_surfboard_lifetime
+    return process_surfboard_lifetime(surf_data_df, surf_data_dict)
+
+
+# Append the new sessions to the cumulative hours and wear of every wetsuit (weighted by the water temperature
+# of the sessions, when there are buoy observations; the ledger is rebuilt when they change)
+def wetsuit_ledger(surf_data_df, session_conditions=None, buoy_folder=BUOY_FOLDER, ledger_file=WETSUIT_LEDGER_FILE):
+    import json
+    import hashlib
+    from analysis.wetsuits import load_wetsuit_ledger, update_wetsuit_ledger, save_wetsuit_ledger
+    if session_conditions is None:
+        sessions, source = surf_data_df, None
     else:
-        plot_folder = None
-
-
-    # (2) SUMMARISE DATA ----
-    from analysis.summarise import create_simple_summary, create_ranked_summary
-    
-    # Basic, single values per year and per year+month
-    summary_all = create_simple_summary(surf_data_df)
-    summary_by_year = create_simple_summary(surf_data_df, group_cols=['year'])
-    summary_by_year_month = create_simple_summary(surf_data_df, group_cols=['year', 'month', 'season'])
-
-    # Ranked Summaries (dictionary objects)
-    ranked_summary = create_ranked_summary(surf_data_df, by_year=False)
-    ranked_summary_by_year = create_ranked_summary(surf_data_df)
-    
-    # view the dictionary of ranked summaries
-    if print_summaries:
-        print("\nRanked Summary:")
-        for key, value in ranked_summary.items():
-            print(f"{key}:\n{value}\n")
-        print("\nRanked Summary by Year:")
-        for key, value in ranked_summary_by_year.items():
-            print(f"{key}:\n{value}\n")
+        sessions = session_conditions
+        source = hashlib.sha256(json.dumps(conditions_fingerprint(buoy_folder), sort_keys=True).encode()).hexdigest()
+    ledger = update_wetsuit_ledger(load_wetsuit_ledger(ledger_file), sessions, source=source)
+    save_wetsuit_ledger(ledger, ledger_file)
+    return ledger
+
+
+# process a gantt-timeline with each wetsuit; how long does a wetsuit last?
+def wetsuit_lifetime(wetsuit_ledger):
+    from analysis.wetsuits import process_wetsuit_lifetime
+    return process_wetsuit_lifetime(wetsuit_ledger)
+
+
+# print the lifetime of every wetsuit and render its timeline
+def report_wetsuits(wetsuit_lifetime_df, plot_folder=PLOT_FOLDER, force=False):
+    from src.render import PlotJob, render_plots
+    print("\nWetsuit lifetime (wear: hours weighted by the water temperature):")
+    print(wetsuit_lifetime_df[['wetsuit', 'min_date', 'max_date', 'sessions', 'hours', 'wear', 'hours_per_month', 'state']]
+          .to_string(index=False, float_format='{:.1f}'.format))
+    job = PlotJob('analysis.wetsuits', 'plot_wetsuit_lifetime', wetsuit_lifetime_df, 'wetsuit_timeline.png')
+    render_plots([job], plot_folder, force=force)
+    return [os.path.join(plot_folder, job.filename)]
+
+
+# Attach the NOAA buoy conditions nearest in time to every session, and the predicted tide
+def session_conditions(surf_data_df, buoy_folder=BUOY_FOLDER, buoy_map_file=SPOT_BUOY_MAP_FILE, tide_folder=TIDE_FOLDER):
+    from analysis.buoys import load_spot_buoy_map, load_buoy_observations, join_buoy_conditions
+    from analysis.tides import attach_tides
+    buoy_map = load_spot_buoy_map(buoy_map_file)
+    observations = load_buoy_observations(buoy_folder, stations=buoy_map['station'].unique())
+    return attach_tides(join_buoy_conditions(surf_data_df, observations, buoy_map),
+                        tide_folder=tide_folder, cache_folder=os.path.join(tide_folder, 'cache'))
+
+
+# Fingerprint of the buoy observations, the buoy map and the tide constituents
+# (the data session_conditions reads besides the sessions)
+def conditions_fingerprint(buoy_folder=BUOY_FOLDER, buoy_map_file=SPOT_BUOY_MAP_FILE, tide_folder=TIDE_FOLDER):
+    from analysis.buoys import buoy_fingerprint
+    from analysis.tides import tide_fingerprint
+    return {**buoy_fingerprint(buoy_folder, buoy_map_file), **tide_fingerprint(tide_folder)}
+
+
+# Update the conditions index of every spot with the sessions added since the last run
+# (it is rebuilt when the buoy or tide data changed)
+def conditions_index(session_conditions, buoy_folder=BUOY_FOLDER, index_file=CONDITIONS_INDEX_FILE):
+    import json
+    import hashlib
+    from analysis.conditions import load_conditions_index, update_conditions_index, save_conditions_index
+    source = hashlib.sha256(json.dumps(conditions_fingerprint(buoy_folder), sort_keys=True).encode()).hexdigest()
+    index = update_conditions_index(load_conditions_index(index_file), session_conditions, source=source)
+    save_conditions_index(index, index_file)
+    return index
+
+
+# Fit the per spot model of wave quality and session value given the conditions, to score forecasts with
+def forecast_model(conditions_index, session_conditions, buoy_map_file=SPOT_BUOY_MAP_FILE):
+    from analysis.buoys import load_spot_buoy_map
+    from analysis.forecast import build_forecast_model
+    return build_forecast_model(conditions_index, session_conditions, load_spot_buoy_map(buoy_map_file))
+
 
+# print the conditions of the good sessions, compared to those of all the sessions, per subregion
+def print_spot_conditions(session_conditions, good_wave_quality=9):
+    from analysis.buoys import summarise_good_conditions
+    summary = summarise_good_conditions(session_conditions, good_wave_quality=good_wave_quality)
+    print(f"\nBuoy conditions of the sessions with a wave quality above {good_wave_quality} (_good) and of all sessions (_all):")
+    print(summary.to_string(index=False, float_format='{:.1f}'.format))
+    return summary
+
+
+# Collect the plots (plot function + the frame it is made from) and render them in parallel
+# (plots whose data and style did not change since the last run are skipped)
+def render_surf_plots(simple_summaries, region_hours_df, time_of_day_df, surfboard_hrs_df=None, surfboard_lifetime_df=None,
+                      plot_folder=PLOT_FOLDER, force=False):
+    from src.render import PlotJob, render_plots
 
     # (3) PLOT ALL DATA ----
-    from analysis.annual_plot import plot_annual_stats, plot_seasonal_stats
-    plot_annual_stats(summary_by_year_month, plot_folder)
-    plot_annual_stats(summary_by_year, plot_folder)
-    plot_seasonal_stats(summary_by_year_month, plot_folder)
-
-
-    # (4) SURF DATA WRAPPED ----
-    # create and save (as JSON) the data needed for the surfing-wrapped animation project
-    # TODO: Create an output with all the data (summary_all)
-    if surf_wrapped:
-        from analysis.surfing_wrapped import create_surf_wrapped_json
-        # Create the JSON output folder
-        json_output_folder = os.path.join(os.path.dirname(__file__), 'output', 'surfing_wrapped')
-        create_surf_wrapped_json(surf_data_df,
-                                 surf_data_dict, 
-                                 summary_by_year, 
-                                 ranked_summary_by_year, 
-                                 json_output_folder)
-        # create_surf_wrapped_all_json(surf_data_df,
-            #                          surf_data_dict, 
-            #                          summary_all, 
-            #                          ranked_summary, 
-            #                          json_output_folder)
+    plot_jobs = [PlotJob('analysis.annual_plot', 'plot_annual_stats', simple_summaries['summary_by_year_month'], 'surf_stats_bar_charts_by_month_year.png'),
+                 PlotJob('analysis.annual_plot', 'plot_annual_stats', simple_summaries['summary_by_year'], 'surf_stats_bar_charts_by_year.png'),
+                 PlotJob('analysis.annual_plot', 'plot_seasonal_stats', simple_summaries['summary_by_year_month'], 'surf_stats_bar_charts_by_month_season.png')]
 
     # (5) SURFBOARD ANALYSIS ----
+    if surfboard_hrs_df is not None:
+        plot_jobs.append(PlotJob('analysis.surfboards', 'plot_surfboard_hrs', surfboard_hrs_df, 'surfboard_hours_by_region.png'))
+    if surfboard_lifetime_df is not None:
+        plot_jobs.append(PlotJob('analysis.surfboards', 'plot_surfboard_lifetime', surfboard_lifetime_df, 'surfboard_timeline_df.png'))
+
+    # (6) REGION ANALYSIS ----
+    plot_jobs.append(PlotJob('analysis.regions', 'plot_regions_across_time', region_hours_df, 'region_hours_across_time.png'))
+    plot_jobs.append(PlotJob('analysis.regions', 'plot_time_of_day', time_of_day_df, 'time_of_day_by_region.png'))
+
+    render_plots(plot_jobs, plot_folder, force=force)
+    return [os.path.join(plot_folder, job.filename) for job in plot_jobs]
+
+
+def build_stages(plot_folder=PLOT_FOLDER,
+                 json_output_folder=JSON_OUTPUT_FOLDER,
+                 surfboard_analysis=False,
+                 checks=None,
+                 buoy_folder=BUOY_FOLDER,
+                 good_wave_quality=9):
+    """
+    The stages of the pipeline. The targets (what the commands ask for) are:
+      - summarise: print the summaries
+      - check: check the data
+      - wrapped: the Surfing Wrapped JSON files
+      - plots: the plots
+      - spots: print the buoy conditions of the good sessions
+      - wetsuits: print the lifetime of every wetsuit and plot its timeline
+    Arguments:
+        plot_folder: folder the plots are saved in
+        json_output_folder: folder the Surfing Wrapped JSON files are saved in
+        surfboard_analysis: include the surfboard plots
+        checks: keyword arguments of check_surf_data (which checks to run)
+        buoy_folder: folder with the NOAA buoy observations
+        good_wave_quality: sessions with a wave quality above this are 'good' (spot analysis)
+    """
+    from functools import partial
+    from src.pipeline import Stage
+
+    plot_inputs = ('simple_summaries', 'region_hours', 'time_of_day')
     if surfboard_analysis:
-        from analysis.surfboards import (process_surfboard_hrs, 
-                                         plot_surfboard_hrs,
-                                         process_surfboard_lifetime,
-                                         plot_surfboard_lifetime)
-        # Process and plot the amount of hours with each surfboard by region
-        surfboard_hrs_df = process_surfboard_hrs(surf_data_df, surf_data_dict)
-        plot_surfboard_hrs(surfboard_hrs_df,
-                           plot_folder=plot_folder)
-        # process and plot a gantt-timeline with each surfboard
-        surfboard_min_max_df = process_surfboard_lifetime(surf_data_df, surf_data_dict)
-        plot_surfboard_lifetime(surfboard_min_max_df,
-                                plot_folder=plot_folder)
-        # new analysis; surfboard length over time
-        # TODO: maybe average length per month - weighted by hours used?
+        plot_inputs += ('surfboard_hrs', 'surfboard_lifetime')
+    # the wetsuit wear is weighted by the water temperature only when there are buoy observations
+    wetsuit_inputs = ('surf_data_df', 'session_conditions') if os.path.isdir(buoy_folder) else ('surf_data_df',)
 
+    return [
+        # SETUP + PROCESS ----
+        Stage('surf_data_dict', load_surf_data_dict, fingerprint=snapshot_fingerprint, cache=False),
+        # (the raw entries are already persisted in the snapshot)
+        Stage('surf_data_df_raw', load_surf_data_raw, ('surf_data_dict',), cache=False),
+        Stage('surf_data_df', process_surf_data_raw, ('surf_data_df_raw',), fingerprint=region_map_fingerprint),
+        # (2) SUMMARISE DATA ----
+        Stage('simple_summaries', simple_summaries, ('surf_data_df',)),
+        Stage('ranked_summaries', ranked_summaries, ('surf_data_df',)),
+        # (5) SURFBOARD ANALYSIS ----
+        Stage('surfboard_hrs', surfboard_hrs, ('surf_data_df', 'surf_data_dict')),
+        Stage('surfboard_lifetime', surfboard_lifetime, ('surf_data_df', 'surf_data_dict')),
+        # (6) REGION ANALYSIS ----
+        Stage('region_hours', region_hours, ('surf_data_df',)),
+        Stage('time_of_day', time_of_day, ('surf_data_df',)),
+        # (7) WETSUIT ANALYSIS ----
+        Stage('wetsuit_ledger', wetsuit_ledger, wetsuit_inputs, params={'buoy_folder': buoy_folder}, cache=False),
+        Stage('wetsuit_lifetime', wetsuit_lifetime, ('wetsuit_ledger',)),
+        # (8) SPOT ANALYSIS ----
+        Stage('session_conditions', session_conditions, ('surf_data_df',), params={'buoy_folder': buoy_folder},
+              fingerprint=partial(conditions_fingerprint, buoy_folder)),
+        # TARGETS ----
+        Stage('summarise', print_summaries, ('simple_summaries', 'ranked_summaries'), cache=False),
+        Stage('check', check_surf_data, ('surf_data_df',), params=checks or {}, cache=False),
+        Stage('wrapped', write_surf_wrapped, ('surf_data_df', 'surf_data_dict', 'simple_summaries', 'ranked_summaries'),
+              params={'json_output_folder': json_output_folder}, outputs=True),
+        Stage('plots', render_surf_plots, plot_inputs,
+              params={'plot_folder': plot_folder}, outputs=True),
+        Stage('conditions_index', conditions_index, ('session_conditions',), params={'buoy_folder': buoy_folder}, cache=False),
+        Stage('forecast_model', forecast_model, ('conditions_index', 'session_conditions')),
+        Stage('spots', print_spot_conditions, ('session_conditions',),
+              params={'good_wave_quality': good_wave_quality}, cache=False),
+        Stage('wetsuits', report_wetsuits, ('wetsuit_lifetime',),
+              params={'plot_folder': plot_folder}, cache=False, outputs=True),
+    ]
 
-    # (6) REGION ANALYSIS ----
-    from analysis.regions import (process_region_hours, 
-                                  plot_regions_across_time,
-                                  process_time_of_day,
-                                  plot_time_of_day)
 
-    # plot the hours per region across time, binned by month
-    region_hours_df = process_region_hours(surf_data_df)
-    plot_regions_across_time(region_hours_df,
-                             plot_folder=plot_folder)
-    # plot the time of day surfed, separated by region
-    time_of_day_df = process_time_of_day(surf_data_df)
-    plot_time_of_day(time_of_day_df,
-                     plot_folder=plot_folder)
+def run_pipeline(targets, refresh_data=False, delta_sync=False, force=False, source=None, verify_frozen=False, **stage_options):
+    """
+    Bring the targets up to date (see build_stages), running only the stages they need.
+    The google sheet is only fetched when refresh_data is True (or when there is no local snapshot yet),
+    otherwise the pipeline runs offline against the snapshot in input/snapshot.
+    With delta_sync, only the rows added to the current year since the last sync are fetched
+    (and with verify_frozen, the past year tabs are also fetched, and re-saved if their content hash changed).
+    With a source (see src.sources, e.g. 'csv:input/logbook'), the snapshot is refreshed from it instead of the google sheet.
+    """
+    from src.pipeline import Pipeline
+
+    preloaded = {}
+    if source:
+        from src.sources import load_source_snapshot
+        preloaded['surf_data_dict'] = load_source_snapshot(source)
+    elif refresh_data or delta_sync or verify_frozen:
+        from src.setup import load_gsheet_snapshot
+        preloaded['surf_data_dict'] = load_gsheet_snapshot(SHEET_URL, SHEET_ACCESS_KEY, refresh=True,
+                                                           delta=delta_sync or verify_frozen, verify_frozen=verify_frozen)
+
+    pipeline = Pipeline(build_stages(**stage_options), preloaded=preloaded)
+    results = pipeline.run(targets, force=force)
+    pipeline.report()
+    return results
+
+
+def main(check_data=False,
+         save_plots=False,
+         surf_wrapped=True,
+         print_summaries=False,
+         surfboard_analysis=False,
+         wetsuit_analysis=False,
+         refresh_data=False,
+         delta_sync=False,
+         verify_frozen=False,
+         source=None):
+    """
+    Main function to read, process, summarise, and visualize my surf data (every step, see the commands below to run a single one).
+    """
+
+    # CHECK -----------------------------------------------------------
+    # ANALYSIS -------------------------------------------------
+    # (2) summaries, (3), (5) and (6) plots, (4) surf data wrapped, (7) wetsuit lifetime
+    # (the plots are only rendered when they are saved)
+    targets = ([target for target, wanted in [('check', check_data),
+                                              ('summarise', print_summaries),
+                                              ('plots', save_plots),
+                                              ('wrapped', surf_wrapped),
+                                              ('wetsuits', wetsuit_analysis)] if wanted])
+    run_pipeline(targets,
+                 refresh_data=refresh_data,
+                 delta_sync=delta_sync,
+                 verify_frozen=verify_frozen,
+                 source=source,
+                 surfboard_analysis=surfboard_analysis)
 
 
     # (7) WETSUIT ANALYSIS ----
-    # TODO: ADD
+    # First/last use, hours and (water temperature weighted) wear of every wetsuit, kept as prefix sums that the new
+    # sessions are appended to (see the wetsuits command)
 
 
     # (8) SPOT ANALYSIS ----
-    # Link historic NOAA data to surf-data and determine the conditions that lead to a spot being 'good' (i.e. wave quality of 8 or higher)
-    # TODO: ADD
+    # Link historic NOAA data to surf-data and determine the conditions that lead to a spot being 'good' (i.e. wave quality above 9)
+    # (needs the buoy observations, see the spots command)
 
 
     # (9) GEOSPATIAL ANALYSIS ----
     # TODO: ADD
 
-    #TEMP
-    print("BREAKPOINT")
+
+# COMMANDS --------------------------------------------------------------------
+
+def run_ingest(args):
+    # fetch the google sheet (or only the new rows, with --sync), or read a local source, and update the local snapshot
+    from src.setup import load_gsheet_snapshot, load_raw_entries
+    if args.source:
+        from src.sources import load_source_snapshot
+        load_raw_entries(load_source_snapshot(args.source))
+    else:
+        load_raw_entries(load_gsheet_snapshot(SHEET_URL, SHEET_ACCESS_KEY, refresh=True,
+                                              delta=args.sync or args.verify_frozen, verify_frozen=args.verify_frozen))
+
+
+def run_export(args):
+    # export the concatenated year sheets (raw entries) of the snapshot, e.g. to stream them later
+    from src.setup import load_gsheet_snapshot, load_raw_entries
+    from src.stream import write_export
+    if args.source:
+        from src.sources import load_source_snapshot
+        surf_data_dict = load_source_snapshot(args.source)
+    else:
+        surf_data_dict = load_gsheet_snapshot(SHEET_URL, SHEET_ACCESS_KEY, refresh=args.refresh or args.sync or args.verify_frozen,
+                                              delta=args.sync or args.verify_frozen, verify_frozen=args.verify_frozen)
+    write_export(load_raw_entries(surf_data_dict), args.file)
+
+
+def run_stream(args):
+    # summarise an exported log in chunks, without loading it all in memory
+    from src.stream import stream_summaries
+    (summary_all, _, _), (ranked_summary, ranked_summary_by_year) = stream_summaries(args.file, chunksize=args.chunksize)
+    print_summaries({'summary_all': summary_all},
+                    {'ranked_summary': ranked_summary, 'ranked_summary_by_year': ranked_summary_by_year})
+
+
+def run_summarise(args):
+    run_pipeline(['summarise'], args.refresh, args.sync, source=args.source, verify_frozen=args.verify_frozen)
+
+
+def run_wrapped(args):
+    run_pipeline(['wrapped'], args.refresh, args.sync, force=args.force, source=args.source, verify_frozen=args.verify_frozen,
+                 json_output_folder=args.output or JSON_OUTPUT_FOLDER)
+
+
+def run_plots(args):
+    run_pipeline(['plots'], args.refresh, args.sync, force=args.force, source=args.source, verify_frozen=args.verify_frozen,
+                 plot_folder=args.output or PLOT_FOLDER, surfboard_analysis=args.surfboards)
+
+
+def run_check(args):
+    run_pipeline(['check'], args.refresh, args.sync, source=args.source, verify_frozen=args.verify_frozen,
+                 checks={'check_missing_values': args.missing or args.all,
+                         'check_unique_vals_per_col': args.unique or args.all,
+                         'check_spots_and_regions': args.spots or args.all})
+
+
+def run_wetsuits(args):
+    run_pipeline(['wetsuits'], args.refresh, args.sync, force=args.force, source=args.source, verify_frozen=args.verify_frozen,
+                 plot_folder=args.output or PLOT_FOLDER, buoy_folder=args.buoys or BUOY_FOLDER)
+
+
+def run_spots(args):
+    run_pipeline(['spots'], args.refresh, args.sync, source=args.source, verify_frozen=args.verify_frozen,
+                 buoy_folder=args.buoys or BUOY_FOLDER, good_wave_quality=args.good)
+
+
+def run_conditions(args):
+    # query the conditions index, e.g. the best swell direction at a spot, or the spots that were good in a 14s+ W swell
+    from analysis.conditions import parse_selection, best_bins, spots_where
+    index = run_pipeline(['conditions_index'], args.refresh, args.sync, source=args.source, verify_frozen=args.verify_frozen,
+                         buoy_folder=args.buoys or BUOY_FOLDER)['conditions_index']
+    selections = dict(parse_selection(selection) for selection in args.where)
+    if args.best:
+        print(best_bins(index, args.spot, args.best, min_sessions=args.min_sessions, **selections).to_string(index=False))
+    else:
+        print(spots_where(index, min_sessions=args.min_sessions, **selections).to_string(index=False))
+
+
+def run_forecast(args):
+    # rank the spots for a local forecast file, by the expected wave quality of their best hour of each day
+    from analysis.forecast import read_forecast, score_forecast, rank_forecast, write_forecast_json
+    model = run_pipeline(['forecast_model'], args.refresh, args.sync, source=args.source, verify_frozen=args.verify_frozen,
+                         buoy_folder=args.buoys or BUOY_FOLDER)['forecast_model']
+    ranked = rank_forecast(model, score_forecast(model, read_forecast(args.file)), top_n=args.top)
+    print(ranked.to_string(index=False, float_format='{:.1f}'.format))
+    write_forecast_json(ranked, args.output or FORECAST_OUTPUT_FILE)
+
+
+def run_buoys(args):
+    # parse the raw NDBC files into the buoy archive read by the spot analysis
+    from src.buoy_archive import update_buoy_archive
+    update_buoy_archive(args.raw, args.archive or BUOY_FOLDER, force=args.force)
+
+
+def run_benchmark(args):
+    from src.benchmark import benchmark
+    regressions = benchmark(sizes=args.sizes,
+                            repeat=args.repeat,
+                            stages=args.stages,
+                            output_file=args.output,
+                            baseline_file=args.baseline,
+                            save_baseline=args.save_baseline,
+                            threshold=args.threshold)
+    if regressions:
+        sys.exit(1)
+
+
+def run_batch(args):
+    from src.batch import batch
+    if args.source:
+        sys.exit('batch: --source is set per logbook, in the source column of the manifest')
+    report = batch(args.manifest,
+                   output_folder=args.output,
+                   max_workers=args.workers,
+                   refresh=args.refresh,
+                   delta=args.sync,
+                   verify_frozen=args.verify_frozen,
+                   force=args.force)
+    if report['n_failed']:
+        sys.exit(1)
+
+
+def run_all(args):
+    main(save_plots=True,
+         wetsuit_analysis=True,
+         refresh_data=args.refresh,
+         delta_sync=args.sync,
+         verify_frozen=args.verify_frozen,
+         source=args.source)
+
+
+def profile_imports(argv, top_n=25):
+    """
+    Re-run the command in a child interpreter with `-X importtime` and report the slowest imports.
+    Arguments:
+        argv: command line arguments of the command (without --import-profile)
+        top_n: number of imports to report
+    """
+    import subprocess
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__)] + argv,
+                            stderr=subprocess.PIPE, text=True)
+    # lines look like: "import time:       self [us] |  cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, package = line[len('import time:'):].split('|')
+        imports.append((int(cumulative_us), int(self_us), package.rstrip()))
+
+    # top level imports (no indent) add up to the total import time
+    total_us = sum(cumulative for cumulative, _, package in imports if not package.startswith('  '))
+    print(f"\nImport profile of `{' '.join(argv) or 'all'}`: {len(imports)} modules, {total_us / 1e6:.3f}s in total")
+    print(f"{'cumulative [s]':>15} {'self [s]':>10}  module")
+    for cumulative, self_us, package in sorted(imports, reverse=True)[:top_n]:
+        print(f"{cumulative / 1e6:>15.3f} {self_us / 1e6:>10.3f}  {package.strip()}")
+    return result.returncode
+
+
+# options to update the data, shared by every command (given before or after the command)
+# the copy on the commands has no defaults, so it doesn't overwrite the options given before the command
+def data_option_parser(defaults=True):
+    data_options = argparse.ArgumentParser(add_help=False)
+    default = {} if defaults else {'default': argparse.SUPPRESS}
+    data_options.add_argument('--refresh', action='store_true', **default,
+                              help='fetch the google sheet and update the local snapshot before running')
+    data_options.add_argument('--sync', action='store_true', **default,
+                              help='only fetch the rows added to the current year sheet since the last sync '
+                                   '(the past year sheets are not re-checked, see --verify-frozen)')
+    data_options.add_argument('--verify-frozen', action='store_true', **default,
+                              help='sync, and also re-check the past year sheets by their content hash (picks up edits to past years)')
+    data_options.add_argument('--source', **default,
+                              help='refresh the snapshot from a local source instead of the google sheet: '
+                                   'csv:<folder of per-sheet csv files>, xlsx:<workbook>, parquet:<folder> or snapshot:<folder>')
+    return data_options
+
+
+def build_parser():
+    data_options = data_option_parser(defaults=False)
+
+    parser = argparse.ArgumentParser(prog='surf-data',
+                                     parents=[data_option_parser()],
+                                     description='Process, summarise and visualize the surf data. '
+                                                 'Without a command, every step is run.')
+    parser.add_argument('--import-profile', action='store_true',
+                        help='report how long the imports of the command take (python -X importtime)')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='record the wall time, CPU time, peak memory and rows of every step, and save them in FILE')
+    parser.add_argument('--trace-format', choices=['json', 'chrome'], default='json',
+                        help='json (list of spans) or chrome (for chrome://tracing or ui.perfetto.dev; default: json)')
+    parser.set_defaults(func=run_all)
+
+    commands = parser.add_subparsers(title='commands', metavar='<command>')
+
+    ingest = commands.add_parser('ingest', help='fetch the google sheet (or read a local source) into the local snapshot')
+    ingest.add_argument('--sync', action='store_true', default=argparse.SUPPRESS,
+                        help='only fetch the rows added to the current year sheet since the last sync '
+                             '(the past year sheets are not re-checked, see --verify-frozen)')
+    ingest.add_argument('--verify-frozen', action='store_true', default=argparse.SUPPRESS,
+                        help='sync, and also re-check the past year sheets by their content hash')
+    ingest.add_argument('--source', default=argparse.SUPPRESS,
+                        help='local source to read instead of the google sheet, e.g. csv:input/logbook')
+    ingest.set_defaults(func=run_ingest)
+
+    export = commands.add_parser('export', parents=[data_options],
+                                 help='export the sessions of the snapshot as CSV or NDJSON (one session per line)')
+    export.add_argument('file', help='.csv, .ndjson or .jsonl file to write')
+    export.set_defaults(func=run_export)
+
+    stream = commands.add_parser('stream', help='print the summaries of an exported log, reading it in chunks')
+    stream.add_argument('file', help='.csv, .ndjson or .jsonl export of the sessions, in date order')
+    stream.add_argument('--chunksize', type=int, default=50_000, help='rows read at a time (default: 50000)')
+    stream.set_defaults(func=run_stream)
+
+    summarise = commands.add_parser('summarise', parents=[data_options], help='print the summaries')
+    summarise.set_defaults(func=run_summarise)
+
+    wrapped = commands.add_parser('wrapped', parents=[data_options], help='write the Surfing Wrapped JSON files')
+    wrapped.add_argument('--output', help=f'output folder (default: {JSON_OUTPUT_FOLDER})')
+    wrapped.add_argument('--force', action='store_true', help='re-write the files of every year')
+    wrapped.set_defaults(func=run_wrapped)
+
+    plots = commands.add_parser('plots', parents=[data_options], help='render the plots')
+    plots.add_argument('--output', help=f'output folder (default: {PLOT_FOLDER})')
+    plots.add_argument('--surfboards', action='store_true', help='include the surfboard plots')
+    plots.add_argument('--force', action='store_true', help='re-render every plot')
+    plots.set_defaults(func=run_plots)
+
+    check = commands.add_parser('check', parents=[data_options], help='check the data')
+    check.add_argument('--missing', action='store_true', help='missing values per column, per year')
+    check.add_argument('--unique', action='store_true', help='unique values per column')
+    check.add_argument('--spots', action='store_true', help='unique spots and subregions')
+    check.add_argument('--all', action='store_true', help='every check')
+    check.set_defaults(func=run_check)
+
+    wetsuits = commands.add_parser('wetsuits', parents=[data_options],
+                                   help='print the lifetime, hours and wear of every wetsuit, and plot its timeline')
+    wetsuits.add_argument('--output', help=f'plot folder (default: {PLOT_FOLDER})')
+    wetsuits.add_argument('--buoys', help=f'folder with the buoy observations, for the water temperature (default: {BUOY_FOLDER})')
+    wetsuits.add_argument('--force', action='store_true', help='re-render the plot')
+    wetsuits.set_defaults(func=run_wetsuits)
+
+    spots = commands.add_parser('spots', parents=[data_options],
+                                help='print the NOAA buoy conditions of the good sessions, per subregion')
+    spots.add_argument('--buoys', help=f'folder with a <station>.csv of observations per buoy (default: {BUOY_FOLDER})')
+    spots.add_argument('--good', type=int, default=9, help='sessions with a wave quality above this are good (default: 9)')
+    spots.set_defaults(func=run_spots)
+
+    conditions = commands.add_parser('conditions', parents=[data_options],
+                                     help='query the index of the sessions per spot and buoy conditions')
+    conditions.add_argument('--where', nargs='+', default=[], metavar='CONDITION=RANGE',
+                            help='only count the sessions in these conditions, e.g. dpd=14: mwd=W,SW wvht=1:2')
+    conditions.add_argument('--best', metavar='CONDITION', help='rank the bins of a condition at --spot by wave quality, e.g. mwd')
+    conditions.add_argument('--spot', help='spot to rank the conditions of, e.g. "Santa Cruz - Waddell Reef"')
+    conditions.add_argument('--min-sessions', type=int, default=1, help='leave out spots (or bins) with fewer sessions')
+    conditions.add_argument('--buoys', help=f'folder with the buoy observations (default: {BUOY_FOLDER})')
+    conditions.set_defaults(func=run_conditions)
+
+    forecast = commands.add_parser('forecast', parents=[data_options],
+                                   help='rank the spots for a forecast, from how the sessions went in past conditions')
+    forecast.add_argument('file', help='.csv or .ndjson forecast with a row per buoy (station) and hour: time (UTC), wvht, dpd, mwd, wspd, ...')
+    forecast.add_argument('--top', type=int, default=25, help='number of (spot, day) rows to rank (default: 25)')
+    forecast.add_argument('--output', help=f'JSON file to write the ranking to (default: {FORECAST_OUTPUT_FILE})')
+    forecast.add_argument('--buoys', help=f'folder with the buoy observations (default: {BUOY_FOLDER})')
+    forecast.set_defaults(func=run_forecast)
+
+    buoys = commands.add_parser('buoys', help='parse raw NDBC buoy files (.txt or .txt.gz) into the buoy archive')
+    buoys.add_argument('raw', help='folder with the raw NDBC standard meteorological files, e.g. 46225h2019.txt.gz')
+    buoys.add_argument('--archive', help=f'archive folder (default: {BUOY_FOLDER})')
+    buoys.add_argument('--force', action='store_true', help='rebuild every station, not only those whose files changed')
+    buoys.set_defaults(func=run_buoys)
+
+    benchmark = commands.add_parser('benchmark', help='time and memory-profile the stages on synthetic logbooks')
+    benchmark.add_argument('--sizes', type=float, nargs='+', default=[1e3, 1e4, 1e5],
+                           help='number of sessions of each synthetic logbook (default: 1e3 1e4 1e5)')
+    benchmark.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best is kept')
+    benchmark.add_argument('--stages', nargs='+', help='only report these stages')
+    benchmark.add_argument('--output', help='file to save the results in (default: output/benchmarks/benchmark_<time>.json)')
+    benchmark.add_argument('--baseline', default=os.path.join('output', 'benchmarks', 'baseline.json'),
+                           help='results to compare against (default: output/benchmarks/baseline.json)')
+    benchmark.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    benchmark.add_argument('--threshold', type=float, default=0.25,
+                           help='flag stages that got this much slower or use this much more memory (default: 0.25)')
+    benchmark.set_defaults(func=run_benchmark)
+
+    # (no --source: each logbook sets its own source in the manifest)
+    batch = commands.add_parser('batch',
+                                help='run ingest, process, summaries and the Surfing Wrapped JSON for many logbooks')
+    batch.add_argument('manifest',
+                       help='csv of the logbooks, with the columns surfer, sheet_url, sheet_access_key, source and snapshot_folder')
+    batch.add_argument('--refresh', action='store_true', default=argparse.SUPPRESS,
+                       help='fetch the google sheet logbooks and update their snapshots before running')
+    batch.add_argument('--sync', action='store_true', default=argparse.SUPPRESS,
+                       help='only fetch the rows added to the current year sheet of each google sheet logbook since its last sync')
+    batch.add_argument('--verify-frozen', action='store_true', default=argparse.SUPPRESS,
+                       help='sync, and also re-check the past year sheets by their content hash')
+    batch.add_argument('--output', default=os.path.join('output', 'batch'),
+                       help='output folder, with a sub folder per surfer (default: output/batch)')
+    batch.add_argument('--workers', type=int, help='number of worker processes (default: one per cpu)')
+    batch.add_argument('--force', action='store_true', help='re-write the files of every year')
+    batch.set_defaults(func=run_batch)
+
+    return parser
+
 
 if __name__ == "__main__":
-    main(check_data=False,
-         save_plots=True)
\ No newline at end of file
+    args = build_parser().parse_args()
+    if args.import_profile:
+        sys.exit(profile_imports([arg for arg in sys.argv[1:] if arg != '--import-profile']))
+    if args.trace:
+        from src.trace import enable_tracing, write_trace, print_trace_summary
+        enable_tracing()
+        try:
+            args.func(args)
+        finally:
+            write_trace(args.trace, args.trace_format)
+            print_trace_summary()
+    else:
+        args.func(args)
@@ -0,0 +1,79 @@
+import os
+import json
+import shutil
+import hashlib
+from datetime import datetime
+
+from src.trace import traced
+
+# Folder (inside an output folder) with one copy of every artifact, stored under its content hash
+STORE_FOLDER = '.store'
+# Append-only log (inside an output folder) of every artifact version that was saved
+HISTORY_FILE = 'artifact_history.jsonl'
+
+
+# Function to (atomically) point a path at a stored file; a hardlink, or a copy where hardlinks are not supported
+def link_artifact(store_path, path):
+    if os.path.exists(path) and os.path.samefile(store_path, path):
+        return
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.link(store_path, tmp_path)
+    except OSError:
+        shutil.copyfile(store_path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+@traced('export')
+def store_artifact(output_folder, filename, content):
+    """
+    Save an artifact (e.g. an encoded plot or csv) once, under its content hash, and link two versions to it:
+      1. undated, in the output folder
+      2. dated, in a subfolder with the current date (to keep historical versions)
+    Saving the same content again only adds links, so the output folder does not grow when nothing changed.
+    Arguments:
+        output_folder: folder to save the artifact in
+        filename: name of the (undated) file
+        content: bytes of the file
+    Returns:
+        content hash of the artifact
+    """
+    current_date = datetime.now().strftime("%Y%m%d")
+    content_hash = hashlib.sha256(content).hexdigest()
+
+    store_folder = os.path.join(output_folder, STORE_FOLDER)
+    os.makedirs(store_folder, exist_ok=True)
+    store_path = os.path.join(store_folder, content_hash + os.path.splitext(filename)[1])
+    is_new = not os.path.exists(store_path)
+    if is_new:
+        tmp_path = f'{store_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, store_path)
+
+    output_file_path = os.path.join(output_folder, filename)
+    output_file_path_dated = os.path.join(output_folder, current_date, f'{current_date}_{filename}')
+    os.makedirs(os.path.dirname(output_file_path_dated), exist_ok=True)
+    link_artifact(store_path, output_file_path)
+    link_artifact(store_path, output_file_path_dated)
+
+    # one line per save, appended in a single write (so parallel savers don't clobber each other)
+    record = {'saved': datetime.now().isoformat(timespec='seconds'),
+              'file': filename,
+              'dated_file': os.path.relpath(output_file_path_dated, output_folder),
+              'hash': content_hash,
+              'new_content': is_new}
+    with open(os.path.join(output_folder, HISTORY_FILE), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    return content_hash
+
+
+# Function to read the history of the artifacts saved in an output folder (optionally, of a single file)
+def artifact_history(output_folder, filename=None):
+    history_path = os.path.join(output_folder, HISTORY_FILE)
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [record for record in records if filename is None or record['file'] == filename]
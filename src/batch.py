@@ -0,0 +1,185 @@
+import os
+import re
+import json
+import time
+import traceback
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+
+from src.snapshot import SNAPSHOT_FOLDER
+from src.trace import trace_events, add_trace_events
+
+# Default folder for the output of every surfer (a sub folder per surfer)
+BATCH_OUTPUT_FOLDER = os.path.join('output', 'batch')
+# Default folder for the snapshots of the logbooks that are fetched from a google sheet
+BATCH_SNAPSHOT_FOLDER = os.path.join(SNAPSHOT_FOLDER, 'logbooks')
+BATCH_REPORT_FILE = 'batch_report.json'
+# Columns of the logbook manifest (a csv with a row per surfer); a logbook is either
+#   a google sheet: sheet_url and sheet_access_key (snapshot_folder is where its snapshot is kept, optional),
+#   a local source (see src.sources, e.g. csv:logbooks/ana): source (and optionally snapshot_folder), or
+#   a local snapshot: snapshot_folder only
+MANIFEST_COLUMNS = ['surfer', 'sheet_url', 'sheet_access_key', 'source', 'snapshot_folder']
+
+
+# Function to turn a surfer's name into a folder name
+def surfer_folder_name(surfer):
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', surfer.strip()).strip('_')
+
+
+def read_logbook_manifest(manifest_file, snapshot_folder=BATCH_SNAPSHOT_FOLDER):
+    """
+    Read the manifest of the logbooks to process.
+    Arguments:
+        manifest_file: csv with the columns surfer, sheet_url, sheet_access_key, source and snapshot_folder (blanks allowed)
+        snapshot_folder: folder for the snapshots of the google sheet (and source) logbooks that don't set their own
+    Returns:
+        list of dictionaries, one per logbook
+    """
+    manifest_df = pd.read_csv(manifest_file, dtype=str, keep_default_na=False)
+    missing_cols = [col for col in ['surfer'] if col not in manifest_df.columns]
+    if missing_cols:
+        raise ValueError(f'The logbook manifest {manifest_file} has no {", ".join(missing_cols)} column')
+    manifest_df = manifest_df.reindex(columns=MANIFEST_COLUMNS, fill_value='')
+
+    logbooks = []
+    for logbook in manifest_df.to_dict('records'):
+        logbook = {col: value.strip() for col, value in logbook.items()}
+        if not logbook['sheet_url'] and not logbook['source'] and not logbook['snapshot_folder']:
+            raise ValueError(f'Logbook of "{logbook["surfer"]}" has no sheet_url, source or snapshot_folder')
+        logbook['folder_name'] = surfer_folder_name(logbook['surfer'])
+        logbook['snapshot_folder'] = logbook['snapshot_folder'] or os.path.join(snapshot_folder, logbook['folder_name'])
+        logbooks.append(logbook)
+
+    folder_names = [logbook['folder_name'] for logbook in logbooks]
+    duplicates = sorted({name for name in folder_names if folder_names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'Surfers in the logbook manifest must be unique, found more than one "{", ".join(duplicates)}"')
+    return logbooks
+
+
+# Function (run in a worker process) to run ingest -> process -> summaries -> wrapped JSON for one logbook
+# The output (and the printed log) of every surfer goes in its own folder, so the workers don't share any files
+def process_logbook(logbook, output_folder, refresh=False, delta=False, verify_frozen=False, force=False):
+    from src.setup import load_gsheet_snapshot, load_raw_entries
+    from src.snapshot import load_snapshot
+    from src.sources import load_source_snapshot
+    from src.process import process_surf_data
+    from analysis.summarise import create_simple_summaries, create_ranked_summaries
+    from analysis.surfing_wrapped import create_surf_wrapped_json
+
+    surfer_folder = os.path.join(output_folder, logbook['folder_name'])
+    os.makedirs(surfer_folder, exist_ok=True)
+    n_events = len(trace_events())
+    result = {'surfer': logbook['surfer'], 'pid': os.getpid(), 'n_sessions': 0, 'files': [], 'error': None}
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    with open(os.path.join(surfer_folder, 'batch.log'), 'w') as log, redirect_stdout(log):
+        try:
+            if logbook['source']:
+                surf_data_dict = load_source_snapshot(logbook['source'], logbook['snapshot_folder'])
+            elif logbook['sheet_url']:
+                surf_data_dict = load_gsheet_snapshot(logbook['sheet_url'],
+                                                      logbook['sheet_access_key'],
+                                                      snapshot_folder=logbook['snapshot_folder'],
+                                                      refresh=refresh or delta or verify_frozen,
+                                                      delta=delta or verify_frozen,
+                                                      verify_frozen=verify_frozen)
+            else:
+                surf_data_dict = load_snapshot(logbook['snapshot_folder'])
+            surf_data_df = process_surf_data(load_raw_entries(surf_data_dict, logbook['snapshot_folder']),
+                                             rm_incomplete_yrs=False)
+            _, summary_by_year, _ = create_simple_summaries(surf_data_df, [None, ['year'], ['year', 'month', 'season']])
+            _, ranked_summary_by_year = create_ranked_summaries(surf_data_df)
+            result['files'] = create_surf_wrapped_json(surf_data_df,
+                                                       surf_data_dict,
+                                                       summary_by_year,
+                                                       ranked_summary_by_year,
+                                                       os.path.join(surfer_folder, 'surfing_wrapped'),
+                                                       force=force)
+            result['n_sessions'] = len(surf_data_df)
+        except Exception as error:
+            # one broken logbook should not stop the batch
+            traceback.print_exc(file=log)
+            result['error'] = f'{type(error).__name__}: {error}'
+
+    result['seconds'] = time.perf_counter() - start_wall
+    result['cpu_seconds'] = time.process_time() - start_cpu
+    result['trace_events'] = trace_events()[n_events:]
+    return result
+
+
+def run_batch(logbooks, output_folder=BATCH_OUTPUT_FOLDER, max_workers=None, refresh=False, delta=False, verify_frozen=False,
+              force=False):
+    """
+    Process many surfers' logbooks in a pool of worker processes, at most max_workers at a time.
+    Arguments:
+        logbooks: list of logbooks (see read_logbook_manifest)
+        output_folder: folder with a sub folder of output per surfer
+        max_workers: number of worker processes (default: one per cpu, up to the number of logbooks)
+        refresh: fetch the google sheets (the local snapshots are used otherwise)
+        delta: only fetch the rows added to the current year of each google sheet since its last sync (see sync_gsheet)
+        verify_frozen: with delta, also re-check the past year tabs by their content hash
+        force: re-write every year's JSON file, even if its data did not change
+    Returns:
+        throughput report; dictionary with the totals and a list of results (one per logbook)
+    """
+    max_workers = max_workers or min(len(logbooks), os.cpu_count() or 1) or 1
+    results = []
+    start_wall = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_logbook, logbook, output_folder, refresh, delta, verify_frozen, force) for logbook in logbooks]
+        for future in as_completed(futures):
+            result = future.result()
+            add_trace_events(result.pop('trace_events'))
+            results.append(result)
+            status = f"failed ({result['error']})" if result['error'] else f"{result['n_sessions']:,} sessions"
+            print(f"  {result['surfer']}: {status} in {result['seconds']:.2f}s")
+    wall_seconds = time.perf_counter() - start_wall
+
+    results = sorted(results, key=lambda result: result['surfer'])
+    n_sessions = sum(result['n_sessions'] for result in results)
+    busy_seconds = sum(result['seconds'] for result in results)
+    return {'created': datetime.now().isoformat(timespec='seconds'),
+            'max_workers': max_workers,
+            'cpu_count': os.cpu_count(),
+            'n_logbooks': len(results),
+            'n_failed': sum(result['error'] is not None for result in results),
+            'n_sessions': n_sessions,
+            'wall_seconds': wall_seconds,
+            # time the logbooks took one after the other, over the time the batch took: close to max_workers when it scales
+            'speedup': busy_seconds / wall_seconds if wall_seconds else None,
+            'logbooks_per_second': len(results) / wall_seconds if wall_seconds else None,
+            'sessions_per_second': n_sessions / wall_seconds if wall_seconds else None,
+            'results': results}
+
+
+# Function to print the throughput report
+def print_batch_report(report):
+    print(f"\nBatch: {report['n_logbooks']} logbook(s), {report['n_failed']} failed, "
+          f"{report['n_sessions']:,} sessions in {report['wall_seconds']:.2f}s with {report['max_workers']} worker(s)")
+    print(f"  {report['logbooks_per_second']:.2f} logbooks/s, {report['sessions_per_second']:,.0f} sessions/s, "
+          f"speedup {report['speedup']:.2f}x")
+
+
+def batch(manifest_file, output_folder=BATCH_OUTPUT_FOLDER, max_workers=None, refresh=False, delta=False, verify_frozen=False,
+          force=False):
+    """
+    Run the batch of logbooks in the manifest, and save the throughput report in the output folder.
+    Returns:
+        throughput report (see run_batch)
+    """
+    logbooks = read_logbook_manifest(manifest_file)
+    print(f"Batch: processing {len(logbooks)} logbook(s) from {manifest_file}")
+    report = run_batch(logbooks, output_folder, max_workers=max_workers, refresh=refresh, delta=delta,
+                       verify_frozen=verify_frozen, force=force)
+    print_batch_report(report)
+
+    os.makedirs(output_folder, exist_ok=True)
+    report_path = os.path.join(output_folder, BATCH_REPORT_FILE)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Report saved as {report_path}")
+    return report
@@ -0,0 +1,205 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from src.synthetic import synthetic_surf_data_dict, to_sheet_values
+
+# Default folder for the benchmark results, and the baseline they are compared against
+BENCHMARK_FOLDER = os.path.join('output', 'benchmarks')
+BASELINE_FILE = os.path.join(BENCHMARK_FOLDER, 'baseline.json')
+# Default logbook sizes (number of sessions)
+BENCHMARK_SIZES = [1e3, 1e4, 1e5]
+# A stage regressed when it got this much slower (or uses this much more memory) than in the baseline
+REGRESSION_THRESHOLD = 0.25
+# Timings below this are too noisy to flag (seconds)
+MIN_SECONDS = 0.01
+
+
+# The benchmarked stages, in the order of the pipeline:
+#   (name, function of the results so far, name of its result (None if it is not used by a later stage))
+def benchmark_stages(json_output_folder):
+    from src.setup import values_to_df, concatenate_entries
+    from src.process import process_surf_data
+    from analysis.summarise import create_simple_summaries, create_ranked_summaries
+    from analysis.surfing_wrapped import create_surf_wrapped_json
+    from analysis.regions import process_region_hours
+    from analysis.surfboards import process_surfboard_lifetime
+
+    # the sheet values are decoded as load_gsheet does, so the later stages get the same typed columns as the pipeline
+    return [('decode_sheets',
+             lambda ctx: {sheet_name: values_to_df(values, sheet_name) for sheet_name, values in ctx['sheet_values'].items()},
+             'surf_data_dict'),
+            ('concatenate_entries',
+             lambda ctx: concatenate_entries(ctx['surf_data_dict']),
+             'surf_data_df_raw'),
+            ('process_surf_data',
+             lambda ctx: process_surf_data(ctx['surf_data_df_raw'], rm_incomplete_yrs=False),
+             'surf_data_df'),
+            ('create_simple_summaries',
+             lambda ctx: create_simple_summaries(ctx['surf_data_df'], [None, ['year'], ['year', 'month', 'season']]),
+             'simple_summaries'),
+            ('create_ranked_summaries',
+             lambda ctx: create_ranked_summaries(ctx['surf_data_df']),
+             'ranked_summaries'),
+            ('create_surf_wrapped_json',
+             lambda ctx: create_surf_wrapped_json(ctx['surf_data_df'], ctx['surf_data_dict'],
+                                                  ctx['simple_summaries'][1], ctx['ranked_summaries'][1],
+                                                  json_output_folder, force=True),
+             None),
+            ('process_region_hours',
+             lambda ctx: process_region_hours(ctx['surf_data_df']),
+             None),
+            ('process_surfboard_lifetime',
+             lambda ctx: process_surfboard_lifetime(ctx['surf_data_df'], ctx['surf_data_dict']),
+             None)]
+
+
+# Function to time a stage (best of repeat runs), then measure its peak memory (tracemalloc) in a separate run
+def measure_stage(function, ctx, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function(ctx)
+            timings.append(time.perf_counter() - start)
+
+    # tracemalloc slows down the run, so memory is measured on its own
+    tracemalloc.start()
+    try:
+        with redirect_stdout(io.StringIO()):
+            function(ctx)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, {'seconds': min(timings),
+                    'seconds_median': float(np.median(timings)),
+                    'peak_mb': peak / 1e6}
+
+
+def run_benchmarks(sizes=BENCHMARK_SIZES, repeat=3, seed=0, stages=None):
+    """
+    Time and memory-profile each stage of the pipeline on synthetic logbooks (see src.synthetic) of different sizes.
+    Arguments:
+        sizes: number of sessions of each logbook
+        repeat: number of timed runs of each stage (the best is kept)
+        seed: seed of the synthetic logbooks
+        stages: names of the stages to report (default: all of them; the stages they depend on still run)
+    Returns:
+        dictionary with the environment and a list of results (one per stage and size)
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as json_output_folder:
+        for size in sizes:
+            n_sessions = int(size)
+            print(f"\nBenchmark: {n_sessions:,} sessions")
+            ctx = {'sheet_values': to_sheet_values(synthetic_surf_data_dict(n_sessions, seed=seed))}
+            for name, function, result_name in benchmark_stages(json_output_folder):
+                reported = not stages or name in stages
+                if reported:
+                    result, measured = measure_stage(function, ctx, repeat=repeat)
+                    measured = {'stage': name,
+                                'n_sessions': n_sessions,
+                                **measured,
+                                'sessions_per_second': n_sessions / measured['seconds'] if measured['seconds'] else None}
+                    results.append(measured)
+                    print(f"  {name:<28} {measured['seconds']:>9.3f}s {measured['peak_mb']:>10.1f} MB")
+                elif result_name is not None:
+                    # a stage that is not reported, but whose result a later stage needs
+                    with redirect_stdout(io.StringIO()):
+                        result = function(ctx)
+                else:
+                    continue
+                if result_name is not None:
+                    ctx[result_name] = result
+
+    return {'created': datetime.now().isoformat(timespec='seconds'),
+            'environment': {'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'pandas': pd.__version__,
+                            'platform': platform.platform(),
+                            'cpu_count': os.cpu_count()},
+            'seed': seed,
+            'repeat': repeat,
+            'results': results}
+
+
+def compare_to_baseline(benchmark_result, baseline, threshold=REGRESSION_THRESHOLD, min_seconds=MIN_SECONDS):
+    """
+    Flag the stages that got slower or use more memory than in the baseline (same stage and logbook size).
+    Returns:
+        list of regressions; dictionaries with the stage, size, metric, baseline and current value
+    """
+    baseline_results = {(result['stage'], result['n_sessions']): result for result in baseline['results']}
+    regressions = []
+    for result in benchmark_result['results']:
+        base = baseline_results.get((result['stage'], result['n_sessions']))
+        if base is None:
+            continue
+        for metric in ['seconds', 'peak_mb']:
+            if metric == 'seconds' and max(result[metric], base[metric]) < min_seconds:
+                continue
+            if base[metric] and result[metric] > base[metric] * (1 + threshold):
+                regressions.append({'stage': result['stage'],
+                                    'n_sessions': result['n_sessions'],
+                                    'metric': metric,
+                                    'baseline': base[metric],
+                                    'current': result[metric],
+                                    'change': result[metric] / base[metric] - 1})
+    return regressions
+
+
+# Function to save the benchmark results as JSON
+def save_benchmark(benchmark_result, file_path):
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    with open(file_path, 'w') as f:
+        json.dump(benchmark_result, f, indent=4)
+    print(f"Benchmark saved as {file_path}")
+
+
+# Function to load benchmark results (None if the file doesn't exist)
+def load_benchmark(file_path):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def benchmark(sizes=BENCHMARK_SIZES, repeat=3, stages=None, output_file=None, baseline_file=BASELINE_FILE,
+              save_baseline=False, threshold=REGRESSION_THRESHOLD):
+    """
+    Run the benchmarks, save the results and report the regressions against the baseline.
+    Returns:
+        list of regressions (empty if there is no baseline)
+    """
+    result = run_benchmarks(sizes, repeat=repeat, stages=stages)
+    output_file = output_file or os.path.join(BENCHMARK_FOLDER, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    save_benchmark(result, output_file)
+
+    regressions = []
+    baseline = load_benchmark(baseline_file)
+    if baseline is None:
+        print(f"No baseline in {baseline_file} to compare against")
+    else:
+        regressions = compare_to_baseline(result, baseline, threshold=threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression['stage']} ({regression['n_sessions']:,} sessions): {regression['metric']} "
+                  f"{regression['baseline']:.3f} -> {regression['current']:.3f} (+{regression['change']:.0%})",
+                  file=sys.stderr)
+        if not regressions:
+            print(f"No regressions against {baseline_file}")
+
+    if save_baseline:
+        save_benchmark(result, baseline_file)
+
+    return regressions
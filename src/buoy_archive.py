@@ -0,0 +1,228 @@
+import os
+import re
+import glob
+import gzip
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from src.trace import traced
+
+# Archive of NOAA buoy observations, parsed once from the raw NDBC standard meteorological files
+# (e.g. 46225h2019.txt.gz from https://www.ndbc.noaa.gov/historical_data.shtml, or the realtime 46225.txt),
+# one folder per station:
+#   <archive>/<station>/time.npy     sorted observation times (datetime64[ns], UTC), one per observation
+#   <archive>/<station>/<col>.npy    float32 column per condition (NaN where missing)
+#   <archive>/<station>/meta.json    number of rows, first/last time and the raw files it was built from
+# The arrays are read back as memory maps, so loading a station costs nothing until its pages are read,
+# and a time window (see station_window) only reads the pages in the window.
+ARCHIVE_META_FILE = 'meta.json'
+# Conditions kept in the archive (NDBC names, lower case):
+#   wvht: significant wave height [m], dpd: dominant wave period [s], mwd: wave direction [deg true]
+#   wspd: wind speed [m/s], wdir: wind direction [deg true], wtmp: water temperature [deg C]
+ARCHIVE_COLS = ['wvht', 'dpd', 'mwd', 'wspd', 'wdir', 'wtmp']
+# NDBC header names of the time and condition columns (older files use YYYY / YY, WD, and have no minutes)
+NDBC_COLUMNS = {'YY': 'year', 'YYYY': 'year', 'MM': 'month', 'DD': 'day', 'hh': 'hour', 'mm': 'minute',
+                'WD': 'wdir', 'WDIR': 'wdir', 'WSPD': 'wspd', 'WVHT': 'wvht', 'DPD': 'dpd', 'MWD': 'mwd', 'WTMP': 'wtmp'}
+# Missing values are written as 99, 999 (or MM in the realtime files); anything at or above these is missing
+MISSING_VALUES = {'wvht': 99, 'dpd': 99, 'mwd': 999, 'wspd': 99, 'wdir': 999, 'wtmp': 999}
+# Rows parsed at a time, so a file of any length is streamed into the archive
+ARCHIVE_CHUNKSIZE = 100_000
+
+
+# Station of a raw NDBC file (e.g. 46225 for 46225h2019.txt.gz, 46225.txt or 4622512024.txt.gz), None if it isn't one
+def ndbc_station(file_path):
+    match = re.match(r'^([0-9a-z]{5})(h\d{4}|\d{5})?\.txt(\.gz)?$', os.path.basename(file_path), re.IGNORECASE)
+    return match.group(1).lower() if match else None
+
+
+def _open_text(file_path):
+    return gzip.open(file_path, 'rt') if file_path.endswith('.gz') else open(file_path)
+
+
+def read_ndbc_file(file_path, chunksize=ARCHIVE_CHUNKSIZE):
+    """
+    Stream a raw NDBC standard meteorological file (plain text or gzip), in chunks.
+    Handles the header of every era of the files (2 or 4 digit years, with or without minutes, WD or WDIR),
+    and turns the missing value markers into NaN.
+    Arguments:
+        file_path: .txt or .txt.gz file
+        chunksize: number of rows per chunk
+    Yields:
+        DataFrames with a 'time' column (datetime64[ns], UTC) and the ARCHIVE_COLS (float32, NaN if not in the file)
+    """
+    with _open_text(file_path) as f:
+        header = f.readline().lstrip('#').split()
+        # newer files have a second header line with the units (#yr  mo  dy ...)
+        n_header_lines = 2 if f.readline().startswith('#') else 1
+
+    usecols = [i for i, name in enumerate(header) if name in NDBC_COLUMNS]
+    names = [NDBC_COLUMNS[header[i]] for i in usecols]
+    if not {'year', 'month', 'day', 'hour'} <= set(names):
+        raise ValueError(f'{file_path} is not an NDBC standard meteorological file (header: {" ".join(header)})')
+
+    with _open_text(file_path) as f:
+        for chunk in pd.read_csv(f, sep=r'\s+', header=None, skiprows=n_header_lines, usecols=usecols,
+                                 na_values=['MM'], dtype=np.float64, chunksize=chunksize):
+            chunk.columns = names
+            year = chunk['year'].to_numpy()
+            times = pd.to_datetime({'year': np.where(year < 100, year + 1900, year),
+                                    'month': chunk['month'],
+                                    'day': chunk['day'],
+                                    'hour': chunk['hour'],
+                                    'minute': chunk['minute'] if 'minute' in chunk else 0})
+            observations = {'time': times.to_numpy(dtype='datetime64[ns]')}
+            for col in ARCHIVE_COLS:
+                values = chunk[col].to_numpy(dtype=np.float32) if col in chunk else np.full(len(chunk), np.nan, dtype=np.float32)
+                values[values >= MISSING_VALUES[col]] = np.nan
+                observations[col] = values
+            yield pd.DataFrame(observations)
+
+
+# Raw files of a station in the order they are preferred in, when two of them have the same observation time:
+# the yearly historical files (quality controlled) first, then the monthly and the realtime files
+def _preferred_order(file_paths):
+    return sorted(file_paths, key=lambda file_path: (not re.search(r'h\d{4}\.txt', os.path.basename(file_path)),
+                                                     os.path.basename(file_path)))
+
+
+# Size and modification time of the raw files, to tell whether a station has to be rebuilt
+def _source_stats(file_paths):
+    return {os.path.basename(file_path): [os.stat(file_path).st_size, os.stat(file_path).st_mtime_ns]
+            for file_path in file_paths}
+
+
+@traced('ingest')
+def build_station_archive(station, file_paths, archive_folder, chunksize=ARCHIVE_CHUNKSIZE):
+    """
+    Parse the raw files of a station into its archive folder.
+    The files are streamed (chunk by chunk) into temporary column files, which are then sorted by time one column
+    at a time, so the memory needed is about one column of the station rather than all of its files.
+    Observations with the same time are kept once (see _preferred_order).
+    Arguments:
+        station: station id, e.g. '46225'
+        file_paths: raw NDBC files of the station
+        archive_folder: folder of the archive
+        chunksize: rows parsed at a time
+    Returns:
+        number of observations in the archive
+    """
+    file_paths = _preferred_order(file_paths)
+    station_folder = os.path.join(archive_folder, station)
+    build_folder = station_folder + '.building'
+    shutil.rmtree(build_folder, ignore_errors=True)
+    os.makedirs(build_folder)
+
+    # (1) stream the files into unsorted column files
+    columns = ['time'] + ARCHIVE_COLS
+    raw_files = {col: open(os.path.join(build_folder, f'{col}.raw'), 'wb') for col in columns}
+    try:
+        for file_path in file_paths:
+            for chunk in read_ndbc_file(file_path, chunksize=chunksize):
+                for col in columns:
+                    chunk[col].to_numpy().tofile(raw_files[col])
+    finally:
+        for raw_file in raw_files.values():
+            raw_file.close()
+
+    # (2) sort by time (stable, so the first of the observations with the same time is the preferred one)
+    times = np.fromfile(os.path.join(build_folder, 'time.raw'), dtype='datetime64[ns]')
+    order = np.argsort(times, kind='stable')
+    sorted_times = times[order]
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = sorted_times[1:] != sorted_times[:-1]
+    order = order[keep]
+    first, last = (str(np.datetime64(sorted_times[i], 's')) for i in [0, -1]) if len(order) else (None, None)
+    del times, sorted_times
+
+    # (3) write every column in time order, one at a time
+    for col in columns:
+        dtype = 'datetime64[ns]' if col == 'time' else np.float32
+        unsorted = np.memmap(os.path.join(build_folder, f'{col}.raw'), dtype=dtype, mode='r') if len(keep) else np.empty(0, dtype)
+        np.save(os.path.join(build_folder, f'{col}.npy'), unsorted[order])
+        del unsorted
+        os.remove(os.path.join(build_folder, f'{col}.raw'))
+
+    with open(os.path.join(build_folder, ARCHIVE_META_FILE), 'w') as f:
+        json.dump({'station': station,
+                   'n_rows': int(len(order)),
+                   'first': first,
+                   'last': last,
+                   'columns': ARCHIVE_COLS,
+                   'sources': _source_stats(file_paths)}, f, indent=2)
+
+    # replace the station's folder only once the new one is complete
+    shutil.rmtree(station_folder, ignore_errors=True)
+    os.replace(build_folder, station_folder)
+    return len(order)
+
+
+# Metadata of a station in the archive (None if it isn't archived)
+def station_meta(archive_folder, station):
+    meta_file = os.path.join(archive_folder, station, ARCHIVE_META_FILE)
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+# Stations in the archive
+def archive_stations(archive_folder):
+    return sorted(os.path.basename(os.path.dirname(meta_file))
+                  for meta_file in glob.glob(os.path.join(archive_folder, '*', ARCHIVE_META_FILE)))
+
+
+@traced('ingest')
+def update_buoy_archive(raw_folder, archive_folder, force=False):
+    """
+    Bring the archive up to date with a folder of raw NDBC files (any mix of stations, years, gzip or not):
+    only the stations whose raw files were added or changed are rebuilt.
+    Arguments:
+        raw_folder: folder with the raw files (e.g. 46225h2019.txt.gz)
+        archive_folder: folder of the archive
+        force: rebuild every station
+    Returns:
+        dictionary of {station: number of observations} of the stations that were rebuilt
+    """
+    files_by_station = {}
+    for file_path in sorted(glob.glob(os.path.join(raw_folder, '*'))):
+        station = ndbc_station(file_path)
+        if station is not None:
+            files_by_station.setdefault(station, []).append(file_path)
+    if not files_by_station:
+        raise FileNotFoundError(f'No NDBC files (e.g. 46225h2019.txt.gz) found in "{raw_folder}"')
+
+    rebuilt = {}
+    for station, file_paths in files_by_station.items():
+        meta = station_meta(archive_folder, station)
+        if not force and meta is not None and meta['sources'] == _source_stats(_preferred_order(file_paths)):
+            continue
+        rebuilt[station] = build_station_archive(station, file_paths, archive_folder)
+        print(f'Archived buoy {station}: {rebuilt[station]} observations from {len(file_paths)} file(s)')
+
+    if not rebuilt:
+        print(f'The buoy archive is up to date with {raw_folder}')
+    return rebuilt
+
+
+def load_station(archive_folder, station):
+    """
+    Open the archive of a station as memory maps (nothing is read until the arrays are used).
+    Returns:
+        dictionary with 'time' (datetime64[ns]) and the ARCHIVE_COLS (float32), all np.memmap
+    """
+    if station_meta(archive_folder, station) is None:
+        raise FileNotFoundError(f'Buoy {station} is not in the archive "{archive_folder}"')
+    return {col: np.load(os.path.join(archive_folder, station, f'{col}.npy'), mmap_mode='r')
+            for col in ['time'] + ARCHIVE_COLS}
+
+
+# Function to select the observations of a station between two times (views of the memory maps, found with a
+# binary search of the times, so only the pages of the window are read)
+def station_window(station_data, start=None, end=None):
+    times = station_data['time']
+    first = 0 if start is None else np.searchsorted(times, np.datetime64(start, 'ns'), side='left')
+    last = len(times) if end is None else np.searchsorted(times, np.datetime64(end, 'ns'), side='right')
+    return {col: values[first:last] for col, values in station_data.items()}
@@ -0,0 +1,154 @@
+import os
+import glob
+import json
+import pickle
+import hashlib
+import inspect
+from collections import namedtuple
+
+from src.snapshot import SNAPSHOT_FOLDER
+from src.trace import trace_span
+
+# Default folder for the cached stage results (next to the snapshot they are built from)
+CACHE_FOLDER = os.path.join(SNAPSHOT_FOLDER, 'stages')
+# Folders with the code the stages run; a change to any of it invalidates the cached results
+CODE_FOLDERS = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), folder)
+                for folder in ['src', 'analysis']]
+
+# A stage of the pipeline:
+#   name: name of the stage (and of its result)
+#   function: called with the results of the input stages (in order), plus the params as keyword arguments
+#   inputs: names of the stages whose results the function needs
+#   params: dictionary of keyword arguments, part of the stage's key
+#   fingerprint: (source stages) function returning a fingerprint of the data, e.g. the snapshot's tab hashes
+#   cache: persist the result, keyed by the hash of the code, the params and the upstream keys
+#   outputs: the result is a list of files the stage wrote; the stage is re-run when any of them is missing
+Stage = namedtuple('Stage', ['name', 'function', 'inputs', 'params', 'fingerprint', 'cache', 'outputs'],
+                   defaults=((), {}, None, True, False))
+
+
+# Function to hash the code of the pipeline (so the cache is invalidated when the code changes)
+def code_fingerprint(code_folders=CODE_FOLDERS):
+    sha = hashlib.sha256()
+    for path in sorted(path for folder in code_folders for path in glob.glob(os.path.join(folder, '*.py'))):
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+# Function to hash the source file a stage function is defined in (e.g. main.py)
+def function_fingerprint(function):
+    with open(inspect.getsourcefile(function), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class Pipeline:
+    """
+    Run the stages needed for a set of targets, re-using the persisted results of the stages whose
+    key (code + params + upstream keys) did not change. Results are only loaded when a stage that
+    has to run needs them, so targets that are up to date run (and load) nothing.
+    Arguments:
+        stages: list of Stages
+        cache_folder: folder the stage results are persisted in
+        preloaded: dictionary of {stage name: result} that are already in memory (e.g. a freshly fetched sheet)
+    """
+
+    def __init__(self, stages, cache_folder=CACHE_FOLDER, preloaded=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_folder = cache_folder
+        self.results = dict(preloaded or {})
+        self.keys = {}
+        self.code_hash = code_fingerprint()
+        # what happened to each stage: 'ran', 'loaded' (from the cache) or 'up to date'
+        self.log = {}
+
+    def key(self, name):
+        if name not in self.keys:
+            stage = self.stages[name]
+            sha = hashlib.sha256()
+            sha.update(json.dumps([name, stage.params], sort_keys=True, default=str).encode())
+            sha.update(self.code_hash.encode())
+            sha.update(function_fingerprint(stage.function).encode())
+            if stage.fingerprint is not None:
+                sha.update(json.dumps(stage.fingerprint(), sort_keys=True, default=str).encode())
+            for input_name in stage.inputs:
+                sha.update(self.key(input_name).encode())
+            self.keys[name] = sha.hexdigest()
+        return self.keys[name]
+
+    def _cache_path(self, name):
+        return os.path.join(self.cache_folder, f'{name}.pkl')
+
+    # Function to load a cached result, None if there is none for the current key (or its output files are gone)
+    def _load(self, name):
+        cache_path = self._cache_path(name)
+        if not os.path.exists(cache_path):
+            return None
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['key'] != self.key(name):
+            return None
+        if self.stages[name].outputs and not all(os.path.exists(path) for path in cached['result']):
+            return None
+        return cached
+
+    def _save(self, name, result):
+        os.makedirs(self.cache_folder, exist_ok=True)
+        tmp_path = f'{self._cache_path(name)}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'key': self.key(name), 'result': result}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._cache_path(name))
+
+    def result(self, name, force=False):
+        if name in self.results and not force:
+            return self.results[name]
+
+        stage = self.stages[name]
+        with trace_span(f'load {name}', 'cache') as span:
+            cached = self._load(name) if stage.cache and not force else None
+            span['output'] = cached['result'] if cached is not None else None
+        if cached is not None:
+            self.log[name] = 'loaded'
+            result = cached['result']
+        else:
+            inputs = [self.result(input_name) for input_name in stage.inputs]
+            # forced stages that write files are asked to re-write the files they would skip
+            params = dict(stage.params, force=True) if force and stage.outputs else stage.params
+            with trace_span(name, 'stage', inputs=inputs) as span:
+                result = stage.function(*inputs, **params)
+                span['output'] = result
+            self.log[name] = 'ran'
+            if stage.cache:
+                self._save(name, result)
+        self.results[name] = result
+        return result
+
+    def run(self, targets, force=False):
+        """
+        Bring the targets up to date.
+        Arguments:
+            targets: names of the stages to run
+            force: re-run the targets themselves, even if they are up to date (their inputs are still re-used);
+                   targets that write files are called with force=True
+        Returns:
+            dictionary of {target: result}
+        """
+        results = {}
+        for target in targets:
+            stage = self.stages[target]
+            # targets that write files are up to date when their key matches and the files exist;
+            # their inputs don't need to be loaded at all
+            cached = self._load(target) if stage.outputs and stage.cache and not force else None
+            if cached is not None:
+                self.log[target] = 'up to date'
+                results[target] = cached['result']
+            else:
+                results[target] = self.result(target, force=force)
+        return results
+
+    # Function to print what happened to each stage
+    def report(self):
+        n_ran = sum(status == 'ran' for status in self.log.values())
+        print(f"\nPipeline: {n_ran} stage(s) ran")
+        for name, status in self.log.items():
+            print(f"  {name}: {status}")
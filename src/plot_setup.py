@@ -17,6 +17,10 @@ board_state_color_dict = {'have':'#5db054',
                           'sold':'#f59e42',
                           'broken':'#b05454'}
 
+# colors of the wetsuit state (retired once it has not been worn for a while)
+wetsuit_state_color_dict = {'in use':'#5db054',
+                            'retired':'#b05454'}
+
 # apply color for `when`
 time_of_day_color_dict = {'morning': '#89D99D',
                           'midday':  '#3B8C6E',
@@ -1,7 +1,8 @@
-from tracemalloc import start
 import pandas as pd
 
-from src.utils import to_snake_case, convert_numeric_columns, calc_avg_wave_height, check_row_counts, assign_season
+from src.utils import to_snake_case, calc_avg_wave_height, check_row_counts, assign_season
+from src.trace import traced
+from src.schema import REGION_MAP_FILE, apply_session_schema, decode_frame
 
 
 # add regions (level above the regions defined in the sheet)
@@ -11,7 +12,7 @@ def add_regions(df):
     """
 
     # read in the region_general_dictionary .csv file in the input folder
-    region_map = pd.read_csv('input/region_map.csv', index_col='subregion').to_dict()['region']
+    region_map = pd.read_csv(REGION_MAP_FILE, index_col='subregion').to_dict()['region']
 
     # map the subregion to the region
     df['region'] = df['subregion'].map(region_map).fillna('Other')
@@ -19,35 +20,35 @@ def add_regions(df):
     return df
 
 # Main function to process the surf data DataFrame
+@traced('process')
 def process_surf_data(df,
                       rm_cols = ['Visuals', 'Notes', 'BUOY Data'],
-                      rm_incomplete_yrs = True):
+                      rm_incomplete_yrs = True,
+                      report_memory = False):
     """
     Main function to process the raw surf data DataFrame.
+    The result is stored with the compact session schema (see src.schema.apply_session_schema).
     """
-    # Make a copy of the df so we can check row counts later
-    df_0 = df.copy()
-    
+    # Keep a reference to the raw df so we can check row counts later (the steps below don't modify it)
+    df_0 = df
+
     # Remove the specified columns
     df = df.drop(columns=rm_cols, errors='ignore')
 
     # Update columns to snake case
     df.columns = [to_snake_case(col) for col in df.columns]
 
-    # Replace empty values with NA
-    df = df.replace(['', ' ', 'NA', 'N/A', 'n/a', 'na'], pd.NA)
-    # Replace NaN values with NA
-    df.fillna(pd.NA, inplace=True)
-
-    # Convert columns to numeric if all values are numeric
-    df = convert_numeric_columns(df)
+    # Decode any columns that are still raw strings (NA tokens and numbers, see src.schema)
+    # the sheets are already decoded on import, so this only does work for e.g. older all-string snapshots
+    df = decode_frame(df)
 
     # Create date column
     df['date'] = pd.to_datetime(df[['year', 'month', 'day']])
 
     # Sort by date and rename columns
+    # (stable sort, so sessions on the same day keep the order they were logged in, on every run)
     df = (df
-          .sort_values(by='date', ignore_index=True)
+          .sort_values(by='date', kind='stable', ignore_index=True)
           .rename(columns={'region': 'subregion'}))
     
     # Calculate Average Wave Height
@@ -70,14 +71,16 @@ def process_surf_data(df,
     df['subregion_spot'] = df['subregion'] + ' - ' + df['spot']
 
     # add new parameter which is the "session value" which is the sum of wave quality, surf quality and barrel count
-    df['session_value'] = (df[['wave_quality', 'surfing_quality', 'barrels_made']].sum(axis=1, skipna=True))
+    df['session_value'] = (df[['wave_quality', 'surfing_quality', 'barrels_made']].sum(axis=1, skipna=True).astype('float64'))
 
     # add in the seasons
     df['season'] = df['month'].apply(assign_season)
 
-    # add in a session_id which is a 3-digit number, restarting per year
+    # add in a session_id which is a number, restarting per year
     df['session_id'] = df.groupby('year').cumcount() + 1
-    df['session_id'] = df['session_id'].astype(str).str.zfill(3)
+
+    # store the string columns as categoricals and downcast the numeric columns
+    df = apply_session_schema(df, report_memory=report_memory)
 
     return df
 
@@ -0,0 +1,104 @@
+import os
+import json
+import hashlib
+import importlib
+import importlib.util
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from src.trace import traced, trace_events, add_trace_events
+
+# File (in the plot folder) that keeps the fingerprint of the inputs of each rendered plot
+RENDER_MANIFEST_FILE = 'render_manifest.json'
+
+# A plot to render:
+#   module, function: plot function, called as function(data, plot_folder=plot_folder, filename=filename)
+#   data: the (pre-computed) DataFrame the plot is made from
+#   filename: png file the plot is saved as in the plot folder
+PlotJob = namedtuple('PlotJob', ['module', 'function', 'data', 'filename'])
+
+
+# Function to fingerprint the style config (every public value in src.plot_setup)
+def style_fingerprint():
+    plot_setup = importlib.import_module('src.plot_setup')
+    style = {name: value for name, value in vars(plot_setup).items() if not name.startswith('_')}
+    return hashlib.sha256(json.dumps(style, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Function to fingerprint a plot job; its input data, the code of the plot module and the style config
+def job_fingerprint(job, style_hash):
+    sha = hashlib.sha256()
+    sha.update(json.dumps([job.module, job.function, style_hash]).encode())
+    sha.update(json.dumps([[str(col), str(dtype)] for col, dtype in job.data.dtypes.items()]).encode())
+    sha.update(pd.util.hash_pandas_object(job.data, index=True).to_numpy().tobytes())
+    with open(importlib.util.find_spec(job.module).origin, 'rb') as f:
+        sha.update(f.read())
+    return sha.hexdigest()
+
+
+# Function (run in a worker process) to render a single plot on the non-interactive Agg backend
+# Returns the trace events the plot recorded (the worker inherits the tracing of the parent when it is forked)
+def _render_job(module, function, data, plot_folder, filename):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    n_events = len(trace_events())
+    plot_function = getattr(importlib.import_module(module), function)
+    plot_function(data, plot_folder=plot_folder, filename=filename)
+    plt.close('all')
+    return trace_events()[n_events:]
+
+
+@traced('plot')
+def render_plots(plot_jobs, plot_folder, max_workers=None, force=False):
+    """
+    Render the plots in parallel, one process per plot, skipping the plots whose input data,
+    plot code and style config are the same as when the png in the plot folder was last rendered.
+    Arguments:
+        plot_jobs: list of PlotJobs
+        plot_folder: folder the plots are saved in
+        max_workers: number of worker processes (default: one per plot, up to the number of cpus)
+        force: render every plot, even if its inputs did not change
+    Returns:
+        list of the file names that were rendered
+    """
+    os.makedirs(plot_folder, exist_ok=True)
+    manifest_path = os.path.join(plot_folder, RENDER_MANIFEST_FILE)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    style_hash = style_fingerprint()
+    to_render = {}
+    for job in plot_jobs:
+        fingerprint = job_fingerprint(job, style_hash)
+        if (force or manifest.get(job.filename) != fingerprint
+                or not os.path.exists(os.path.join(plot_folder, job.filename))):
+            to_render[job.filename] = (job, fingerprint)
+        else:
+            print(f"Plot {job.filename} is up to date")
+
+    if not to_render:
+        return []
+
+    rendered = []
+    max_workers = max_workers or min(len(to_render), os.cpu_count() or 1)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_render_job, job.module, job.function, job.data, plot_folder, filename): filename
+                       for filename, (job, fingerprint) in to_render.items()}
+            for future in as_completed(futures):
+                filename = futures[future]
+                add_trace_events(future.result())
+                manifest[filename] = to_render[filename][1]
+                rendered.append(filename)
+    finally:
+        # keep the fingerprints of the plots that did render, even if another one failed
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=4)
+
+    return rendered
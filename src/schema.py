@@ -0,0 +1,218 @@
+import hashlib
+from collections import namedtuple
+from itertools import zip_longest
+
+import numpy as np
+import pandas as pd
+
+from src.utils import assign_season, to_snake_case
+from src.trace import traced
+
+# File with the subregion -> region map (the regions are a level above the subregions in the sheet)
+REGION_MAP_FILE = 'input/region_map.csv'
+
+# Categories with a natural order; any other values that show up in the data are added (sorted) after these.
+# All other categories are sorted, so grouping on them gives the same order as grouping on the strings.
+SEASON_ORDER = [assign_season(month) for month in [12, 3, 6, 9]] + ['Unknown']
+WHEN_ORDER = ['morning', 'midday', 'afternoon', 'evening', 'night']
+
+# Columns of the processed session DataFrame that are stored as categoricals
+CATEGORY_COLS = ['spot', 'subregion', 'region', 'board', 'wetty', 'when', 'season', 'subregion_spot']
+
+# Numeric columns of the processed session DataFrame, and the (smallest) dtype they are stored as
+NUMERIC_DTYPES = {'year': 'int16',
+                  'month': 'int8',
+                  'day': 'int8',
+                  'hrs': 'float32',
+                  'wave_quality': 'Int8',
+                  'surfing_quality': 'Int8',
+                  'barrels_made': 'Int16',
+                  'session_id': 'int16'}
+
+
+# Tokens that are treated as an empty cell
+NA_TOKENS = ['', ' ', 'NA', 'N/A', 'n/a', 'na']
+
+# Definition of a column in the sheet:
+#   name: snake case column name
+#   dtype: dtype it is decoded to (numbers only, strings are kept as objects until the session schema is applied)
+#   na_tokens: values that are treated as NA
+#   parser: 'number', 'string' or 'auto' (number if every value is a number, otherwise string)
+ColumnSpec = namedtuple('ColumnSpec', ['name', 'dtype', 'na_tokens', 'parser'])
+
+# Columns of the year sheets, in the order they show up in the sheet
+SESSION_COLUMNS = [ColumnSpec('year', NUMERIC_DTYPES['year'], NA_TOKENS, 'number'),
+                   ColumnSpec('month', NUMERIC_DTYPES['month'], NA_TOKENS, 'number'),
+                   ColumnSpec('day', NUMERIC_DTYPES['day'], NA_TOKENS, 'number'),
+                   ColumnSpec('spot', 'object', NA_TOKENS, 'string'),
+                   ColumnSpec('region', 'object', NA_TOKENS, 'string'),
+                   ColumnSpec('hrs', NUMERIC_DTYPES['hrs'], NA_TOKENS, 'number'),
+                   ColumnSpec('board', 'object', NA_TOKENS, 'string'),
+                   ColumnSpec('wetty', 'object', NA_TOKENS, 'string'),
+                   ColumnSpec('when', 'object', NA_TOKENS, 'string'),
+                   ColumnSpec('wave_height', 'object', NA_TOKENS, 'string'),
+                   ColumnSpec('wave_quality', NUMERIC_DTYPES['wave_quality'], NA_TOKENS, 'number'),
+                   ColumnSpec('surfing_quality', NUMERIC_DTYPES['surfing_quality'], NA_TOKENS, 'number'),
+                   ColumnSpec('barrels_made', NUMERIC_DTYPES['barrels_made'], NA_TOKENS, 'number'),
+                   ColumnSpec('people', 'object', NA_TOKENS, 'string'),
+                   ColumnSpec('notes', 'object', NA_TOKENS, 'string'),
+                   ColumnSpec('visuals', 'object', NA_TOKENS, 'string'),
+                   ColumnSpec('buoy_data', 'object', NA_TOKENS, 'string')]
+
+# any column that is not in the schema
+DEFAULT_COLUMN = ColumnSpec(None, None, NA_TOKENS, 'auto')
+
+
+# Function to fingerprint the region map (its content), so the sessions processed with it are rebuilt when it changes
+def region_map_fingerprint(region_map_file=REGION_MAP_FILE):
+    with open(region_map_file, 'rb') as f:
+        return {region_map_file: hashlib.sha256(f.read()).hexdigest()}
+
+
+# Build the (stable) category dictionaries for the processed session DataFrame
+def session_categories(region_map_file=REGION_MAP_FILE):
+    region_map = pd.read_csv(region_map_file)
+    return {'subregion': list(region_map['subregion'].unique()),
+            'region': list(region_map['region'].unique()) + ['Other'],
+            'season': SEASON_ORDER,
+            'when': WHEN_ORDER}
+
+
+# Convert a column to a categorical, with the known categories plus any unseen values in the column
+def to_category(series, categories=(), natural_order=False):
+    categories = list(categories)
+    extra = set(series.dropna().unique()) - set(categories)
+    if natural_order:
+        categories = categories + sorted(extra, key=str)
+    else:
+        categories = sorted(set(categories) | extra, key=str)
+    return pd.Categorical(series, categories=categories)
+
+
+# Downcast a numeric column; columns that are not whole numbers (e.g. half points) are kept as float32
+def to_small_numeric(series, dtype):
+    series = pd.to_numeric(series, errors='coerce')
+    if dtype.lower().startswith('int'):
+        values = series.dropna().to_numpy(dtype=np.float64)
+        if not np.array_equal(values, np.round(values)):
+            return series.astype('float32')
+        # don't downcast if the values don't fit (e.g. session ids of a very large synthetic log)
+        if len(values) and (values.min() < np.iinfo(dtype.lower()).min or values.max() > np.iinfo(dtype.lower()).max):
+            dtype = 'int64'
+        if series.isna().any():
+            # numpy ints can't hold NA, use the nullable version of the dtype (e.g. 'int16' -> 'Int16')
+            dtype = dtype.capitalize()
+    return series.astype(dtype)
+
+
+@traced('process')
+def apply_session_schema(df, region_map_file=REGION_MAP_FILE, report_memory=False):
+    """
+    Store the processed session DataFrame in a compact form:
+      - the string columns become categoricals with stable category dictionaries
+        (regions/subregions from the region map, seasons from assign_season, time of day in its natural order)
+      - the numeric columns are downcast (e.g. hrs to float32, wave quality / barrels to small nullable ints)
+    Arguments:
+        df: processed session DataFrame
+        region_map_file: csv file with the subregion -> region map
+        report_memory: print the memory usage (deep) before and after
+    """
+    memory_before = df.memory_usage(deep=True).sum()
+    known_categories = session_categories(region_map_file)
+
+    for col in CATEGORY_COLS:
+        if col in df.columns:
+            df[col] = to_category(df[col],
+                                  known_categories.get(col, ()),
+                                  natural_order=col in ['season', 'when'])
+
+    for col, dtype in NUMERIC_DTYPES.items():
+        if col in df.columns:
+            df[col] = to_small_numeric(df[col], dtype)
+
+    if report_memory:
+        memory_after = df.memory_usage(deep=True).sum()
+        print(f'Session DataFrame memory: {memory_before / 1e6:.2f} MB -> {memory_after / 1e6:.2f} MB '
+              f'({memory_before / memory_after:.1f}x smaller)')
+
+    return df
+
+
+# Decode a single column (raw cell values) into a typed Series, following the column spec
+def decode_column(values, spec=DEFAULT_COLUMN):
+    series = pd.Series(values, dtype=object)
+    is_na = series.isna() | series.isin(spec.na_tokens)
+    series = series.where(~is_na, pd.NA)
+
+    if spec.parser == 'string':
+        return series
+
+    numbers = pd.to_numeric(series, errors='coerce')
+    n_not_numeric = (~is_na).sum() - numbers.notna().sum()
+    if spec.parser == 'auto':
+        # numeric only if every (non-NA) value is a number
+        return series if n_not_numeric else numbers
+    if n_not_numeric:
+        print(f'Column "{spec.name}": {n_not_numeric} values are not numbers and are set to NA')
+    return to_small_numeric(numbers, spec.dtype)
+
+
+def decode_values(values, schema=SESSION_COLUMNS):
+    """
+    Decode the values of a sheet (header row + rows of cells, as returned by the Sheets API)
+    straight into a typed DataFrame, one column at a time.
+    Arguments:
+        values: list of rows, the first row being the header
+        schema: list of ColumnSpecs, columns that are not in it are decoded with the 'auto' parser
+    """
+    headers = list(values[0])
+    rows = values[1:]
+    # rows can be longer than the header (extra columns get a default name) or shorter (trailing empty cells)
+    n_columns = max([len(headers)] + [len(row) for row in rows])
+    headers += [f'column_{i + 1}' for i in range(len(headers), n_columns)]
+    headers = [to_snake_case(col) for col in headers]
+
+    specs = {spec.name: spec for spec in schema}
+    # transpose the rows into columns, padding the short rows (and the header columns no row reaches)
+    columns = list(zip_longest(*rows, fillvalue=None))
+    columns += [(None,) * len(rows)] * (n_columns - len(columns))
+    data = {i: decode_column(column, specs.get(header, DEFAULT_COLUMN))
+            for i, (header, column) in enumerate(zip(headers, columns))}
+    df = pd.DataFrame(data)
+    df.columns = headers
+    return df
+
+
+# Decode the columns of an already built DataFrame (e.g. an older all-string snapshot), skipping typed columns
+def decode_frame(df, schema=SESSION_COLUMNS):
+    specs = {spec.name: spec for spec in schema}
+    # (the decoded columns get the frame's index back, e.g. for the chunks of a streamed log)
+    data = {i: (decode_column(df.iloc[:, i].to_numpy(), specs.get(col, DEFAULT_COLUMN)).set_axis(df.index)
+                if df.iloc[:, i].dtype == object else df.iloc[:, i])
+            for i, col in enumerate(df.columns)}
+    decoded = pd.DataFrame(data, index=df.index)
+    decoded.columns = df.columns
+    return decoded
+
+
+def reconcile_columns(dfs, schema=SESSION_COLUMNS):
+    """
+    Give every DataFrame the same columns (union, in order of appearance) and the same dtypes,
+    adding the missing columns as typed NAs, so they can be concatenated without type changes.
+    """
+    columns = list(dict.fromkeys(col for df in dfs for col in df.columns))
+    specs = {spec.name: spec for spec in schema}
+
+    reconciled = []
+    for df in dfs:
+        missing = [col for col in columns if col not in df.columns]
+        if missing:
+            df = df.copy()
+            for col in missing:
+                spec = specs.get(col)
+                dtype = spec.dtype if spec is not None and spec.parser == 'number' else 'object'
+                # numpy ints can't hold NA (e.g. 'int16' -> 'Int16')
+                df[col] = pd.Series(pd.NA, index=df.index, dtype=dtype.capitalize() if dtype.startswith('int') else dtype)
+            df = df[columns]
+        reconciled.append(df)
+    return reconciled
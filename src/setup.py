@@ -1,12 +1,26 @@
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
 
 from src.utils import to_snake_case
+from src.trace import traced
+from src.schema import decode_values, decode_frame, reconcile_columns
+from src.snapshot import (SNAPSHOT_FOLDER, read_manifest, save_snapshot, load_snapshot,
+                          tab_hashes, save_frame, load_frame)
+
+# HTTP status codes for quota (429) and transient server errors, which are retried with a backoff
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
 
 # Authenticate and build the service
+# (the google client is imported here, so runs against the local snapshot don't pay for importing it)
 def auth_gsheet(sheet_access_key,
                 scope = ['https://www.googleapis.com/auth/spreadsheets']):
+    from google.oauth2.service_account import Credentials
+    from googleapiclient.discovery import build
+
     creds = Credentials.from_service_account_file(sheet_access_key, scopes=scope)
     service = build('sheets', 'v4', credentials=creds)
     return service
@@ -14,21 +28,67 @@ def auth_gsheet(sheet_access_key,
 
 # Function to get all sheet names
 def get_sheet_names(sheet_url, service):
-    spreadsheet = service.spreadsheets().get(spreadsheetId=sheet_url).execute()
+    spreadsheet = execute_with_backoff(service.spreadsheets().get(spreadsheetId=sheet_url))
     sheets = spreadsheet.get('sheets', [])
     return [sheet['properties']['title'] for sheet in sheets]
 
 
-# Function to connect to a specific sheet and get data
-def connect_to_sheet(sheet_name, sheet_url, service):
-    range_name = f'{sheet_name}!A:Z'  # Adjust range as needed
-    sheet = service.spreadsheets()
-    result = sheet.values().get(spreadsheetId=sheet_url, range=range_name).execute()
-    values = result.get('values', [])
+# Function to get the HTTP status of an API error (None if the error did not come from the API)
+# (read off the response, so a fake service can raise its own errors without the google client installed)
+def error_status(error):
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+# Check if an API error is a quota / transient server error that is worth retrying
+def is_retryable_error(error):
+    return error_status(error) in RETRYABLE_STATUS_CODES
+
+
+# Check if an API error is a request the API rejected (e.g. a bad range), which retrying would not change
+def is_rejected_request(error):
+    status = error_status(error)
+    return status is not None and status not in RETRYABLE_STATUS_CODES
+
+
+# Execute a google API request, backing off exponentially (with jitter) on quota errors
+def execute_with_backoff(request, max_retries=5, base_delay=1.0):
+    for attempt in range(max_retries + 1):
+        try:
+            return request.execute()
+        except Exception as error:
+            if attempt == max_retries or not is_retryable_error(error):
+                raise
+            delay = base_delay * 2 ** attempt + random.uniform(0, base_delay)
+            print(f'Sheets API quota/server error, retrying in {delay:.1f}s (attempt {attempt + 1} of {max_retries})')
+            time.sleep(delay)
+
 
+# Build the A1 range for a sheet (quoted, so names like '2017' or 'My Boards' are read as sheet names)
+def sheet_range(sheet_name, columns='A:Z'):
+    return "'" + sheet_name.replace("'", "''") + "'!" + columns
+
+
+# Function to build a DataFrame from rows of different lengths (sheets drop trailing empty cells)
+def rows_to_df(rows, columns):
+    widest_row = max((len(row) for row in rows), default=0)
+    # pandas only pads the rows up to the widest row, so pad them when every row is shorter than the header
+    if rows and widest_row < len(columns):
+        rows = [row + [None] * (len(columns) - len(row)) for row in rows]
+    return pd.DataFrame(rows, columns=columns)
+
+
+# Function to turn the values of a sheet (list of rows) into a DataFrame
+# The year sheets are decoded straight into typed columns (see src.schema), the other sheets are kept as strings
+def values_to_df(values, sheet_name):
     # if there are values and headers, create a DataFrame with the data
-    if values and values[0]:
-        headers = values[0]
+    if values and values[0] and sheet_name.isdigit():
+        return decode_values(values)
+    elif values and values[0]:
+        headers = list(values[0])
         data = values[1:]
         if data:
             # Find the maximum number of columns across all data rows
@@ -38,26 +98,217 @@ def connect_to_sheet(sheet_name, sheet_url, service):
                 extra_columns = max_columns - len(headers)
                 default_headers = [f'column_{i + len(headers) + 1}' for i in range(extra_columns)]
                 headers.extend(default_headers)
-        df = pd.DataFrame(data, columns=headers)
+        df = rows_to_df(data, headers)
+        # change the column names to snake case
+        df.columns = [to_snake_case(col) for col in df.columns]
         return df
     else:
         print(f'Skipping import of "{sheet_name}" sheet. Either invalid header or missing values.')
         return None
 
+
+# Function to connect to a specific sheet and get data
+def connect_to_sheet(sheet_name, sheet_url, service):
+    sheet = service.spreadsheets()
+    result = execute_with_backoff(sheet.values().get(spreadsheetId=sheet_url, range=sheet_range(sheet_name)))
+    return values_to_df(result.get('values', []), sheet_name)
+
+
+# Function to get the data of all sheets in a single values().batchGet round trip
+def batch_get_sheets(sheet_names, sheet_url, service):
+    request = service.spreadsheets().values().batchGet(spreadsheetId=sheet_url,
+                                                       ranges=[sheet_range(name) for name in sheet_names])
+    result = execute_with_backoff(request)
+    # the value ranges are returned in the same order as the requested ranges
+    value_ranges = result.get('valueRanges', [])
+    return {name: values_to_df(value_range.get('values', []), name)
+            for name, value_range in zip(sheet_names, value_ranges)}
+
+
+# Function to get the data of all sheets with one request per sheet, using a bounded thread pool
+def fetch_sheets_concurrently(sheet_names, sheet_url, service_factory, max_workers=4):
+    # the google client (httplib2) is not thread safe, so every worker thread builds its own service
+    thread_data = threading.local()
+
+    def fetch(sheet_name):
+        if not hasattr(thread_data, 'service'):
+            thread_data.service = service_factory()
+        return connect_to_sheet(sheet_name, sheet_url, thread_data.service)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        dfs = list(executor.map(fetch, sheet_names))
+    return dict(zip(sheet_names, dfs))
+
+
 # Function to authenticate and load all sheets into a dictionary of DataFrames
-def load_gsheet(sheet_url, sheet_access_key):
-    service = auth_gsheet(sheet_access_key)
+@traced('ingest')
+def load_gsheet(sheet_url,
+                sheet_access_key,
+                service = None,
+                batch = True,
+                max_workers = 4,
+                service_factory = None):
+    """
+    Load every sheet of the google sheet into a dictionary of DataFrames (keyed by sheet name).
+    Arguments:
+        sheet_url: spreadsheet ID
+        sheet_access_key: path to the service account JSON file
+        service: an already built sheets service (e.g. a fake one when testing), built from the key if None;
+                 as it can't be shared between threads, the per-sheet requests are then made one at a time
+        batch: fetch all sheets with a single values().batchGet request
+        max_workers: number of concurrent per-sheet requests, if not batching (or the batch request is rejected)
+        service_factory: function that builds a sheets service, called once per worker thread (default: from the key)
+    """
+    if service is None:
+        service_factory = service_factory or (lambda: auth_gsheet(sheet_access_key))
+        service = service_factory()
+    elif service_factory is None:
+        service_factory = lambda: service
+        max_workers = 1
+
     sheet_names = get_sheet_names(sheet_url, service)
-    data_dict = {}
-    for sheet in sheet_names:
-        df = connect_to_sheet(sheet, sheet_url, service)
-        data_dict[sheet] = df
-        # change the column names to snake case
-        if df is not None:
-            df.columns = [to_snake_case(col) for col in df.columns]
+
+    if batch:
+        try:
+            return batch_get_sheets(sheet_names, sheet_url, service)
+        except Exception as error:
+            # a quota / server error was already retried (more requests would not help), anything else is a bug
+            if not is_rejected_request(error):
+                raise
+            print(f'Batched sheet request failed ({error}), falling back to one request per sheet.')
+
+    return fetch_sheets_concurrently(sheet_names, sheet_url, service_factory, max_workers=max_workers)
+
+
+# Function to load the sheets from the local snapshot, only going to the google sheet when asked to refresh
+@traced('ingest')
+def load_gsheet_snapshot(sheet_url,
+                         sheet_access_key,
+                         snapshot_folder = SNAPSHOT_FOLDER,
+                         refresh = False,
+                         delta = False,
+                         verify_frozen = False):
+    """
+    Load the surf data dictionary from the local snapshot (no network), or refresh it from the google sheet.
+    Arguments:
+        sheet_url: spreadsheet ID
+        sheet_access_key: path to the service account JSON file
+        snapshot_folder: folder where the local snapshot is stored
+        refresh: if True, fetch the google sheet and update the tabs whose content has changed
+        delta: if True (and refreshing), only fetch the rows appended since the last sync (see sync_gsheet)
+        verify_frozen: with delta, also re-check the past year tabs by their content hash (see sync_gsheet)
+    """
+    # use the snapshot, unless asked to refresh (or there is no snapshot yet)
+    has_snapshot = read_manifest(snapshot_folder) is not None
+    if not refresh and has_snapshot:
+        return load_snapshot(snapshot_folder)
+    if delta and has_snapshot:
+        return sync_gsheet(sheet_url, sheet_access_key, snapshot_folder, verify_frozen=verify_frozen)
+
+    data_dict = load_gsheet(sheet_url, sheet_access_key)
+    changed = save_snapshot(data_dict, snapshot_folder, sheet_url=sheet_url)
+    if changed:
+        print(f'Updated snapshot tabs: {", ".join(changed)}')
+    else:
+        print('Snapshot is up to date, no tabs changed.')
     return data_dict
 
 
+# Function to only fetch what changed since the last sync, rather than every tab
+@traced('ingest')
+def sync_gsheet(sheet_url,
+                sheet_access_key,
+                snapshot_folder = SNAPSHOT_FOLDER,
+                verify_frozen = False,
+                service = None):
+    """
+    Incrementally sync the local snapshot with the google sheet, in a single batchGet round trip:
+      - the latest year tab in the snapshot only has its new rows fetched (open-ended range below the last synced row)
+      - older year tabs are frozen and not fetched, unless verify_frozen is True (then re-checked by content hash)
+      - new tabs (e.g. a new year) and non-year tabs (e.g. Surfboards) are fetched in full
+    The new rows are also appended to the persisted raw entries frame (see load_raw_entries).
+    Note: edits to rows that were already synced are not picked up, use a full refresh for that.
+    Arguments:
+        sheet_url: spreadsheet ID
+        sheet_access_key: path to the service account JSON file
+        snapshot_folder: folder where the local snapshot is stored
+        verify_frozen: also fetch the past year tabs and compare their hashes
+        service: an already built sheets service, built from the key if None
+    """
+    manifest = read_manifest(snapshot_folder)
+    if service is None:
+        service = auth_gsheet(sheet_access_key)
+
+    sheet_names = get_sheet_names(sheet_url, service)
+    data_dict = load_snapshot(snapshot_folder)
+    old_sources = {name: tab_hash for name, tab_hash in tab_hashes(snapshot_folder).items() if name.isdigit()}
+
+    # the latest year tab in the snapshot is the one still being added to
+    synced_years = [name for name in sheet_names if name.isdigit() and manifest['tabs'].get(name)]
+    delta_sheet = max(synced_years, key=int) if synced_years else None
+
+    # every other tab is either frozen (past years) or fetched in full
+    full_sheets = [name for name in sheet_names
+                   if name != delta_sheet
+                   and (verify_frozen or not name.isdigit() or not manifest['tabs'].get(name))]
+
+    ranges = [sheet_range(name) for name in full_sheets]
+    if delta_sheet:
+        first_new_row = manifest['tabs'][delta_sheet]['n_rows'] + 2  # +1 for the header, +1 as sheets are 1-indexed
+        ranges += [sheet_range(delta_sheet, 'A1:Z1'), sheet_range(delta_sheet, f'A{first_new_row}:Z')]
+    request = service.spreadsheets().values().batchGet(spreadsheetId=sheet_url, ranges=ranges)
+    value_ranges = [value_range.get('values', []) for value_range in execute_with_backoff(request).get('valueRanges', [])]
+
+    fetched = {name: values_to_df(values, name) for name, values in zip(full_sheets, value_ranges)}
+
+    new_rows_df = None
+    if delta_sheet:
+        header_values, new_rows = value_ranges[-2], value_ranges[-1]
+        old_df = data_dict[delta_sheet]
+        header = [to_snake_case(col) for col in header_values[0]] if header_values else []
+        widest_row = max((len(row) for row in new_rows), default=0)
+        # the new rows can only be appended if the header (and so the column layout) did not change
+        if header == list(old_df.columns[:len(header)]) and widest_row <= len(old_df.columns):
+            new_rows_df = decode_frame(rows_to_df(new_rows, old_df.columns))
+            if len(new_rows_df):
+                fetched[delta_sheet] = pd.concat(reconcile_columns([old_df, new_rows_df]), ignore_index=True)
+        else:
+            print(f'Header of the "{delta_sheet}" sheet changed, fetching the whole sheet.')
+            fetched[delta_sheet] = connect_to_sheet(delta_sheet, sheet_url, service)
+
+    # keep the order of the sheets, and drop sheets that no longer exist
+    data_dict = {name: fetched[name] if name in fetched else data_dict.get(name) for name in sheet_names}
+    changed = save_snapshot(data_dict, snapshot_folder, sheet_url=sheet_url)
+
+    n_new_rows = 0 if new_rows_df is None else len(new_rows_df)
+    print(f'Synced {n_new_rows} new rows in "{delta_sheet}" and fetched {len(full_sheets)} other sheets. '
+          f'Updated snapshot tabs: {", ".join(changed) if changed else "none"}')
+
+    # append the new rows to the persisted raw entries, if that is all that changed
+    numeric_sheets = [name for name in data_dict if name.isdigit()]
+    if n_new_rows and [name for name in changed if name.isdigit()] == [delta_sheet] and numeric_sheets[-1] == delta_sheet:
+        raw_df = load_frame('raw_entries', old_sources, snapshot_folder)
+        if raw_df is not None:
+            new_sources = {name: tab_hash for name, tab_hash in tab_hashes(snapshot_folder).items() if name.isdigit()}
+            save_frame(pd.concat(reconcile_columns([raw_df, new_rows_df]), ignore_index=True), 'raw_entries', new_sources, snapshot_folder)
+
+    return data_dict
+
+
+# Function to get the concatenated entries, re-using the raw entries persisted in the snapshot when they are up to date
+# (surf_data_dict is expected to be the one loaded/synced through the snapshot)
+@traced('ingest')
+def load_raw_entries(surf_data_dict, snapshot_folder = SNAPSHOT_FOLDER):
+    sources = {name: tab_hash for name, tab_hash in tab_hashes(snapshot_folder).items() if name.isdigit()}
+    df = load_frame('raw_entries', sources, snapshot_folder) if sources else None
+    if df is None:
+        df = concatenate_entries(surf_data_dict)
+        if sources:
+            save_frame(df, 'raw_entries', sources, snapshot_folder)
+    return df
+
+
+@traced('ingest')
 def concatenate_entries(surf_data_dict):
     # Keep the sheets that have the data (i.e. labeled by the year)
     numeric_sheets = [sheet_name for sheet_name in surf_data_dict if sheet_name.isdigit()]
@@ -65,7 +316,7 @@ def concatenate_entries(surf_data_dict):
     # Create a list of dataframes from the dictionary, using only the numeric sheet names
     surf_data = [surf_data_dict[sheet_name] for sheet_name in numeric_sheets]
 
-    # Concatenate the dataframes, even if they don't have the same columns
-    df = pd.concat(surf_data, ignore_index=True)
+    # The sheets don't all have the same columns, so give them the same (typed) columns before concatenating
+    df = pd.concat(reconcile_columns(surf_data), ignore_index=True)
 
     return df
\ No newline at end of file
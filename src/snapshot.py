@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import hashlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from src.trace import traced
+
+# Default folder for the local snapshot of the google sheet
+SNAPSHOT_FOLDER = os.path.join('input', 'snapshot')
+MANIFEST_FILE = 'manifest.json'
+
+
+# Function to build a file-system safe file name for a sheet tab
+def tab_file_name(sheet_name):
+    return re.sub(r'[^0-9a-zA-Z_-]+', '_', sheet_name) + '.npz'
+
+
+# Function to hash the content (headers + values) of a sheet tab
+def hash_tab(df):
+    sha = hashlib.sha256()
+    sha.update(json.dumps([str(col) for col in df.columns]).encode())
+    sha.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return sha.hexdigest()
+
+
+# Function to read the snapshot manifest (None if there is no snapshot yet)
+def read_manifest(snapshot_folder=SNAPSHOT_FOLDER):
+    manifest_path = os.path.join(snapshot_folder, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+# Function to write the snapshot manifest
+def write_manifest(manifest, snapshot_folder=SNAPSHOT_FOLDER):
+    with open(os.path.join(snapshot_folder, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+# Convert a column into a (values, mask) pair of plain numpy arrays
+def _column_to_arrays(series):
+    mask = series.isna().to_numpy()
+    if isinstance(series.dtype, pd.CategoricalDtype) or series.dtype == object or pd.api.types.is_string_dtype(series):
+        # strings (and anything else stored as an object) are saved as fixed width unicode
+        values = series.astype(object).where(~mask, '').astype(str).to_numpy(dtype=str)
+    elif isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+        # nullable ints / floats / booleans; the mask keeps track of the NAs
+        values = series.to_numpy(dtype=series.dtype.numpy_dtype, na_value=0)
+    else:
+        values = series.to_numpy()
+    return values, mask
+
+
+# Convert a (values, mask) pair back into a column with its original dtype
+def _arrays_to_column(values, mask, dtype):
+    series = pd.Series(values)
+    if values.dtype.kind == 'U':
+        series = series.astype(object).where(~mask, None)
+        return series if dtype == 'object' else series.astype(dtype)
+    series = series.astype(dtype)
+    if mask.any():
+        series[mask] = pd.NA if isinstance(series.dtype, pd.api.extensions.ExtensionDtype) else np.nan
+    return series
+
+
+# Save a single tab as a columnar .npz file
+def _save_tab(df, file_path):
+    arrays = {}
+    for i, col in enumerate(df.columns):
+        arrays[f'values_{i}'], arrays[f'mask_{i}'] = _column_to_arrays(df[col])
+    np.savez(file_path, **arrays)
+
+
+# Load a single tab from a columnar .npz file
+def _load_tab(file_path, columns, dtypes):
+    with np.load(file_path, allow_pickle=False) as arrays:
+        data = {col: _arrays_to_column(arrays[f'values_{i}'], arrays[f'mask_{i}'], dtype)
+                for i, (col, dtype) in enumerate(zip(columns, dtypes))}
+    return pd.DataFrame(data, columns=columns)
+
+
+@traced('ingest')
+def save_snapshot(surf_data_dict, snapshot_folder=SNAPSHOT_FOLDER, sheet_url=None):
+    """
+    Save every tab of the surf_data_dict to a local columnar snapshot.
+    Only the tabs whose content hash changed (or are new) are re-written.
+    Arguments:
+        surf_data_dict: dictionary of DataFrames, keyed by sheet name (output of load_gsheet)
+        snapshot_folder: folder where the snapshot is stored
+        sheet_url: spreadsheet ID the data came from (recorded in the manifest)
+    Returns:
+        list of the sheet names that were (re-)written
+    """
+    os.makedirs(snapshot_folder, exist_ok=True)
+    old_manifest = read_manifest(snapshot_folder) or {}
+    old_tabs = old_manifest.get('tabs', {})
+
+    tabs = {}
+    changed = []
+    for sheet_name, df in surf_data_dict.items():
+        # tabs that were skipped on import are recorded, but have no file
+        if df is None:
+            tabs[sheet_name] = None
+            continue
+
+        tab_hash = hash_tab(df)
+        file_name = tab_file_name(sheet_name)
+        old_tab = old_tabs.get(sheet_name)
+        if (old_tab is None or old_tab['hash'] != tab_hash
+                or not os.path.exists(os.path.join(snapshot_folder, file_name))):
+            _save_tab(df, os.path.join(snapshot_folder, file_name))
+            changed.append(sheet_name)
+
+        tabs[sheet_name] = {'file': file_name,
+                            'hash': tab_hash,
+                            'n_rows': len(df),
+                            'columns': [str(col) for col in df.columns],
+                            'dtypes': [str(dtype) for dtype in df.dtypes]}
+
+    # remove the files of tabs that no longer exist in the sheet
+    for sheet_name, old_tab in old_tabs.items():
+        if old_tab and sheet_name not in tabs:
+            old_path = os.path.join(snapshot_folder, old_tab['file'])
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    manifest = {'sheet_url': sheet_url,
+                'updated': datetime.now().isoformat(timespec='seconds'),
+                'tabs': tabs,
+                'frames': old_manifest.get('frames', {})}
+    write_manifest(manifest, snapshot_folder)
+
+    return changed
+
+
+@traced('ingest')
+def load_snapshot(snapshot_folder=SNAPSHOT_FOLDER):
+    """
+    Load the local snapshot back into a dictionary of DataFrames (same contract as load_gsheet).
+    """
+    manifest = read_manifest(snapshot_folder)
+    if manifest is None:
+        raise FileNotFoundError(f'No snapshot found in "{snapshot_folder}". Run with refresh to fetch the google sheet.')
+
+    data_dict = {}
+    for sheet_name, tab in manifest['tabs'].items():
+        if tab is None:
+            data_dict[sheet_name] = None
+        else:
+            data_dict[sheet_name] = _load_tab(os.path.join(snapshot_folder, tab['file']),
+                                              tab['columns'],
+                                              tab['dtypes'])
+    return data_dict
+
+
+# Function to get the content hash of each tab in the snapshot
+def tab_hashes(snapshot_folder=SNAPSHOT_FOLDER):
+    manifest = read_manifest(snapshot_folder) or {}
+    return {sheet_name: tab['hash'] for sheet_name, tab in manifest.get('tabs', {}).items() if tab}
+
+
+def save_frame(df, frame_name, sources, snapshot_folder=SNAPSHOT_FOLDER):
+    """
+    Persist a derived frame (e.g. the concatenated raw entries) next to the snapshot tabs.
+    Arguments:
+        df: DataFrame to save
+        frame_name: name of the frame in the manifest
+        sources: dictionary of {sheet name: tab hash} the frame was built from
+        snapshot_folder: folder where the snapshot is stored
+    """
+    manifest = read_manifest(snapshot_folder)
+    if manifest is None:
+        raise FileNotFoundError(f'No snapshot found in "{snapshot_folder}" to add the "{frame_name}" frame to.')
+
+    file_name = f'frame_{tab_file_name(frame_name)}'
+    _save_tab(df, os.path.join(snapshot_folder, file_name))
+    manifest.setdefault('frames', {})[frame_name] = {'file': file_name,
+                                                     'n_rows': len(df),
+                                                     'columns': [str(col) for col in df.columns],
+                                                     'dtypes': [str(dtype) for dtype in df.dtypes],
+                                                     'sources': sources}
+    write_manifest(manifest, snapshot_folder)
+
+
+def load_frame(frame_name, sources=None, snapshot_folder=SNAPSHOT_FOLDER):
+    """
+    Load a derived frame from the snapshot.
+    Returns None if it does not exist, or (when sources are given) if it was built from different tab hashes.
+    """
+    frame = ((read_manifest(snapshot_folder) or {}).get('frames') or {}).get(frame_name)
+    if frame is None or (sources is not None and frame['sources'] != sources):
+        return None
+    file_path = os.path.join(snapshot_folder, frame['file'])
+    if not os.path.exists(file_path):
+        return None
+    return _load_tab(file_path, frame['columns'], frame['dtypes'])
@@ -0,0 +1,133 @@
+import os
+import glob
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from src.utils import to_snake_case
+from src.trace import traced
+from src.schema import decode_frame
+from src.snapshot import SNAPSHOT_FOLDER, MANIFEST_FILE, save_snapshot, load_snapshot
+
+# Every source returns the surf_data_dict contract of load_gsheet:
+#   {sheet name: DataFrame}, the year sheets decoded into typed, snake case columns (see src.schema),
+#   the other sheets (e.g. Surfboards) as strings with snake case columns
+
+# Optional libraries of the file formats (not in requirements.txt)
+OPTIONAL_DEPENDENCIES = {'xlsx': 'openpyxl', 'parquet': 'pyarrow'}
+
+
+# Function to check that the optional library of a format is installed, with a clear error if it isn't
+def require_dependency(kind):
+    module = OPTIONAL_DEPENDENCIES[kind]
+    if importlib.util.find_spec(module) is None:
+        raise ImportError(f'The "{kind}" source needs the {module} package, install it with `pip install {module}`')
+
+
+# Function to turn a sheet read as strings into the DataFrame load_gsheet returns for it
+def cells_to_df(df, sheet_name):
+    df.columns = [to_snake_case(str(col)) for col in df.columns]
+    # the year sheets are decoded into typed columns, empty cells become NA (as with the sheet values)
+    return decode_frame(df) if sheet_name.isdigit() else df
+
+
+def _read_csv_sheet(file_path):
+    return cells_to_df(pd.read_csv(file_path, dtype=str, keep_default_na=False),
+                       os.path.splitext(os.path.basename(file_path))[0])
+
+
+@traced('ingest')
+def load_csv_folder(folder, max_workers=4):
+    """
+    Load a folder with a csv file per sheet (e.g. 2019.csv, 2020.csv, Surfboards.csv), as exported from the google sheet.
+    The files are parsed in parallel (the pandas csv parser releases the GIL).
+    Arguments:
+        folder: folder with the csv files, named after their sheet
+        max_workers: number of files parsed at the same time
+    """
+    file_paths = sorted(glob.glob(os.path.join(folder, '*.csv')))
+    if not file_paths:
+        raise FileNotFoundError(f'No csv files found in "{folder}"')
+    sheet_names = [os.path.splitext(os.path.basename(file_path))[0] for file_path in file_paths]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(sheet_names, executor.map(_read_csv_sheet, file_paths)))
+
+
+@traced('ingest')
+def load_xlsx(file_path):
+    """
+    Load an .xlsx workbook (e.g. the google sheet downloaded as Microsoft Excel), one sheet per tab.
+    Needs openpyxl.
+    """
+    require_dependency('xlsx')
+    sheets = pd.read_excel(file_path, sheet_name=None, dtype=str, keep_default_na=False, engine='openpyxl')
+    return {str(sheet_name): cells_to_df(df, str(sheet_name)) for sheet_name, df in sheets.items()}
+
+
+@traced('ingest')
+def load_parquet_snapshot(folder):
+    """
+    Load a parquet snapshot (a .parquet file per sheet, named after it); the typed columns are kept as they are.
+    Needs pyarrow.
+    """
+    require_dependency('parquet')
+    file_paths = sorted(glob.glob(os.path.join(folder, '*.parquet')))
+    if not file_paths:
+        raise FileNotFoundError(f'No parquet files found in "{folder}"')
+    return {os.path.splitext(os.path.basename(file_path))[0]: pd.read_parquet(file_path, engine='pyarrow')
+            for file_path in file_paths}
+
+
+@traced('ingest')
+def load_gsheet_source(sheet_url, sheet_access_key=None):
+    from src.setup import load_gsheet
+    if sheet_access_key is None:
+        raise ValueError('The "gsheet" source needs a sheet_access_key (service account JSON file)')
+    return load_gsheet(sheet_url, sheet_access_key)
+
+
+# Sources by name: function of the location (and keyword options) returning a surf_data_dict
+SOURCES = {'gsheet': load_gsheet_source,
+           'csv': load_csv_folder,
+           'xlsx': load_xlsx,
+           'parquet': load_parquet_snapshot,
+           'snapshot': load_snapshot}
+
+
+def parse_source(source):
+    """
+    Parse a source given as 'kind:location' (e.g. 'csv:input/logbook'), or as a path whose kind is inferred:
+    an .xlsx file, a folder of .parquet or .csv files, or a snapshot folder (with a manifest).
+    Returns:
+        (kind, location)
+    """
+    kind, _, location = source.partition(':')
+    if location and kind in SOURCES:
+        return kind, location
+
+    if source.lower().endswith('.xlsx'):
+        return 'xlsx', source
+    if os.path.isdir(source):
+        if os.path.exists(os.path.join(source, MANIFEST_FILE)):
+            return 'snapshot', source
+        if glob.glob(os.path.join(source, '*.parquet')):
+            return 'parquet', source
+        if glob.glob(os.path.join(source, '*.csv')):
+            return 'csv', source
+    raise ValueError(f'Unknown source "{source}", use kind:location with a kind of {", ".join(SOURCES)}, '
+                     f'or the path of an .xlsx file or a folder of csv/parquet files')
+
+
+# Function to refresh the local snapshot from a source (rather than the google sheet), so the pipeline runs off it
+def load_source_snapshot(source, snapshot_folder=SNAPSHOT_FOLDER, **options):
+    kind, location = parse_source(source)
+    data_dict = SOURCES[kind](location, **options)
+    if kind == 'snapshot' and os.path.abspath(location) == os.path.abspath(snapshot_folder):
+        return data_dict
+    changed = save_snapshot(data_dict, snapshot_folder, sheet_url=f'{kind}:{location}')
+    if changed:
+        print(f'Updated snapshot tabs from {kind}:{location}: {", ".join(changed)}')
+    else:
+        print(f'Snapshot is up to date with {kind}:{location}, no tabs changed.')
+    return data_dict
@@ -0,0 +1,275 @@
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import CategoricalDtype, is_extension_array_dtype, is_float_dtype
+
+from src.trace import traced
+from src.process import process_surf_data
+from src.schema import NUMERIC_DTYPES, apply_session_schema, session_categories, to_category, to_small_numeric
+from analysis.summarise import (RANKED_KEYS, build_summary_cube, build_ranked_cube, rollup_ranked_cube,
+                                summary_grain, summaries_from_cube, ranked_summaries_from_cubes)
+
+# Default number of rows read (and processed) at a time
+STREAM_CHUNKSIZE = 50_000
+# Formats of the exported logs, by file extension
+EXPORT_FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+
+# Function to get the format of an exported log from its extension
+def export_format(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format "{extension}", use one of {", ".join(EXPORT_FORMATS)}')
+    return EXPORT_FORMATS[extension]
+
+
+def read_export(file_path, chunksize=None):
+    """
+    Read a log exported as CSV or NDJSON (one session per line), with the raw cells of the year sheets
+    (the same contract as the sheet values; the cells are decoded by process_surf_data).
+    Arguments:
+        file_path: .csv, .ndjson or .jsonl file
+        chunksize: number of rows per chunk; None to read the whole file at once
+    Returns:
+        DataFrame, or an iterator of DataFrames if chunksize is set
+    """
+    if export_format(file_path) == 'csv':
+        return pd.read_csv(file_path, dtype=str, keep_default_na=False, chunksize=chunksize)
+
+    def as_cells(df):
+        # json numbers are decoded like the string cells of the sheet
+        return df.astype(object).where(df.notna(), None)
+
+    reader = pd.read_json(file_path, lines=True, dtype=False, convert_dates=False, chunksize=chunksize)
+    return as_cells(reader) if chunksize is None else (as_cells(chunk) for chunk in reader)
+
+
+# Function to export the raw entries (e.g. load_raw_entries) as CSV or NDJSON
+# The sessions are written in date order (stable, like process_surf_data), so the export can be streamed
+def write_export(df, file_path):
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    date_cols = [col for col in ['year', 'month', 'day'] if col in df.columns]
+    if date_cols:
+        df = df.sort_values(date_cols, kind='stable', na_position='last',
+                            key=lambda col: pd.to_numeric(col, errors='coerce'))
+    if export_format(file_path) == 'csv':
+        df.to_csv(file_path, index=False)
+    else:
+        df.to_json(file_path, orient='records', lines=True)
+    print(f"Exported {len(df):,} sessions to {file_path}")
+
+
+# Function to number the sessions of a chunk per year, continuing from the sessions of the earlier chunks
+def _number_sessions(df, year_counts):
+    offsets = df['year'].map(year_counts).fillna(0).to_numpy(dtype=np.int64)
+    df['session_id'] = to_small_numeric(df.groupby('year').cumcount() + 1 + offsets, NUMERIC_DTYPES['session_id'])
+    return df, year_counts.add(df['year'].value_counts(), fill_value=0)
+
+
+# Function to concatenate processed frames, leaving out the empty frames, and the all-NA columns of a frame where
+# the frames don't agree on the dtype (pandas already ignores them when picking the dtype, but warns that it will stop)
+def _concat_sessions(dfs):
+    columns = list(dict.fromkeys(col for df in dfs for col in df.columns))
+    dfs = [df for df in dfs if not df.empty] or dfs[:1]
+    left_out = set()
+    for col in columns:
+        entries = {i: df[col] for i, df in enumerate(dfs) if col in df.columns}
+        dtypes = [entry.dtype for entry in entries.values()]
+        if any(dtype != dtypes[0] for dtype in dtypes) and any(entry.notna().any() for entry in entries.values()):
+            left_out.update((i, col) for i, entry in entries.items() if entry.isna().all())
+    dfs = [df[[col for col in df.columns if (i, col) not in left_out]] for i, df in enumerate(dfs)]
+    return pd.concat(dfs, ignore_index=True).reindex(columns=columns)
+
+
+def stream_sessions(chunks, rm_incomplete_yrs=False):
+    """
+    Process the raw chunks of a log one at a time, with the cleaning rules of process_surf_data.
+    The log is expected in the order it was logged (by date), as in the sheets; every chunk is sorted,
+    and the sessions of the last day of a chunk are held back until the next one, so a day is never split.
+    Together, the yielded chunks are exactly the rows (and session ids) of process_surf_data on the whole log.
+    Arguments:
+        chunks: iterable of raw DataFrames, e.g. read_export(file_path, chunksize)
+        rm_incomplete_yrs: see process_surf_data
+    Yields:
+        processed DataFrames, in date order
+    """
+    carry = None
+    undated = []
+    year_counts = pd.Series(dtype='float64')
+    for raw_chunk in chunks:
+        chunk = process_surf_data(raw_chunk, rm_incomplete_yrs=rm_incomplete_yrs)
+        # sessions without a date are sorted last
+        is_dated = chunk['date'].notna()
+        if not is_dated.all():
+            undated.append(chunk[~is_dated])
+            chunk = chunk[is_dated]
+        if chunk.empty:
+            continue
+        if carry is not None:
+            if chunk['date'].iloc[0] < carry['date'].iloc[0]:
+                raise ValueError(f"The log is not in date order ({chunk['date'].iloc[0]:%Y-%m-%d} comes after "
+                                 f"{carry['date'].iloc[0]:%Y-%m-%d}), it can't be streamed; use the in-memory path")
+            chunk = apply_session_schema(_concat_sessions([carry, chunk]))
+
+        is_last_day = (chunk['date'] == chunk['date'].iloc[-1]).to_numpy()
+        carry = chunk[is_last_day]
+        if not is_last_day.all():
+            ready, year_counts = _number_sessions(chunk[~is_last_day].reset_index(drop=True), year_counts)
+            yield ready
+
+    rest = ([carry] if carry is not None else []) + undated
+    if rest:
+        ready, year_counts = _number_sessions(apply_session_schema(_concat_sessions(rest)), year_counts)
+        yield ready
+
+
+# The dtype of a session column over all the chunks, following the rules of apply_session_schema
+def _combine_dtypes(col, dtype, other, known_categories):
+    if dtype == other:
+        return dtype
+    if isinstance(dtype, CategoricalDtype) and isinstance(other, CategoricalDtype):
+        values = pd.Series(list(dtype.categories) + list(other.categories), dtype=object)
+        categories = to_category(values, known_categories.get(col, ()), natural_order=col in ['season', 'when']).categories
+        return CategoricalDtype(categories)
+    # whole numbers in one chunk and not in another (float32), ids that only overflow in one chunk, NAs in one chunk
+    if is_float_dtype(dtype) or is_float_dtype(other):
+        return np.dtype('float32')
+    bits = 8 * max(dtype.itemsize, other.itemsize)
+    nullable = is_extension_array_dtype(dtype) or is_extension_array_dtype(other)
+    return pd.api.types.pandas_dtype(f"{'I' if nullable else 'i'}nt{bits}")
+
+
+class StreamingSummaries:
+    """
+    Running aggregators for the simple and ranked summaries, fed one processed chunk at a time (see stream_sessions).
+    Only the aggregates are kept (the summary and ranked cubes, plus the top n sessions per year),
+    so memory is bounded by the chunk size and the number of cells, not by the length of the log.
+    The results are the same as create_simple_summaries and create_ranked_summaries on the whole log.
+    Arguments:
+        group_cols_list: see create_simple_summaries
+        top_n: see create_ranked_summaries
+    """
+
+    def __init__(self, group_cols_list=(None, ['year'], ['year', 'month', 'season']), top_n=5):
+        self.group_cols_list = list(group_cols_list)
+        self.grain = summary_grain(self.group_cols_list)
+        self.top_n = top_n
+        self.known_categories = session_categories()
+        self.dtypes = None
+        self.cube = None
+        self.ranked_cube = None
+        # rows (and session rows of the ranked cube) of the earlier chunks, to number the rows of the next one
+        self.n_rows = 0
+        self.n_session_rows = 0
+
+    # Function to cast the category columns of an aggregate to the categories of every chunk so far
+    # (so concatenated aggregates group in the same order as the whole log would)
+    def _unify(self, df, value_col=None):
+        for col in df.columns:
+            dtype = self.dtypes.get(value_col if col == 'value' else col)
+            if isinstance(dtype, CategoricalDtype) and df[col].dtype != dtype:
+                df[col] = df[col].astype(object).astype(dtype)
+        return df
+
+    # Function to keep the top sessions per year (ties go to the session that comes first, as in select_top_n)
+    # One more than the top n is kept: nlargest only breaks ties by position when there are more than n rows
+    def _top_sessions(self, sessions):
+        session_value = sessions['session_value_sum'] / sessions['session_value_count']
+        top_index = session_value.groupby(sessions['year']).nlargest(self.top_n + 1).index.get_level_values(-1)
+        return sessions.loc[np.sort(top_index)]
+
+    def update(self, df):
+        # keep track of the dtypes the whole log would have
+        if self.dtypes is None:
+            self.dtypes = dict(df.dtypes)
+        else:
+            self.dtypes = {col: _combine_dtypes(col, self.dtypes[col], dtype, self.known_categories)
+                           for col, dtype in df.dtypes.items()}
+
+        cube = build_summary_cube(df, self.grain)
+        for freq in cube['freqs'].values():
+            freq['first_row'] += self.n_rows
+        ranked_cube = build_ranked_cube(df)
+        # the sessions of a chunk are a contiguous slice of the sessions of the whole log
+        ranked_cube['sessions'].index += self.n_session_rows
+        self.n_rows += len(df)
+        self.n_session_rows += len(ranked_cube['sessions'])
+
+        if self.cube is None:
+            self.cube = cube
+            self.ranked_cube = dict(ranked_cube, sessions=self._top_sessions(ranked_cube['sessions']))
+            return self
+
+        grain = cube['grain']
+        totals = self._unify(pd.concat([self.cube['totals'].reset_index(), cube['totals'].reset_index()]))
+        self.cube['totals'] = totals.groupby(grain, observed=True).sum()
+        for col, freq in cube['freqs'].items():
+            freq = self._unify(pd.concat([self.cube['freqs'][col], freq], ignore_index=True), value_col=col)
+            self.cube['freqs'][col] = (freq
+                                       .groupby(grain + ['value'], observed=True)
+                                       .agg(count=('count', 'sum'),
+                                            first_row=('first_row', 'min'))
+                                       .reset_index())
+
+        for key in ['spots', 'boards']:
+            table = self._unify(pd.concat([self.ranked_cube[key], ranked_cube[key]], ignore_index=True))
+            self.ranked_cube[key] = table.groupby(['year'] + RANKED_KEYS[key], as_index=False, observed=True).sum()
+        sessions = self._unify(pd.concat([self.ranked_cube['sessions'], ranked_cube['sessions']]))
+        self.ranked_cube['sessions'] = self._top_sessions(sessions)
+        return self
+
+    # Function to cast the aggregates to the dtypes they have when the whole log is aggregated at once
+    def _final_cubes(self):
+        empty_df = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in self.dtypes.items()})
+        summary_template = build_summary_cube(empty_df, self.grain)
+        ranked_template = build_ranked_cube(empty_df)
+
+        grain = summary_template['grain']
+        totals = self.cube['totals'].reset_index()
+        cube = {'grain': grain,
+                'totals': totals.astype(summary_template['totals'].reset_index().dtypes).set_index(grain),
+                'freqs': {col: freq.astype(summary_template['freqs'][col].dtypes)
+                          for col, freq in self.cube['freqs'].items()}}
+        ranked_cube = {key: table.astype(ranked_template[key].dtypes) for key, table in self.ranked_cube.items()}
+        return cube, ranked_cube
+
+    def results(self):
+        """
+        Returns:
+            (simple summaries (see create_simple_summaries), ranked summaries (see create_ranked_summaries))
+        """
+        if self.cube is None:
+            raise ValueError('No sessions were streamed')
+        cube, cube_by_year = self._final_cubes()
+
+        # the top sessions of all years are among the top sessions of their year; their index is already
+        # their position in the sessions of the whole log (as after the roll up)
+        cube_all = dict(rollup_ranked_cube({key: cube_by_year[key] for key in ['spots', 'boards']}),
+                        sessions=cube_by_year['sessions'].drop(columns='year'))
+        return (summaries_from_cube(cube, self.group_cols_list),
+                ranked_summaries_from_cubes(cube_all, cube_by_year, top_n=self.top_n))
+
+
+@traced('summarise')
+def stream_summaries(file_path,
+                     chunksize=STREAM_CHUNKSIZE,
+                     group_cols_list=(None, ['year'], ['year', 'month', 'season']),
+                     top_n=5,
+                     rm_incomplete_yrs=False):
+    """
+    Build the simple and ranked summaries of an exported log (see read_export) in chunks,
+    so peak memory depends on the chunk size rather than on the length of the log.
+    Arguments:
+        file_path: .csv, .ndjson or .jsonl export of the year sheets
+        chunksize: number of rows read and processed at a time
+        group_cols_list: see create_simple_summaries
+        top_n: see create_ranked_summaries
+        rm_incomplete_yrs: see process_surf_data
+    Returns:
+        (simple summaries, (ranked summary over all years, ranked summary by year)), as the in-memory path
+    """
+    summaries = StreamingSummaries(group_cols_list, top_n=top_n)
+    for df in stream_sessions(read_export(file_path, chunksize=chunksize), rm_incomplete_yrs=rm_incomplete_yrs):
+        summaries.update(df)
+    return summaries.results()
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+from src.schema import REGION_MAP_FILE, SESSION_COLUMNS
+
+# Subregions that are not in the region map (they end up in the 'Other' region), e.g. surf trips
+TRIP_SUBREGIONS = ['Bali', 'Madagascar', 'Portugal', 'Costa Rica']
+
+# Vocabularies of the (string) cells of the year sheets, and how often each value is logged
+HRS_VALUES = (['0.5', '0.75', '1', '1.25', '1.5', '1.75', '2', '2.5', '3', '4'],
+              [0.04, 0.08, 0.2, 0.14, 0.2, 0.1, 0.12, 0.07, 0.04, 0.01])
+WETTY_VALUES = (['4/3', '3/2', '5/4 hooded', 'springsuit', 'trunks', ''],
+                [0.45, 0.3, 0.05, 0.08, 0.07, 0.05])
+WHEN_VALUES = (['morning', 'midday', 'afternoon', 'evening', 'night', ''],
+               [0.45, 0.15, 0.15, 0.2, 0.01, 0.04])
+# single values, ranges, lists, decimals, pluses, blanks and the odd non-number
+WAVE_HEIGHT_VALUES = (['1', '2', '3', '4', '5', '6', '8', '1-2', '2-3', '3-4', '3-5', '4-6', '6-8', '8-10', '10-12',
+                       '2,4', '3,5', '2.5', '3.5', '6+', '4-5+', '', 'flat'],
+                      [0.03, 0.07, 0.1, 0.09, 0.05, 0.04, 0.02, 0.05, 0.09, 0.09, 0.07, 0.06, 0.03, 0.01, 0.005,
+                       0.02, 0.02, 0.03, 0.02, 0.02, 0.015, 0.04, 0.02])
+QUALITY_VALUES = ([str(i) for i in range(1, 11)] + [''],
+                  [0.02, 0.04, 0.08, 0.12, 0.17, 0.19, 0.17, 0.11, 0.05, 0.02, 0.03])
+BARREL_VALUES = (['0', '1', '2', '3', '4', '5', '8', ''],
+                 [0.55, 0.15, 0.1, 0.07, 0.04, 0.03, 0.01, 0.05])
+PEOPLE_VALUES = (['', 'solo', 'Alex', 'Sam, Jo', 'the crew'], [0.3, 0.3, 0.2, 0.1, 0.1])
+NOTES_VALUES = (['', 'fun', 'crowded', 'glassy', 'windy', 'best session of the year'], [0.4, 0.2, 0.1, 0.15, 0.14, 0.01])
+BOARD_STATES = (['have', 'sold', 'broken', 'gave away'], [0.4, 0.3, 0.15, 0.15])
+
+# Share of rows that stop after the barrels column (the sheet API drops trailing empty cells)
+SHORT_ROW_SHARE = 0.1
+
+
+# Draw n values from a (values, probabilities) vocabulary, as an object array of (shared) strings
+def _draw(rng, vocabulary, n):
+    values, probabilities = vocabulary
+    probabilities = np.asarray(probabilities) / np.sum(probabilities)
+    return np.array(values, dtype=object)[rng.choice(len(values), size=n, p=probabilities)]
+
+
+# Popularity of n items, from a zipf-like distribution (a few favourites, a long tail)
+def _popularity(n, skew=1.1):
+    weights = 1 / np.arange(1, n + 1) ** skew
+    return weights / weights.sum()
+
+
+def synthetic_surf_data_dict(n_sessions,
+                             start_year=2017,
+                             n_years=9,
+                             n_spots_per_subregion=8,
+                             n_boards=20,
+                             seed=0,
+                             region_map_file=REGION_MAP_FILE):
+    """
+    Generate a realistic (but made up) surf_data_dict, with the same contract as load_gsheet before decoding:
+      - a year tab per year, with string cells (blanks, messy wave heights, short rows, ...)
+      - a Surfboards tab (board, gone, when_gone)
+    The output only depends on the arguments (the seed), so benchmarks can be repeated.
+    Arguments:
+        n_sessions: total number of sessions (spread evenly over the years), e.g. 1e3 to 1e7
+        start_year: first year of the logbook
+        n_years: number of years (and year tabs)
+        n_spots_per_subregion: number of spots in every subregion
+        n_boards: number of surfboards (a few of them are not in the Surfboards tab)
+        seed: seed of the random generator
+        region_map_file: csv with the subregions (and their regions) to draw from
+    """
+    rng = np.random.default_rng(seed)
+    n_sessions = int(n_sessions)
+
+    # spots, in subregions from the region map plus a few trips
+    subregions = list(pd.read_csv(region_map_file)['subregion'].unique()) + TRIP_SUBREGIONS
+    spots = np.array([f'{subregion} Spot {i + 1}' for subregion in subregions for i in range(n_spots_per_subregion)],
+                     dtype=object)
+    spot_subregions = np.repeat(np.array(subregions, dtype=object), n_spots_per_subregion)
+    # a home break gets most of the sessions
+    spot_codes = rng.choice(len(spots), size=n_sessions, p=_popularity(len(spots))[rng.permutation(len(spots))])
+
+    # dates; every year has the same number of sessions, in the order they were logged (by date)
+    years = np.repeat(np.arange(start_year, start_year + n_years), -(-n_sessions // n_years))[:n_sessions]
+    year_start = pd.to_datetime(years.astype(str), format='%Y').to_numpy()
+    days_in_year = np.where(pd.to_datetime(years.astype(str), format='%Y').is_leap_year, 366, 365)
+    day_of_year = (rng.random(n_sessions) * days_in_year).astype(np.int64)
+    dates = pd.DatetimeIndex(np.sort(year_start + day_of_year.astype('timedelta64[D]')))
+
+    boards = np.array([f'Board {i + 1}' for i in range(n_boards)], dtype=object)
+    # a board is surfed for a couple of years, so pick it from the boards around the session's position in the log
+    board_position = np.arange(n_sessions) / max(n_sessions - 1, 1) * (n_boards - 1)
+    board_codes = np.clip(np.round(board_position + rng.normal(0, 2, n_sessions)), 0, n_boards - 1).astype(np.int64)
+
+    numbers = np.array([str(i) for i in range(max(start_year + n_years, 32))], dtype=object)
+    columns = {'year': numbers[dates.year],
+               'month': numbers[dates.month],
+               'day': numbers[dates.day],
+               'spot': spots[spot_codes],
+               'region': spot_subregions[spot_codes],
+               'hrs': _draw(rng, HRS_VALUES, n_sessions),
+               'board': boards[board_codes],
+               'wetty': _draw(rng, WETTY_VALUES, n_sessions),
+               'when': _draw(rng, WHEN_VALUES, n_sessions),
+               'wave_height': _draw(rng, WAVE_HEIGHT_VALUES, n_sessions),
+               'wave_quality': _draw(rng, QUALITY_VALUES, n_sessions),
+               'surfing_quality': _draw(rng, QUALITY_VALUES, n_sessions),
+               # barrels were only logged from the fifth year on
+               'barrels_made': np.where(dates.year >= start_year + 4, _draw(rng, BARREL_VALUES, n_sessions), ''),
+               'people': _draw(rng, PEOPLE_VALUES, n_sessions),
+               'notes': _draw(rng, NOTES_VALUES, n_sessions),
+               'visuals': np.full(n_sessions, '', dtype=object),
+               'buoy_data': np.full(n_sessions, '', dtype=object)}
+
+    # short rows; the cells after the barrels column are missing
+    short_rows = rng.random(n_sessions) < SHORT_ROW_SHARE
+    for col in ['people', 'notes', 'visuals', 'buoy_data']:
+        columns[col] = np.where(short_rows, None, columns[col])
+
+    session_df = pd.DataFrame(columns, columns=[spec.name for spec in SESSION_COLUMNS])
+    year_bounds = np.searchsorted(dates.year, np.arange(start_year, start_year + n_years + 1))
+    surf_data_dict = {str(start_year + i): session_df.iloc[year_bounds[i]:year_bounds[i + 1]].reset_index(drop=True)
+                      for i in range(n_years)}
+
+    # surfboards; the last few boards were never added to the Surfboards tab
+    n_listed_boards = max(n_boards - 2, 1)
+    gone = _draw(rng, BOARD_STATES, n_listed_boards)
+    gone_year = rng.integers(start_year + 1, start_year + n_years + 1, n_listed_boards)
+    when_gone = [f'{year}{rng.integers(1, 13):02d}{rng.integers(1, 29):02d}' if state != 'have' else ''
+                 for state, year in zip(gone, gone_year)]
+    surf_data_dict['Surfboards'] = pd.DataFrame({'board': boards[:n_listed_boards],
+                                                 'gone': gone,
+                                                 'when_gone': when_gone})
+    return surf_data_dict
+
+
+# Convert a surf_data_dict into the values of the sheets (header + rows of cells, as returned by the Sheets API)
+def to_sheet_values(surf_data_dict):
+    sheet_values = {}
+    for sheet_name, df in surf_data_dict.items():
+        rows = [[cell for cell in row if cell is not None] for row in df.itertuples(index=False)]
+        sheet_values[sheet_name] = [list(df.columns)] + rows
+    return sheet_values
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+# State of the tracing; off by default, so the traced functions only pay for a single check
+_TRACE = {'enabled': False,
+          'memory': False,
+          'start': None,
+          'events': [],
+          # spans that are open, per thread (to attribute the peak memory of nested spans)
+          'stack': threading.local()}
+
+
+# Function to switch tracing on (and clear the events of an earlier trace)
+def enable_tracing(memory=True):
+    _TRACE.update(enabled=True, memory=memory, start=time.perf_counter(), events=[])
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+# Function to switch tracing off
+def disable_tracing():
+    _TRACE['enabled'] = False
+    if _TRACE['memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def tracing_enabled():
+    return _TRACE['enabled']
+
+
+# Function to get the recorded events (one per span, in the order they ended)
+def trace_events():
+    return list(_TRACE['events'])
+
+
+# Function to add the events recorded in another process (e.g. a render worker) to the trace
+def add_trace_events(events):
+    if _TRACE['enabled']:
+        _TRACE['events'].extend(events)
+
+
+# Function to count the rows and size (MB, shallow) of the frames in a value (a frame, or a list/tuple/dict of them)
+def describe_frames(value):
+    if isinstance(value, pd.DataFrame):
+        return len(value), value.memory_usage(index=True, deep=False).sum() / 1e6
+    if isinstance(value, pd.Series):
+        return len(value), value.memory_usage(index=True, deep=False) / 1e6
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        rows, size = 0, 0.0
+        for item in value:
+            if isinstance(item, (pd.DataFrame, pd.Series, dict, list, tuple)):
+                item_rows, item_size = describe_frames(item)
+                rows, size = rows + (item_rows or 0), size + (item_size or 0)
+        return (rows, size) if size else (None, None)
+    return None, None
+
+
+def _span_stack():
+    stack = getattr(_TRACE['stack'], 'spans', None)
+    if stack is None:
+        stack = _TRACE['stack'].spans = []
+    return stack
+
+
+@contextmanager
+def trace_span(name, category='stage', inputs=None):
+    """
+    Record the wall time, CPU time and peak traced memory of a block of code (when tracing is enabled).
+    Arguments:
+        name: name of the span
+        category: kind of step, e.g. 'ingest', 'process', 'summarise', 'plot' or 'export'
+        inputs: value(s) the block works on, to record their rows and size
+    Yields:
+        dictionary of the span; set span['output'] to record the rows and size of the result
+    """
+    if not _TRACE['enabled']:
+        yield {}
+        return
+
+    stack = _span_stack()
+    span = {'name': name, 'category': category, 'depth': len(stack)}
+    span['input_rows'], span['input_mb'] = describe_frames(inputs)
+    if _TRACE['memory']:
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak so far belongs to the parent span; start counting again for this one
+        if stack:
+            stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+        tracemalloc.reset_peak()
+        span['_memory_start'], span['_peak'] = current, current
+
+    stack.append(span)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield span
+    finally:
+        span['wall_s'] = time.perf_counter() - start_wall
+        span['cpu_s'] = time.process_time() - start_cpu
+        span['start_s'] = start_wall - _TRACE['start']
+        stack.pop()
+        if _TRACE['memory']:
+            peak = max(span.pop('_peak'), tracemalloc.get_traced_memory()[1])
+            span['peak_mb'] = (peak - span.pop('_memory_start')) / 1e6
+            if stack:
+                stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+        span['output_rows'], span['output_mb'] = describe_frames(span.pop('output', None))
+        span['pid'], span['tid'] = os.getpid(), threading.get_ident()
+        _TRACE['events'].append(span)
+
+
+def traced(category='stage', name=None):
+    """
+    Decorator to record a span (see trace_span) for every call of a function, with the rows and size
+    of the frames it gets and returns.
+    Arguments:
+        category: kind of step, e.g. 'ingest', 'process', 'summarise', 'plot' or 'export'
+        name: name of the span (default: module.function)
+    """
+    def decorator(function):
+        span_name = name or f'{function.__module__}.{function.__qualname__}'
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _TRACE['enabled']:
+                return function(*args, **kwargs)
+            with trace_span(span_name, category, inputs=list(args) + list(kwargs.values())) as span:
+                result = function(*args, **kwargs)
+                span['output'] = result
+            return result
+        return wrapper
+    return decorator
+
+
+def write_trace(file_path, trace_format='json'):
+    """
+    Save the recorded events.
+    Arguments:
+        file_path: file to save the trace in
+        trace_format: 'json' (list of spans) or 'chrome' (Chrome trace event format, for chrome://tracing or Perfetto)
+    """
+    events = trace_events()
+    if trace_format == 'chrome':
+        trace = {'traceEvents': [{'name': event['name'],
+                                  'cat': event['category'],
+                                  'ph': 'X',
+                                  'ts': event['start_s'] * 1e6,
+                                  'dur': event['wall_s'] * 1e6,
+                                  'pid': event['pid'],
+                                  'tid': event['tid'],
+                                  'args': {key: value for key, value in event.items()
+                                           if key not in ['name', 'category', 'start_s', 'wall_s', 'pid', 'tid']}}
+                                 for event in events],
+                 'displayTimeUnit': 'ms'}
+    elif trace_format == 'json':
+        trace = {'events': sorted(events, key=lambda event: event['start_s'])}
+    else:
+        raise ValueError(f'Unknown trace format "{trace_format}", use "json" or "chrome"')
+
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    with open(file_path, 'w') as f:
+        json.dump(trace, f, indent=1, default=float)
+    print(f"Trace saved as {file_path}")
+
+
+# Function to print the slowest spans, to see which stage dominates a run
+def print_trace_summary(top_n=15):
+    events = sorted(trace_events(), key=lambda event: event['wall_s'], reverse=True)[:top_n]
+    print(f"\n{'wall [s]':>9} {'cpu [s]':>8} {'peak [MB]':>10} {'rows in':>9} {'rows out':>9}  span")
+    for event in events:
+        peak = f"{event['peak_mb']:.1f}" if 'peak_mb' in event else '-'
+        rows_in = event['input_rows'] if event['input_rows'] is not None else '-'
+        rows_out = event['output_rows'] if event['output_rows'] is not None else '-'
+        print(f"{event['wall_s']:>9.3f} {event['cpu_s']:>8.3f} {peak:>10} {rows_in:>9} {rows_out:>9}  "
+              f"{'  ' * event['depth']}{event['name']} [{event['category']}]")
@@ -1,11 +1,13 @@
 import re
 import pandas as pd
 import numpy as np
-import statistics
-import matplotlib.pyplot as plt
-from datetime import datetime
 import os
-import json
+import io
+
+from src.artifacts import store_artifact
+
+# regex for a single number in a wave height (e.g. the '3' and '5' in '3-5', or the '2.5' in '2.5+')
+WAVE_HEIGHT_NUMBER = r'(\d+(?:\.\d+)?|\.\d+)'
 
 
 # function to assert that two dataframes have the same number of rows
@@ -19,44 +21,25 @@ def to_snake_case(string):
     return string.lower()
 
 
-# Function to convert columns to numeric if all values are numeric
-def convert_numeric_columns(df):
-    for col in df.columns:
-        try:
-            # Attempt to convert the entire column to numeric
-            df[col] = pd.to_numeric(df[col], errors='raise')
-        except (ValueError, TypeError):
-            # If conversion fails for any value, skip this column
-            pass
-    return df
-
-
 # Function to average the wave height for a sheet
+# Wave heights are logged as a single value ('4'), a range ('3-5'), a list ('2,4'), a decimal ('2.5') or with a plus ('6+').
+# Adds the float columns wave_height_avg, wave_height_min and wave_height_max.
 def calc_avg_wave_height(df):
 
-  # initialize vector
-  wave_ht_avg = []
-  for wave_height in df["wave_height"]:
-    # if NA value, keep NA
-    if pd.isna(wave_height):
-      wave_ht_avg.append(pd.NA)
-    # If we have a single numeric value, use that
-    elif wave_height.isnumeric():
-      wave_ht_avg.append(wave_height)
-    # if not single numeric value, then calculate the average
-    else:
-      # force all these values to be strings
-      wave_height_str = str(wave_height)
-      # change all '-' to ',' then split by comma
-      vals = wave_height_str.replace('-', ',').split(',')
-      # now make each str we split and turn them into ints
-      vals_int = map(int, vals)
-      # get average of the two values
-      avg = statistics.mean(vals_int)
-      # append this avg to the vector we initialized
-      wave_ht_avg.append(avg)
-  # Put values into the dataframe
-  df["wave_height_avg"] = wave_ht_avg
+  # there are only a handful of distinct wave heights, so parse each distinct value once and map back to the rows
+  codes, uniques = pd.factorize(df["wave_height"])
+  # pull out every number in each distinct value
+  numbers = (pd.Series(uniques, dtype=str)
+             .str.extractall(WAVE_HEIGHT_NUMBER)[0]
+             .astype(float))
+  stats = (numbers
+           .groupby(level=0)
+           .agg(['mean', 'min', 'max'])
+           .reindex(range(len(uniques))))
+
+  # NA values have a code of -1, which picks up the NaN appended to the end
+  for stat, col in [('mean', 'wave_height_avg'), ('min', 'wave_height_min'), ('max', 'wave_height_max')]:
+    df[col] = np.append(stats[stat].to_numpy(dtype=np.float64), np.nan)[codes]
   return df
 
 
@@ -79,6 +62,15 @@ def assign_season(month):
         return 'Unknown'  # Handle cases outside the 1-12 range
 
 
+# Function to give every session a key from its content (the columns given), so a session keeps its key however
+# the log around it changes (a session_id shifts when an earlier session is added); identical sessions are told
+# apart by their occurrence
+def session_keys(sessions, columns):
+    hashes = pd.util.hash_pandas_object(sessions.reindex(columns=columns), index=False).to_numpy()
+    occurrence = pd.Series(hashes).groupby(hashes).cumcount().to_numpy()
+    return pd.util.hash_pandas_object(pd.DataFrame({'hash': hashes, 'occurrence': occurrence}), index=False).to_numpy()
+
+
 def check_n_distinct(df, col):
     val_counts = df[col].value_counts().reset_index().sort_values(by=col)
     for row in val_counts.itertuples():
@@ -88,48 +80,17 @@ def check_n_distinct(df, col):
 # save two versions of a file, 
 # 1. undated, in main folder
 # 2. dated, in a subfolder with the current date (to keep historical versions)
+# the figure is encoded once, and both versions are links to a single copy (see src.artifacts)
 def save_plt_dated(plot_folder, filename):
-    current_date = datetime.now().strftime("%Y%m%d")
-    filename_dated = f'{current_date}_{filename}'
-    
-    output_file_path = os.path.join(plot_folder, filename)
-    output_file_path_dated = os.path.join(plot_folder, current_date, filename_dated)
-    # if output_file_path_dated doesn't exist, create the folder
-    if not os.path.exists(os.path.dirname(output_file_path_dated)):
-        os.makedirs(os.path.dirname(output_file_path_dated))
-
-    plt.savefig(output_file_path)
-    plt.savefig(output_file_path_dated)
+    import matplotlib.pyplot as plt
+
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format=os.path.splitext(filename)[1][1:] or None)
+    store_artifact(plot_folder, filename, buffer.getvalue())
 
 # save two versions of a file, 
 # 1. undated, in main folder
 # 2. dated, in a subfolder with the current date (to keep historical versions)
+# the csv is written once, and both versions are links to a single copy (see src.artifacts)
 def save_csv_dated(plot_folder, filename, df):
-    current_date = datetime.now().strftime("%Y%m%d")
-    filename_dated = f'{current_date}_{filename}'
-    
-    output_file_path = os.path.join(plot_folder, filename)
-    output_file_path_dated = os.path.join(plot_folder, current_date, filename_dated)
-    # if output_file_path_dated doesn't exist, create the folder
-    if not os.path.exists(os.path.dirname(output_file_path_dated)):
-        os.makedirs(os.path.dirname(output_file_path_dated))
-
-    df.to_csv(output_file_path, index=False)
-    df.to_csv(output_file_path_dated, index=False)
-
-
-class NpEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        if isinstance(obj, np.floating):
-            return float(obj)
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        if isinstance(obj, pd.Timestamp):
-            return obj.isoformat()
-        if isinstance(obj, np.datetime64):
-            return pd.Timestamp(obj).isoformat()
-        if pd.isna(obj):  # Handle NaN, NaT, None
-            return None
-        return super(NpEncoder, self).default(obj)
\ No newline at end of file
+    store_artifact(plot_folder, filename, df.to_csv(index=False).encode())
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from analysis.regions import build_month_region_cube, cube_region_series, cube_stack_baselines
+
+
+# Sessions over two years in three regions, with missing hours (and a session without a region)
+def sessions_with_missing_hours():
+    return pd.DataFrame({'year': [2022, 2022, 2022, 2022, 2023, 2023, 2023],
+                         'month': [1, 1, 1, 3, 2, 2, 2],
+                         'region': pd.Categorical(['Hawaii', 'Other', 'Hawaii', 'Other', 'Central CA', None, 'Hawaii']),
+                         'hrs': np.array([1.5, np.nan, 2.0, 1.0, np.nan, 3.0, 2.5], dtype='float32')})
+
+
+def test_cube_totals_match_groupby_sum():
+    df = sessions_with_missing_hours()
+    cube = build_month_region_cube(df)
+
+    expected = df.groupby(['year', 'month', 'region'], observed=True)['hrs'].sum()
+    series = cube_region_series(cube)
+    for (year, month, region), hrs in expected.items():
+        assert series.loc[pd.Timestamp(year=year, month=month, day=1), region] == hrs
+    assert np.isfinite(cube.values).all()
+    assert cube.values.sum() == expected.sum()
+    assert set(cube.regions) == set(expected.index.get_level_values('region'))
+
+
+def test_stack_baselines_are_finite_with_missing_hours():
+    lower, upper = cube_stack_baselines(build_month_region_cube(sessions_with_missing_hours()), baseline='symmetric')
+    assert np.isfinite(lower).all() and np.isfinite(upper).all()
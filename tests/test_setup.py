@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+from src.setup import load_gsheet
+
+SHEETS = {'2023': [['Year', 'Month', 'Day', 'Spot', 'HRS'], ['2023', '1', '2', 'Blacks', '1.5']],
+          '2024': [['Year', 'Month', 'Day', 'Spot', 'HRS'], ['2024', '3', '4', 'Rincon', '2'], ['2024', '3', '5', 'Rincon', '1']],
+          'Boards': [['Board', 'Length'], ['Fish', '5\'6']]}
+
+
+# Error of the API, with the HTTP status on its response (as googleapiclient's HttpError)
+class FakeApiError(Exception):
+    def __init__(self, status):
+        super().__init__(f'HTTP {status}')
+        self.resp = type('Response', (), {'status': status})()
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        if isinstance(self.response, Exception):
+            raise self.response
+        return self.response
+
+
+# Local stand-in for the sheets service, recording every request it is asked for (and by which thread)
+class FakeService:
+    def __init__(self, sheets=SHEETS, batch_error=None):
+        self.sheets = sheets
+        self.batch_error = batch_error
+        self.calls = []
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range=None):
+        if range is None:
+            self.calls.append(('get_sheet_names', None, threading.get_ident()))
+            return FakeRequest({'sheets': [{'properties': {'title': name}} for name in self.sheets]})
+        self.calls.append(('get', range, threading.get_ident()))
+        return FakeRequest({'values': self.sheets[range.split('!')[0].strip("'")]})
+
+    def batchGet(self, spreadsheetId, ranges):
+        self.calls.append(('batchGet', tuple(ranges), threading.get_ident()))
+        return FakeRequest(self.batch_error or {'valueRanges': [{'values': self.sheets[r.split('!')[0].strip("'")]}
+                                                                 for r in ranges]})
+
+
+def test_sheets_are_fetched_in_a_single_batch_round_trip():
+    service = FakeService()
+    data_dict = load_gsheet('sheet-id', None, service=service)
+
+    assert [call[0] for call in service.calls] == ['get_sheet_names', 'batchGet']
+    assert list(data_dict) == list(SHEETS)
+    assert data_dict['2024']['hrs'].tolist() == [2, 1]
+
+
+def test_rejected_batch_falls_back_to_one_request_per_sheet():
+    service = FakeService(batch_error=FakeApiError(400))
+    data_dict = load_gsheet('sheet-id', None, service=service)
+
+    requested = sorted(call[1] for call in service.calls if call[0] == 'get')
+    assert requested == sorted(f"'{name}'!A:Z" for name in SHEETS)
+    assert list(data_dict) == list(SHEETS)
+    # a single injected service is never shared between threads
+    assert len({call[2] for call in service.calls if call[0] == 'get'}) == 1
+
+
+def test_every_worker_thread_builds_its_own_service():
+    services = []
+
+    def service_factory():
+        services.append(FakeService(batch_error=FakeApiError(400)))
+        return services[-1]
+
+    data_dict = load_gsheet('sheet-id', None, service_factory=service_factory, max_workers=3)
+
+    assert list(data_dict) == list(SHEETS)
+    for service in services[1:]:
+        assert len({call[2] for call in service.calls}) == 1
+
+
+@pytest.mark.parametrize('error', [FakeApiError(429), KeyError('valueRanges')])
+def test_quota_errors_and_bugs_are_not_retried_per_sheet(error, monkeypatch):
+    monkeypatch.setattr('src.setup.time.sleep', lambda seconds: None)
+    service = FakeService(batch_error=error)
+    with pytest.raises(type(error)):
+        load_gsheet('sheet-id', None, service=service)
+    assert not [call for call in service.calls if call[0] == 'get']
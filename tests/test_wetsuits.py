@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from analysis.wetsuits import update_wetsuit_ledger, wetsuit_totals, wetsuit_wear_between
+
+
+# Sessions of two wetsuits; the last session of each has no hours (an NA in the sheet)
+def sessions_with_missing_hours():
+    return pd.DataFrame({'date': pd.to_datetime(['2024-01-01', '2024-01-05', '2024-01-09', '2024-01-10']),
+                         'wetty': pd.Categorical(['A', 'A', 'A', 'B']),
+                         'hrs': np.array([1, 2, np.nan, np.nan], dtype='float32'),
+                         'wtmp': [14.0, np.nan, 16.0, 12.0]})
+
+
+def test_sessions_without_hours_keep_the_totals_finite():
+    sessions = sessions_with_missing_hours()
+    ledger = update_wetsuit_ledger(update_wetsuit_ledger(None, sessions.iloc[:2]), sessions)
+
+    totals = wetsuit_totals(ledger)
+    assert totals['sessions'].tolist() == [3, 1]
+    assert totals['hours'].tolist() == [3, 0]
+    assert all(np.isfinite(ledger.cumulative[stat]).all() for stat in ledger.cumulative)
+    assert np.isfinite(wetsuit_wear_between(ledger).to_numpy()).all()
+
+
+def test_appended_sessions_match_a_rebuild():
+    sessions = sessions_with_missing_hours()
+    appended = update_wetsuit_ledger(update_wetsuit_ledger(None, sessions.iloc[:2]), sessions)
+    rebuilt = update_wetsuit_ledger(None, sessions)
+    for stat in rebuilt.cumulative:
+        np.testing.assert_array_equal(appended.cumulative[stat], rebuilt.cumulative[stat])